@@ -0,0 +1,133 @@
+"""
+Minimal asyncio stand ins for redis and the HAProxy stats socket, for
+running `redundis_aio.AioWatcher` end to end (Python 3 only)
+"""
+import redundis_aio as aio
+import asyncio
+
+
+class AioFakeRedis(object):
+    """
+    A minimal asyncio redis: PING, INFO, SLAVEOF and a BLPOP that
+    hangs until the instance stops.  A slave's link is up while the
+    instance it replicates from is running.
+    """
+    def __init__(self, registry, port=0):
+        self.registry = registry
+        self.port = port
+        self.role = 'master'
+        self.master = None
+        self.server = None
+        self.writers = []
+
+    @property
+    def spec(self):
+        return '127.0.0.1:%d' % self.port
+
+    async def start(self):
+        self.stopped = asyncio.Event()
+        self.role, self.master = 'master', None
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.registry[self.port] = self
+        return self
+
+    async def stop(self):
+        self.stopped.set()
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+
+    def info(self):
+        lines = ['# Replication', 'role:%s' % self.role]
+        if self.role == 'slave':
+            upstream = self.registry.get(self.master)
+            link = upstream is not None and upstream.server is not None and 'up' or 'down'
+            lines += ['master_link_status:%s' % link, 'master_last_io_seconds_ago:0',
+                      'slave_repl_offset:0']
+        else:
+            lines.append('master_repl_offset:0')
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    async def execute(self, args):
+        cmd = args[0].upper()
+        if cmd == b'PING':
+            return b'+PONG\r\n'
+        if cmd == b'INFO':
+            body = self.info()
+            return b'$%d\r\n%s\r\n' % (len(body), body)
+        if cmd == b'SLAVEOF':
+            if args[1].upper() == b'NO':
+                self.role, self.master = 'master', None
+            else:
+                self.role, self.master = 'slave', int(args[2])
+            return b'+OK\r\n'
+        if cmd == b'BLPOP':
+            await self.stopped.wait()
+        return b'-ERR unknown command\r\n'
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        try:
+            while self.server is not None:
+                writer.write(await self.execute(await aio.read_reply(reader)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class AioFakeStats(object):
+    """
+    A minimal HAProxy stats socket in prompt mode: `get weight` and
+    `set weight`
+    """
+    def __init__(self, path, servers):
+        self.path = path
+        self.weights = dict(servers)
+        self.server = None
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle, self.path)
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    def execute(self, line):
+        words = line.split()
+        if words[:2] == ['get', 'weight']:
+            weight = self.weights[words[2].split('/')[1]]
+            return '%d (initial %d)\n' % (weight, weight)
+        if words[:2] == ['set', 'weight']:
+            self.weights[words[2].split('/')[1]] = int(words[3])
+        return ''
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        try:
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                writer.write((self.execute(line) + '\n> ').encode())
+        finally:
+            writer.close()
+
+
+async def dispatch(watcher):
+    """
+    Probes the chain and dispatches on its roles once
+    """
+    return await watcher.dispatch_for_roles(watcher.roles(await watcher.probe()))
+
+
+async def stop_later(fake, delay):
+    await asyncio.sleep(delay)
+    await fake.stop()
@@ -0,0 +1,537 @@
+"""
+An asyncio engine for the watcher
+
+Runs the same role dispatch as `watcher.Watcher` (the handlers of
+`roles.ChainRoles`) on asyncio instead of gevent, with no monkey
+patching, so it can be embedded in an asyncio service::
+
+  watcher = AioWatcher(['localhost:6379', 'localhost:6380'], '/tmp/haproxy.sock')
+  task = asyncio.ensure_future(watcher.loop())
+
+Handlers are synchronous: while one runs, the engine's `rechain`,
+`drain_lag` and `assign_weights` only record a plan, which is then
+carried out with `apply`.
+
+Python 3 only, so it lives outside the redundis package, which is
+Python 2.  It needs only `redundis.roles` and `redundis.damping`,
+which import on either, and runs from a checkout with::
+
+  PYTHONPATH=. python3 examples/aio/redundis_aio.py --redi=localhost:6379,localhost:6380
+"""
+from redundis.damping import Damper
+from redundis.roles import ChainRoles
+from redundis.roles import Logged
+from redundis.roles import Snapshot
+import argparse
+import asyncio
+
+
+class ReplyError(Exception):
+    """
+    Redis answered with an error reply
+    """
+
+
+def encode(*args):
+    """
+    Encodes a command as a RESP multi-bulk request
+    """
+    args = [x if isinstance(x, bytes) else str(x).encode() for x in args]
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+async def read_reply(reader):
+    """
+    Reads one reply from the `asyncio.StreamReader` `reader`
+    """
+    line = await reader.readuntil(b'\r\n')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise ReplyError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        size = int(rest)
+        if size < 0:
+            return None
+        data = await reader.readexactly(size + 2)
+        return data[:-2]
+    if kind == b'*':
+        size = int(rest)
+        if size < 0:
+            return None
+        return [await read_reply(reader) for x in range(size)]
+    raise ReplyError('unknown reply type %r' % kind)
+
+
+def parse_info(data):
+    """
+    Parses the body of an INFO reply into a dict, with numbers as
+    ints as redis-py does
+    """
+    out = {}
+    for line in data.decode().splitlines():
+        if not line or line.startswith('#') or ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+        out[key] = value
+    return out
+
+
+# what an instance that is down or wedged raises
+Unreachable = (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+
+class AioRedis(Logged):
+    """
+    A redis instance in the chain, spoken to over one connection
+    """
+    def __init__(self, host, port, timeout=1.0):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.lock = None
+        self.connected = False
+        self.snapshot = Snapshot.down
+
+    @classmethod
+    def from_spec(cls, spec, **kw):
+        host, port = spec.split(':')
+        return cls(host, port, **kw)
+
+    @property
+    def spec(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def __repr__(self):
+        return '<AioRedis %s>' % self.spec
+
+    async def open(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                      self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def command(self, *args):
+        """
+        Sends one command and returns its reply, giving up after
+        `timeout` seconds.  The connection is dropped on any failure.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await self.open()
+                self.writer.write(encode(*args))
+                return await asyncio.wait_for(read_reply(self.reader), self.timeout)
+            except Unreachable:
+                self.close()
+                raise
+
+    async def ping(self):
+        try:
+            return await self.command('PING') == b'PONG'
+        except Unreachable:
+            return False
+
+    async def probe(self):
+        """
+        Takes a `Snapshot` of the instance's replication state
+        """
+        try:
+            info = parse_info(await self.command('INFO', 'replication'))
+        except Unreachable:
+            self.snapshot = Snapshot.down
+        else:
+            self.snapshot = Snapshot.from_info(info)
+        return self.snapshot
+
+    async def slaveof(self, upstream=None):
+        if upstream is None:
+            return await self.command('SLAVEOF', 'NO', 'ONE')
+        return await self.command('SLAVEOF', upstream.host, upstream.port)
+
+    async def monitor_up(self, key='redundis.monitor'):
+        """
+        Hangs a BLPOP on a connection of its own until it fails
+        (False) or something is pushed to `key` (True)
+        """
+        writer = None
+        try:
+            reader, writer = await self.open()
+            while True:
+                writer.write(encode('BLPOP', key, 0))
+                try:
+                    await read_reply(reader)
+                    return True
+                except ReplyError as e:
+                    # UNBLOCKED when the instance's role changes under us
+                    self.debug("%s blpop: %s", self.spec, e)
+        except Unreachable:
+            self.warn("%s has had a connection failure", self.spec)
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def monitor_down(self, interval=2):
+        """
+        Polls the instance until it answers
+        """
+        while not await self.ping():
+            await asyncio.sleep(interval)
+        self.info("%s back up", self.spec)
+        return True
+
+    async def watch(self, publish, interval=2):
+        """
+        Monitors the instance for as long as the task lives, calling
+        `publish((self, up))` on each change of state
+        """
+        while True:
+            if self.connected:
+                up = await self.monitor_up()
+            else:
+                up = await self.monitor_down(interval)
+            self.connected = up
+            publish((self, up))
+
+
+class AioStats(Logged):
+    """
+    An HAProxy stats socket client holding one session in prompt mode
+    """
+    prompt = b'\n> '
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.lock = None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(self.path), self.timeout)
+        self.writer.write(b'prompt\n')
+        await asyncio.wait_for(self.reader.readuntil(self.prompt), self.timeout)
+
+    async def execute_many(self, cmds, retry=1):
+        """
+        Pipelines `cmds` and returns their responses in order
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    await self.connect()
+                self.writer.write(b''.join(cmd.encode() + b'\n' for cmd in cmds))
+                out = []
+                for cmd in cmds:
+                    data = await asyncio.wait_for(self.reader.readuntil(self.prompt),
+                                                  self.timeout)
+                    out.append(data[:-len(self.prompt)].decode().strip())
+                return out
+            except Unreachable:
+                self.close()
+                if not retry:
+                    raise
+        return await self.execute_many(cmds, retry - 1)
+
+    async def get_weights(self, backend, servers):
+        return await self.execute_many(['get weight %s/%s' % (backend, server) \
+                                         for server in servers])
+
+    async def set_weights(self, backend, weights):
+        """
+        Sets each `(server, weight)` of `weights` and returns the
+        weights now current, in one round trip
+        """
+        cmds = []
+        for server, weight in weights:
+            cmds.append('set weight %s/%s %s' % (backend, server, weight))
+            cmds.append('get weight %s/%s' % (backend, server))
+        return (await self.execute_many(cmds))[1::2]
+
+
+def parse_weight(resp):
+    try:
+        return int(resp.split(None, 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+class AioWatcher(ChainRoles):
+    """
+    Watches a chain of redis instances and keeps HAProxy weighted to
+    it, like `watcher.Watcher`, on asyncio
+    """
+    redis_class = AioRedis
+    stats_class = AioStats
+
+    def __init__(self, redi, haproxy_sock, ha_backend='redis', ha_prefix='redis-%s',
+                 down_poll=2, probe_timeout=1.0, promote_wait=0, topology='chain',
+                 weights=None, name='default', damping_args=None, sync_timeout=5.0):
+        assert topology in self.topologies, "Unknown topology %s" % topology
+        self.name = name
+        self.topology = topology
+        if weights is not None:
+            self.weights = tuple(weights)
+        self.down_poll = down_poll
+        self.promote_wait = promote_wait
+        self.sync_timeout = sync_timeout
+        self.syncing = frozenset()
+        self.ha_backend = ha_backend
+        self.ha_prefix = ha_prefix
+        self.instances = [self.redis_class.from_spec(spec, timeout=probe_timeout) \
+                          for spec in redi]
+        self.haproxy = self.stats_class(haproxy_sock, timeout=probe_timeout)
+        self.damper = Damper(**(damping_args or {}))
+        self.weight_cache = {}
+        self.plan = []
+        self.watches = {}
+        self.changes = None
+
+    async def probe(self):
+        """
+        Snapshots every instance once, concurrently
+        """
+        return await asyncio.gather(*[inst.probe() for inst in self.instances])
+
+    def roles(self, snaps):
+        roles = []
+        for inst, snap in zip(self.instances, snaps):
+            if snap.up and not self.damper.admit(inst):
+                self.debug("%s held back (%s)", inst.spec, snap)
+                roles.append(None)
+                continue
+            roles.append(snap.role)
+        return roles
+
+    # while a handler runs, these only record what is to be done
+
+    def rechain(self, insts, promote=False):
+        self.plan.append(('rechain', list(insts), promote))
+
+    def drain_lag(self, master, slaves):
+        self.plan.append(('drain', master, list(slaves)))
+        return []
+
+    def await_sync(self, insts):
+        self.plan.append(('sync', list(insts)))
+
+    def assign_weights(self, *insts):
+        self.plan.append(('weights', list(insts)))
+
+    async def apply(self, plan):
+        for step in plan:
+            await getattr(self, 'apply_' + step[0])(*step[1:])
+
+    async def apply_rechain(self, insts, promote=False):
+        jobs = []
+        if promote:
+            jobs.append((insts[0], insts[0].slaveof()))
+        jobs.extend((inst, inst.slaveof(upstream)) \
+                    for inst, upstream in self.replication_pairs(insts))
+        outs = await asyncio.gather(*[job for inst, job in jobs], return_exceptions=True)
+        for (inst, job), out in zip(jobs, outs):
+            if isinstance(out, Exception):
+                self.warn("%s: slaveof failed: %r", inst.spec, out)
+
+    async def apply_drain(self, master, slaves):
+        """
+        Waits up to `promote_wait` seconds for `slaves` to reach the
+        offset of the `master` about to be promoted
+        """
+        target = master.snapshot.offset
+        if not self.promote_wait or target is None:
+            return []
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.promote_wait
+        lagging = [inst for inst in slaves if (inst.snapshot.offset or 0) < target]
+        while lagging and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+            await asyncio.gather(*[inst.probe() for inst in lagging])
+            lagging = [inst for inst in lagging \
+                       if inst.snapshot.up and (inst.snapshot.offset or 0) < target]
+        return lagging
+
+    async def apply_sync(self, insts):
+        """
+        Waits up to `sync_timeout` seconds for the slaves of `insts`
+        to report their link up, weighting the head at once if any has
+        yet to, as `watcher.Watcher.await_sync` does
+        """
+        if not self.sync_timeout or len(insts) < 2:
+            return []
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.sync_timeout
+        pause = 0.01
+        await asyncio.gather(*[inst.probe() for inst in insts[1:]])
+        lagging = [inst for inst in insts if inst not in self.synced(insts)]
+        if lagging:
+            await self.apply_weights(self.synced(insts))
+        while lagging and loop.time() < deadline:
+            await asyncio.sleep(min(pause, max(0, deadline - loop.time())))
+            pause = min(pause * 2, 0.2)
+            await asyncio.gather(*[inst.probe() for inst in lagging])
+            lagging = [inst for inst in insts if inst not in self.synced(insts)]
+        for inst in lagging:
+            self.warn("%s still syncing (%s), leaving it at weight 0", inst.spec, inst.snapshot)
+        self.syncing = frozenset(lagging)
+        return lagging
+
+    async def apply_weights(self, insts):
+        """
+        Weights `insts` in chain order and drains the rest to 0,
+        sending only changes, draining first, in one batch
+        """
+        insts = self.weighted(insts)
+        target = dict((self.ha_prefix % inst.port, self.weight_for(i)) \
+                      for i, inst in enumerate(insts))
+        target.update((self.ha_prefix % inst.port, 0) \
+                      for inst in self.instances if inst not in insts)
+        diff = [(server, weight) for server, weight in sorted(target.items()) \
+                if self.weight_cache.get(server) != weight]
+        diff.sort(key=lambda sw: (sw[1] > (self.weight_cache.get(sw[0]) or 0), sw[1]))
+        if not diff:
+            return []
+        current = await self.haproxy.set_weights(self.ha_backend, diff)
+        for (server, weight), resp in zip(diff, current):
+            self.weight_cache[server] = parse_weight(resp)
+            self.debug("%s => %s", server, resp)
+        return diff
+
+    async def dispatch_for_roles(self, roles):
+        self.debug("dfr: %s %s", self.name, roles)
+        name = self.handler_for(roles)
+        if name is None:
+            return self.instances
+        self.plan = []
+        self.syncing = frozenset()
+        try:
+            getattr(self, name)(roles)
+            await self.apply(self.plan)
+        except Exception:
+            self.error("Unexpected exception", exc_info=True)
+        return self.instances
+
+    async def check_and_respond(self):
+        """
+        Inspects the chain, reacts to its state and makes sure each
+        instance has a monitor
+        """
+        snaps = await self.probe()
+        insts = await self.dispatch_for_roles(self.roles(snaps))
+        servers = [self.ha_prefix % inst.port for inst in insts]
+        try:
+            weights = await self.haproxy.get_weights(self.ha_backend, servers)
+        except Unreachable:
+            weights = ['?'] * len(insts)
+        for inst, weight in zip(insts, weights):
+            up = inst.snapshot.up
+            self.info("%s %s (%s) => %s", inst.spec, up and "UP" or "DOWN",
+                      inst.snapshot, weight)
+            self.supervise(inst, up)
+
+    def supervise(self, inst, up):
+        """
+        Restarts the monitor of `inst` only if it does not already
+        expect the instance to be `up`
+        """
+        task = self.watches.get(inst)
+        if task is not None and not task.done() and inst.connected == up:
+            return None
+        if task is not None:
+            task.cancel()
+        self.rejoined(inst, up)
+        inst.connected = up
+        task = self.watches[inst] = asyncio.ensure_future(
+            inst.watch(self.changes.put_nowait, interval=self.down_poll))
+        return task
+
+    async def drain_changes(self):
+        review = self.damper.next_review()
+        if self.syncing:
+            review = min(x for x in (review, self.down_poll) if x is not None)
+        try:
+            changes = [await asyncio.wait_for(self.changes.get(), review)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.changes.empty():
+            changes.append(self.changes.get_nowait())
+        return changes
+
+    def caboose(self, inst):
+        if inst in self.instances:
+            self.instances.remove(inst)
+            self.instances.append(inst)
+            self.debug("%s caboosed", inst.spec)
+
+    async def loop(self):
+        """
+        Dispatches on the chain, then again on every change the
+        monitors publish, as `watcher.Watcher.loop` does
+        """
+        self.changes = asyncio.Queue()
+        try:
+            while True:
+                await self.check_and_respond()
+                for inst, up in await self.drain_changes():
+                    self.damper.record(inst, up)
+                    if not up:
+                        self.caboose(inst)
+        finally:
+            for task in self.watches.values():
+                task.cancel()
+            self.haproxy.close()
+            for inst in self.instances:
+                inst.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the watcher on asyncio')
+    parser.add_argument('-r', '--redi', default='localhost:6379,localhost:6380,localhost:6381',
+                        help='Redis instances (comma delimited)')
+    parser.add_argument('--haproxy_sock', default='/tmp/redundis-haproxy.sock',
+                        help='HAProxy stats socket')
+    parser.add_argument('--haproxy_backend', default='redis', help='HAProxy backend')
+    parser.add_argument('--probe_timeout', type=float, default=1.0,
+                        help='Seconds before a command to an instance counts as failed')
+    parser.add_argument('--promote_wait', type=float, default=0,
+                        help='Seconds to let lagging slaves catch up before promoting a new master')
+    parser.add_argument('--sync_timeout', type=float, default=5.0,
+                        help='Seconds to wait for slaves to replicate before weighting them')
+    parser.add_argument('--topology', default='chain', choices=ChainRoles.topologies)
+    args = parser.parse_args(argv)
+    watcher = AioWatcher(args.redi.split(','), args.haproxy_sock, args.haproxy_backend,
+                         probe_timeout=args.probe_timeout, promote_wait=args.promote_wait,
+                         topology=args.topology, sync_timeout=args.sync_timeout)
+    watcher.logging_setup()
+    try:
+        asyncio.run(watcher.loop())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import sys
+import unittest
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the asyncio engine needs Python 3.7")
+class TestResp(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def read(self, data):
+        import asyncio
+        import redundis_aio as aio
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        return self.loop.run_until_complete(aio.read_reply(reader))
+
+    def test_encode(self):
+        import redundis_aio as aio
+        assert aio.encode('SLAVEOF', 'NO', 'ONE') == b'*3\r\n$7\r\nSLAVEOF\r\n$2\r\nNO\r\n$3\r\nONE\r\n'
+
+    def test_read_reply(self):
+        assert self.read(b'+PONG\r\n') == b'PONG'
+        assert self.read(b'*2\r\n$3\r\nfoo\r\n:42\r\n') == [b'foo', 42]
+        assert self.read(b'$-1\r\n') is None
+
+    def test_error_reply(self):
+        import redundis_aio as aio
+        self.assertRaises(aio.ReplyError, self.read, b'-UNBLOCKED\r\n')
+
+    def test_parse_info(self):
+        import redundis_aio as aio
+        info = aio.parse_info(b'# Replication\r\nrole:slave\r\nslave_repl_offset:42\r\n')
+        assert info == dict(role='slave', slave_repl_offset=42)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the asyncio engine needs Python 3.7")
+class TestAioWatcher(unittest.TestCase):
+
+    def makeone(self, *roles):
+        import redundis_aio as aio
+        from redundis.roles import Snapshot
+        w = aio.AioWatcher(['localhost:%d' % (6379 + i) for i in range(len(roles))], '/tmp/ha.sock')
+        for inst, role in zip(w.instances, roles):
+            inst.snapshot = role and Snapshot(role, 'up', 0, 0) or Snapshot.down
+        return w
+
+    def test_shares_dispatch_table(self):
+        import redundis_aio as aio
+        from redundis.roles import ChainRoles
+        assert aio.AioWatcher._role_patterns is ChainRoles._role_patterns
+
+    def test_dead_master_plan(self):
+        w = self.makeone(None, 'slave', 'slave')
+        r1, r2, r3 = w.instances
+        roles = w.roles([inst.snapshot for inst in w.instances])
+        name = w.handler_for(roles)
+        assert name == 'dead_master'
+        getattr(w, name)(roles)
+        assert w.instances == [r2, r3, r1]
+        assert w.plan == [('drain', r2, [r3]), ('rechain', [r2, r3], True),
+                          ('sync', [r2, r3]), ('weights', [r2, r3])]
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the asyncio engine needs Python 3.7")
+class TestAioChain(unittest.TestCase):
+    """
+    `AioWatcher` against fake instances and stats socket
+    """
+    def setUp(self):
+        import asyncio
+        import tempfile
+        from aiofakes import AioFakeRedis
+        from aiofakes import AioFakeStats
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp = tempfile.mkdtemp()
+        self.registry = {}
+        self.watchers = []
+        self.redi = [self.wait(AioFakeRedis(self.registry).start()) for x in range(3)]
+        self.ha = self.wait(AioFakeStats(self.tmp + '/ha.sock',
+                                        [('redis-%s' % r.port, 0) for r in self.redi]).start())
+
+    def tearDown(self):
+        import asyncio
+        import shutil
+        for w in self.watchers:
+            for task in w.watches.values():
+                task.cancel()
+            for inst in w.instances:
+                inst.close()
+            w.haproxy.close()
+        for r in self.redi:
+            if r.server is not None:
+                self.wait(r.stop())
+        self.wait(self.ha.stop())
+        self.wait(asyncio.sleep(0.01))
+        self.loop.close()
+        shutil.rmtree(self.tmp)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def makeone(self, **kw):
+        import redundis_aio as aio
+        w = aio.AioWatcher([r.spec for r in self.redi], self.ha.path, **kw)
+        self.watchers.append(w)
+        return w
+
+    def weights(self):
+        return [self.ha.weights['redis-%s' % r.port] for r in self.redi]
+
+    def test_chains_and_weights(self):
+        from aiofakes import dispatch
+        w = self.makeone()
+        r1, r2, r3 = w.instances
+        assert self.wait(dispatch(w)) == [r1, r2, r3]
+        assert [r.role for r in self.redi] == ['master', 'slave', 'slave']
+        assert [r.master for r in self.redi[1:]] == [r1.port, r2.port]
+        assert self.weights() == [150, 1, 0]
+        assert w.syncing == frozenset()
+        assert self.wait(w.haproxy.get_weights('redis', ['redis-%s' % r1.port])) == \
+               ['150 (initial 150)']
+
+    def test_dead_master(self):
+        from aiofakes import dispatch
+        w = self.makeone(sync_timeout=0.2)
+        r1, r2, r3 = w.instances
+        self.wait(dispatch(w))
+        self.wait(self.redi[0].stop())
+        assert self.wait(dispatch(w)) == [r2, r3, r1]
+        assert [r.role for r in self.redi[1:]] == ['master', 'slave']
+        assert self.weights() == [0, 150, 1]
+
+    def test_slave_left_syncing(self):
+        from aiofakes import dispatch
+        w = self.makeone(sync_timeout=0.05)
+        r1, r2, r3 = w.instances
+        self.wait(dispatch(w))
+        # r3 no longer sees its upstream
+        del self.registry[r2.port]
+        self.wait(dispatch(w))
+        assert w.syncing == frozenset([r3])
+        assert self.weights() == [150, 1, 0]
+
+    def test_monitor_up(self):
+        import asyncio
+        from aiofakes import stop_later
+        r1 = self.makeone().instances[0]
+        up, _ = self.wait(asyncio.gather(r1.monitor_up(), stop_later(self.redi[0], 0.05)))
+        assert up is False
+
+    def test_restart_seen_by_probe_admitted(self):
+        import asyncio
+        w = self.makeone(down_poll=30, damping_args=dict(stable_for=0.1))
+        w.changes = asyncio.Queue()
+        r1, r2, r3 = w.instances
+        self.wait(w.check_and_respond())
+        assert all(inst.connected for inst in w.instances)
+        self.wait(self.redi[2].stop())
+        change = self.wait(asyncio.wait_for(w.changes.get(), 1))
+        assert change == (r3, False)
+        w.damper.record(r3, False)
+        self.wait(self.redi[2].start())
+        self.wait(w.check_and_respond())
+        assert r3.connected
+        self.wait(asyncio.sleep(0.15))
+        assert w.roles(self.wait(w.probe())) == ['master', 'slave', 'master']
+        self.wait(w.check_and_respond())
+        assert self.redi[2].role == 'slave'
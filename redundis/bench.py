@@ -0,0 +1,138 @@
+"""
+Failover latency benchmark
+
+Runs the watcher against in-process fake redis instances and a fake
+HAProxy stats socket, fails the master and times each stage of the
+watcher's reaction:
+
+ - detection: failure injected until the watcher dispatches on it
+ - decision: dispatch starts until the first weight change arrives
+ - apply: first weight change until HAProxy weights a new master
+"""
+from .fakes import FakeHAProxy
+from .fakes import FakeRedis
+from .watcher import Logged
+from .watcher import Watcher
+from time import time
+import gevent
+import math
+import os
+import subprocess
+import sys
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of `values`
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def startup_times(argv=('--help',), runs=10, python=sys.executable):
+    """
+    Seconds each of `runs` fresh `dundis argv` processes took to exit
+    """
+    cmd = [python, '-m', 'redundis.cli'] + list(argv)
+    out = []
+    with open(os.devnull, 'w') as devnull:
+        for x in range(runs):
+            start = time()
+            subprocess.call(cmd, stdout=devnull, stderr=devnull)
+            out.append(time() - start)
+    return out
+
+
+class FailoverBench(Logged):
+    """
+    Measures failover latency over `runs` fresh chains of `size`
+    instances, failing the master of each with `failure` (one of
+    'kill', 'hang' or 'partition').
+    """
+    failures = ('kill', 'hang', 'partition')
+    stages = ('detection', 'decision', 'apply', 'total')
+
+    def __init__(self, runs=20, size=3, failure='kill', timeout=10,
+                 **watcher_args):
+        assert failure in self.failures, "Unknown failure %s" % failure
+        self.runs = runs
+        self.size = size
+        self.failure = failure
+        self.timeout = timeout
+        self.watcher_args = watcher_args
+        self.results = []
+        self.missed = 0
+
+    def setup(self):
+        self.redi = [FakeRedis().start() for x in range(self.size)]
+        servers = [('redis-%s' % r.port, 0) for r in self.redi]
+        self.haproxy = FakeHAProxy(servers).start()
+        self.watcher = Watcher([r.spec for r in self.redi], self.haproxy.path,
+                               **self.watcher_args)
+        self.dispatches = []
+        dispatch = self.watcher.dispatch_for_roles
+
+        def timed_dispatch(roles):
+            self.dispatches.append(time())
+            return dispatch(roles)
+        self.watcher.dispatch_for_roles = timed_dispatch
+        self.loop = gevent.spawn(self.watcher.loop)
+
+    def teardown(self):
+        self.loop.kill()
+        self.watcher.monitors.kill()
+        self.watcher.haproxy.close()
+        for r in self.redi:
+            r.heal()
+            r.stop()
+        self.haproxy.stop()
+
+    def master_weighted(self, port):
+        server = 'redis-%s' % port
+        return lambda ha: ha.weight(server) == self.watcher.weight_for(0)
+
+    def run_once(self):
+        self.setup()
+        try:
+            if self.haproxy.wait_for(self.master_weighted(self.redi[0].port),
+                                     self.timeout) is None:
+                raise RuntimeError("chain never settled")
+            gevent.sleep(0.1)
+            master = self.redi[0]
+            started = time()
+            getattr(master, self.failure)()
+            survivor = lambda ha: any(ha.weight('redis-%s' % r.port) == self.watcher.weight_for(0) \
+                                      for r in self.redi if r is not master) \
+                                  and ha.weight('redis-%s' % master.port) == 0
+            applied = self.haproxy.wait_for(survivor, self.timeout)
+            if applied is None:
+                self.missed += 1
+                self.warn("run missed: no failover within %ss", self.timeout)
+                return None
+            detected = min(t for t in self.dispatches if t >= started)
+            decided = min(t for t, server, weight in self.haproxy.history if t >= started)
+            result = dict(detection=detected - started,
+                          decision=decided - detected,
+                          apply=applied - decided,
+                          total=applied - started)
+            self.results.append(result)
+            return result
+        finally:
+            self.teardown()
+
+    def run(self):
+        for x in range(self.runs):
+            self.run_once()
+        return self.report()
+
+    def report(self):
+        out = dict(runs=self.runs, missed=self.missed, failure=self.failure)
+        for stage in self.stages:
+            values = [r[stage] for r in self.results]
+            out[stage] = dict(p50=percentile(values, 50),
+                              p99=percentile(values, 99),
+                              max=values and max(values) or None)
+        return out
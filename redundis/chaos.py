@@ -0,0 +1,339 @@
+"""
+Client throughput through failovers
+
+`Chaos` drives GET/SET load through the HAProxy frontend of a chain
+from `workers` greenlets, each sending pipelines of `pipeline`
+commands.  Every `every` seconds it fails the chain's master and heals
+it `heal_after` seconds later, while a watcher in the same process
+reacts.  Load is counted in `interval` second buckets, so the report
+shows throughput, errors and latency around each fault and each of
+the watcher's reactions.
+
+The chain is either fake (`Chaos.fakes`) or the one brought up by
+`dundis cluster up` (`Chaos.local`).
+"""
+from .bench import percentile
+from .cluster import ClusterError
+from .cluster import LocalCluster
+from .cluster import started
+from .fakes import FakeHAProxy
+from .fakes import FakeProxy
+from .fakes import FakeRedis
+from .watcher import Logged
+from .watcher import Watcher
+from time import time
+import gevent
+import os
+import random
+import re
+import redis
+import signal
+
+
+class Member(object):
+    """
+    A redis process of a cluster started by `dundis cluster up`, with
+    the faults of a `FakeRedis`: `kill` is a SIGKILL undone by
+    `restart`, `hang` a SIGSTOP undone by `heal`, and `partition` a
+    `CLIENT PAUSE` of `pause` seconds, so clients get no answers but
+    slaves keep replicating.  Only redis 3.0 and later can pause (see
+    `can_partition`); `dundis install` builds 2.4.
+    """
+    # CLIENT PAUSE first shipped in the 3.0 betas
+    pause_since = (2, 9, 50)
+
+    def __init__(self, root, name, port, pause=2.0):
+        self.root = root
+        self.name = name
+        self.port = port
+        self.pause = pause
+
+    @property
+    def pid(self):
+        for proc in LocalCluster.state(self.root)['procs']:
+            if proc['name'] == self.name and started(proc):
+                return proc['pid']
+        raise ClusterError("%s is not running in %s" % (self.name, self.root))
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+    def restart(self):
+        return LocalCluster.respawn(self.root, self.name)
+
+    def hang(self):
+        os.kill(self.pid, signal.SIGSTOP)
+
+    def version(self):
+        client = redis.StrictRedis('127.0.0.1', self.port, socket_timeout=1)
+        return client.info()['redis_version']
+
+    def can_partition(self):
+        return tuple(int(x) for x in re.findall(r'\d+', self.version())[:3]) >= self.pause_since
+
+    def partition(self):
+        client = redis.StrictRedis('127.0.0.1', self.port, socket_timeout=1)
+        client.execute_command('CLIENT', 'PAUSE', int(self.pause * 1000))
+
+    def heal(self):
+        os.kill(self.pid, signal.SIGCONT)
+
+
+class Chaos(Logged):
+    """
+    Load on the frontend at `proxy` while the master of `members`, a
+    dict of port to instance, fails on a schedule under `watcher`
+    """
+    faults = ('kill', 'hang', 'partition')
+
+    def __init__(self, proxy, members, watcher, duration=30.0, every=5.0, heal_after=2.0,
+                 faults=('kill',), workers=16, pipeline=10, reads=0.8, keys=1000,
+                 interval=0.1, op_timeout=1.0, backoff=0.01, settle=10.0):
+        for fault in faults:
+            assert fault in self.faults, "Unknown fault %s" % fault
+        host, port = proxy.split(':')
+        self.host, self.port = host, int(port)
+        self.members = members
+        self.watcher = watcher
+        self.duration = duration
+        self.every = every
+        self.heal_after = heal_after
+        self.fault_cycle = list(faults)
+        self.workers = workers
+        self.pipeline = pipeline
+        self.reads = reads
+        self.keys = keys
+        self.interval = interval
+        self.op_timeout = op_timeout
+        self.backoff = backoff
+        self.settle = settle
+        self.t0 = None
+        self.buckets = {}
+        self.events = []
+        self.injured = []
+        self.injected = []
+        self.cleanup = []
+        self.stopped = False
+
+    @classmethod
+    def fakes(cls, size=3, watcher_args=None, **kw):
+        """
+        Chaos on a fresh chain of `size` fake instances behind a fake
+        HAProxy and frontend
+        """
+        redi = [FakeRedis().start() for x in range(size)]
+        ha = FakeHAProxy([('redis-%s' % r.port, 0) for r in redi]).start()
+        proxy = FakeProxy(ha, dict(('redis-%s' % r.port, r) for r in redi)).start()
+        watcher = Watcher([r.spec for r in redi], ha.path, proxy.spec, **(watcher_args or {}))
+        chaos = cls(proxy.spec, dict((r.port, r) for r in redi), watcher, **kw)
+        chaos.cleanup = [proxy.stop, ha.stop] + [r.stop for r in redi]
+        return chaos
+
+    @classmethod
+    def local(cls, root, chain=None, watcher_args=None, **kw):
+        """
+        Chaos on `chain` (by default the first) of the cluster `dundis
+        cluster up` started under `root`.  Raises a `ClusterError` up
+        front if a `partition` is asked of redis too old to pause.
+        """
+        state = LocalCluster.state(root)
+        if state is None:
+            raise ClusterError("no cluster is up in %s" % root)
+        chains = dict((spec['name'], spec) for spec in state['chains'])
+        if chain is not None and chain not in chains:
+            raise ClusterError("no chain %s in the cluster in %s" % (chain, root))
+        spec = chain is None and state['chains'][0] or chains[chain]
+        ports = [int(x.split(':')[1]) for x in spec['redi']]
+        members = dict((port, Member(root, 'redis-%d' % port, port, kw.get('heal_after', 2.0))) \
+                       for port in ports)
+        if 'partition' in kw.get('faults', ()):
+            for port, member in sorted(members.items()):
+                if not member.can_partition():
+                    raise ClusterError("partition needs CLIENT PAUSE, in redis 3.0 and later, "
+                                       "but redis-%d is %s; leave it out of --faults"
+                                       % (port, member.version()))
+        watcher = Watcher(spec['redi'], state['haproxy_sock'], spec['redis_proxy'], spec['backend'],
+                          ha_prefix=spec['ha_prefix'], **(watcher_args or {}))
+        return cls(spec['redis_proxy'], members, watcher, **kw)
+
+    def event(self, kind, detail=''):
+        self.events.append((time(), kind, detail))
+        self.info("chaos: %s %s", kind, detail)
+
+    def instrument(self):
+        """
+        Notes each dispatch of the watcher and each weight change it
+        makes as events
+        """
+        dispatch, assign = self.watcher.dispatch_for_roles, self.watcher.assign_weights
+
+        def dispatch_for_roles(roles):
+            self.event('dispatch', roles)
+            return dispatch(roles)
+
+        def assign_weights(*insts):
+            diff = assign(*insts)
+            if diff:
+                self.event('weights', ' '.join('%s=%s' % (server, new) for server, old, new in diff))
+            return diff
+
+        self.watcher.dispatch_for_roles = dispatch_for_roles
+        self.watcher.assign_weights = assign_weights
+
+    def record(self, at, ops=0, errors=0, latency=None):
+        bucket = self.buckets.setdefault(self.index(at - self.t0), [0, 0, []])
+        bucket[0] += ops
+        bucket[1] += errors
+        if latency is not None:
+            bucket[2].append(latency)
+
+    def client(self):
+        return redis.StrictRedis(self.host, self.port, socket_timeout=self.op_timeout)
+
+    def worker(self, n):
+        """
+        Sends pipelines of reads and writes until stopped.  A command
+        answered with an error counts as one error; a broken or timed
+        out connection as a whole pipeline of them.
+        """
+        client = self.client()
+        rnd = random.Random(n)
+        while not self.stopped:
+            pipe = client.pipeline(transaction=False)
+            for x in range(self.pipeline):
+                key = 'chaos:%d' % rnd.randrange(self.keys)
+                if rnd.random() < self.reads:
+                    pipe.get(key)
+                else:
+                    pipe.set(key, n)
+            start = time()
+            try:
+                replies = pipe.execute(raise_on_error=False)
+            except (redis.RedisError, IOError):
+                self.record(time(), errors=self.pipeline)
+                client.connection_pool.disconnect()
+                gevent.sleep(self.backoff)
+                continue
+            errors = len([x for x in replies if isinstance(x, Exception)])
+            self.record(time(), ops=len(replies) - errors, errors=errors, latency=time() - start)
+
+    def wait_settled(self):
+        """
+        Waits for the watcher's first dispatch and for a write through
+        the frontend to go through
+        """
+        end = time() + self.settle
+        client = self.client()
+        while time() < end:
+            if any(kind == 'dispatch' for at, kind, detail in self.events):
+                try:
+                    client.set('chaos:settled', 1)
+                    return
+                except (redis.RedisError, IOError):
+                    client.connection_pool.disconnect()
+            gevent.sleep(0.05)
+        raise RuntimeError("chain never settled")
+
+    def schedule(self):
+        """
+        Seconds into the run of each fault, with the fault
+        """
+        out, at = [], self.every
+        while at < self.duration:
+            out.append((at, self.fault_cycle[len(out) % len(self.fault_cycle)]))
+            at += self.every
+        return out
+
+    def master(self):
+        port = int(self.watcher.instances[0].port)
+        return self.members.get(port) or self.members[sorted(self.members)[0]]
+
+    def inject(self, fault):
+        member = self.master()
+        self.event(fault, member.port)
+        self.injected.append((time() - self.t0, fault, member.port))
+        getattr(member, fault)()
+        self.injured.append((member, fault))
+        gevent.spawn_later(self.heal_after, self.heal, member, fault)
+
+    def heal(self, member, fault):
+        if (member, fault) not in self.injured:
+            return
+        self.injured.remove((member, fault))
+        if fault == 'kill':
+            member.restart()
+        else:
+            member.heal()
+        self.event('heal', member.port)
+
+    def run(self):
+        self.instrument()
+        loop = gevent.spawn(self.watcher.loop)
+        try:
+            self.wait_settled()
+            self.t0 = time()
+            workers = [gevent.spawn(self.worker, n) for n in range(self.workers)]
+            for at, fault in self.schedule():
+                gevent.sleep(max(0, self.t0 + at - time()))
+                self.inject(fault)
+            gevent.sleep(max(0, self.t0 + self.duration - time()))
+            self.stopped = True
+            gevent.joinall(workers, timeout=self.op_timeout + 1)
+            gevent.killall(workers)
+        finally:
+            for member, fault in list(self.injured):
+                self.heal(member, fault)
+            loop.kill()
+            self.watcher.monitors.kill()
+            self.watcher.haproxy.close()
+            for stop in self.cleanup:
+                stop()
+        return self.report()
+
+    def index(self, at):
+        """
+        The bucket `at` seconds into the run falls in
+        """
+        return int(at / self.interval + 1e-9)
+
+    def bucket(self, i):
+        return self.buckets.get(i, (0, 0, []))
+
+    def outage(self, start, end):
+        """
+        Seconds from `start` to the end of the last bucket before `end`
+        in which a command failed or none succeeded
+        """
+        bad = [i for i in range(self.index(start), self.index(end)) \
+               if self.bucket(i)[1] or not self.bucket(i)[0]]
+        return bad and max(0.0, (max(bad) + 1) * self.interval - start) or 0.0
+
+    def after(self, kind, start):
+        found = [at for at, event, detail in self.events if event == kind and at >= start]
+        return found and min(found) - start or None
+
+    def report(self):
+        count = int(round(self.duration / self.interval))
+        latencies = [x for i in range(count) for x in self.bucket(i)[2]]
+        ops = sum(self.bucket(i)[0] for i in range(count))
+        timeline = []
+        for i in range(count):
+            done, errors, times = self.bucket(i)
+            timeline.append(dict(t=i * self.interval, ops_per_sec=done / self.interval,
+                                 errors=errors, p50=percentile(times, 50),
+                                 p99=percentile(times, 99)))
+        events = [dict(t=at - self.t0, event=kind, detail=str(detail)) \
+                  for at, kind, detail in self.events if at >= self.t0]
+        ends = [at for at, fault, port in self.injected][1:] + [self.duration]
+        faults = []
+        for (at, fault, port), end in zip(self.injected, ends):
+            start = self.t0 + at
+            faults.append(dict(t=at, fault=fault, target=port, outage=self.outage(at, end),
+                               errors=sum(self.bucket(i)[1] for i in \
+                                          range(self.index(at), self.index(end))),
+                               dispatch=self.after('dispatch', start),
+                               weights=self.after('weights', start)))
+        return dict(duration=self.duration, ops=ops, ops_per_sec=ops / self.duration,
+                    errors=sum(self.bucket(i)[1] for i in range(count)),
+                    p50=percentile(latencies, 50), p99=percentile(latencies, 99),
+                    timeline=timeline, events=events, faults=faults)
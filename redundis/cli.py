@@ -3,12 +3,30 @@ A command line interface
 """
 from cliff.app import App
 from cliff.commandmanager import CommandManager
+import argparse
 import logging
 import sys
-import pkg_resources
 
 
-dist = pkg_resources.get_distribution('Redundis')
+def version():
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution('Redundis').version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
+
+class Version(argparse.Action):
+    """
+    `--version`, looking the version up only when asked for it
+    """
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super(Version, self).__init__(option_strings, dest=dest, default=default,
+                                      nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message='%s %s\n' % (parser.prog, version()))
 
 
 class Dundis(App):
@@ -18,10 +36,16 @@ class Dundis(App):
     def __init__(self):
         super(Dundis, self).__init__(
             description='Redundis command line interface',
-            version=dist.version,
+            version=None,
             command_manager=CommandManager('redundis.cli'),
             )
 
+    def build_option_parser(self, description, version, argparse_kwargs=None):
+        argparse_kwargs = dict(argparse_kwargs or {}, conflict_handler='resolve')
+        parser = super(Dundis, self).build_option_parser(description, version, argparse_kwargs)
+        parser.add_argument('--version', action=Version)
+        return parser
+
     def prepare_to_run_command(self, cmd):
         self.log.debug('prepare_to_run_command %s', cmd.__class__.__name__)
 
@@ -0,0 +1,374 @@
+"""
+A throwaway cluster of redis chains behind one HAProxy, on this box
+
+`LocalCluster` writes a redis config for every instance and an HAProxy
+config with one backend per chain, starts every process at once and
+polls until each instance answers `PING` and the stats socket
+answers.  What it started is kept in `state.json` under its root, so
+another process can bring it down.  The first chain matches the
+watcher's defaults: `redis-<port>` servers on 6379-6381 in the `redis`
+backend, proxied on 6666, with the stats socket at
+`/tmp/redundis-haproxy.sock`.
+"""
+from . import config
+from . import haproxy
+from . import resp
+from .roles import ChainRoles
+from .roles import defaults
+from collections import OrderedDict
+from distutils.spawn import find_executable
+from path import path
+from time import sleep
+from time import time
+import errno
+import json
+import os
+import signal
+import subprocess
+import yaml
+
+
+class ClusterError(RuntimeError):
+    """
+    The cluster could not be brought up
+    """
+
+
+def binary(name, venv=None):
+    """
+    The path to `name` in the virtualenv's bin (where `dundis install`
+    puts it) or else on the PATH
+    """
+    venv = venv is not None and venv or os.environ.get('VIRTUAL_ENV')
+    if venv and (path(venv) / 'bin' / name).exists():
+        return str(path(venv) / 'bin' / name)
+    found = find_executable(name)
+    if found is None:
+        raise ClusterError("%s not found in $VIRTUAL_ENV/bin or on the PATH "
+                           "(try `dundis install`)" % name)
+    return found
+
+
+def alive(pid):
+    """
+    Whether `pid` is still running, reaping it if it is our exited child
+    """
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except OSError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def started(proc):
+    """
+    Whether the process recorded as `proc` in the state is still the
+    one that was started: alive, leading the process group recorded
+    and, where there is a /proc, running the recorded command.  After
+    a reboot, or long after a crash, its pid can be someone else's.
+    """
+    pid = proc['pid']
+    if not alive(pid):
+        return False
+    try:
+        if os.getpgid(pid) != proc.get('pgid'):
+            return False
+    except OSError:
+        return False
+    if not path('/proc').isdir():
+        return True
+    try:
+        with open('/proc/%d/cmdline' % pid) as stream:
+            argv = stream.read().split('\0')
+    except IOError:
+        return False
+    # redis 3 and later retitle themselves '<argv[0]> <addr>:<port>'
+    return argv[:len(proc['argv'])] == proc['argv'] or \
+           argv[0].startswith(proc['argv'][0] + ' ')
+
+
+def tail(filename, lines=5):
+    filename = path(filename)
+    if not filename.exists():
+        return ''
+    return '\n'.join(filename.text().splitlines()[-lines:])
+
+
+def spawn(argv, log):
+    """
+    Starts `argv` in its own session, so it outlives the command that
+    started it, with its output appended to `log`
+    """
+    with open(log, 'ab') as out:
+        return subprocess.Popen(argv, stdout=out, stderr=subprocess.STDOUT,
+                                close_fds=True, preexec_fn=os.setsid)
+
+
+def ping(port, timeout):
+    sock = resp.connect('127.0.0.1', port, timeout=timeout, keepalive=False)
+    try:
+        sock.sendall(resp.encode('PING'))
+        fp = sock.makefile('rb')
+        reply = resp.read_reply(fp)
+        fp.close()
+    finally:
+        sock.close()
+    return reply == 'PONG'
+
+
+def stats_ready(sock, timeout):
+    session = haproxy.StatsSession(sock, retry=0, timeout=timeout * 1000)
+    try:
+        session.execute('show info')
+    finally:
+        session.close()
+    return True
+
+
+class LocalCluster(object):
+    """
+    `chains` chains of `size` redis instances on consecutive ports
+    from `base_port`, each behind its own HAProxy backend listening on
+    consecutive ports from `proxy_port`.  Everything the cluster
+    writes goes under `root`.
+    """
+    weights = ChainRoles.weights
+    state_file = 'state.json'
+
+    def __init__(self, root, chains=1, size=3, base_port=6379, proxy_port=6666,
+                 haproxy_sock=defaults['haproxy_sock'], template=None, check_inter=500,
+                 redis_server='redis-server', haproxy_bin='haproxy'):
+        self.root = path(root).abspath()
+        self.chains = chains
+        self.size = size
+        self.base_port = base_port
+        self.proxy_port = proxy_port
+        self.haproxy_sock = haproxy_sock
+        self.template = template
+        self.check_inter = check_inter
+        self.redis_server = redis_server
+        self.haproxy_bin = haproxy_bin
+
+    def layout(self):
+        """
+        Watcher settings for each chain, as a list of dicts
+        """
+        out = []
+        for i in range(self.chains):
+            name = i and 'redis%d' % i or defaults['ha_backend']
+            ports = [self.base_port + i * self.size + j for j in range(self.size)]
+            out.append(dict(name=name, backend=name, ha_prefix=name + '-%s',
+                            redi=['localhost:%d' % port for port in ports],
+                            redis_proxy='localhost:%d' % (self.proxy_port + i)))
+        return out
+
+    def port(self, spec):
+        return int(spec.split(':')[1])
+
+    def weight_for(self, position):
+        return self.weights[min(position, len(self.weights) - 1)]
+
+    def redis_conf(self, port, upstream=None):
+        """
+        The settings of the instance on `port` as an OrderedDict,
+        replicating from the instance on `upstream`
+        """
+        out = self.template and config.redis_conf_to_dict(self.template) or OrderedDict()
+        for key in [x for x in out if x.startswith('vm-')]:
+            del out[key]
+        out.update([('daemonize', 'no'),
+                    ('bind', '127.0.0.1'),
+                    ('port', str(port)),
+                    ('pidfile', str(self.root / ('redis-%d.pid' % port))),
+                    ('dir', str(self.root)),
+                    ('dbfilename', 'dump-%d.rdb' % port)])
+        for key in ('logfile', 'slaveof'):
+            out.pop(key, None)
+        if upstream is not None:
+            out['slaveof'] = '127.0.0.1 %d' % upstream
+        return out
+
+    def haproxy_conf(self):
+        lines = ['global',
+                 '    stats socket %s level admin' % self.haproxy_sock,
+                 '    maxconn 4096',
+                 '',
+                 'defaults',
+                 '    mode tcp',
+                 '    timeout connect 5000ms',
+                 '    timeout client 50000ms',
+                 '    timeout server 50000ms']
+        for chain in self.layout():
+            lines += ['',
+                      'listen %s' % chain['backend'],
+                      '    bind 127.0.0.1:%d' % self.port(chain['redis_proxy'])]
+            for position, spec in enumerate(chain['redi']):
+                port = self.port(spec)
+                lines.append('    server %s 127.0.0.1:%d check inter %d weight %d' % (
+                    chain['ha_prefix'] % port, port, self.check_inter, self.weight_for(position)))
+        return '\n'.join(lines) + '\n'
+
+    def watcher_conf(self):
+        """
+        A `dundis watch --config` for the cluster
+        """
+        clusters = {}
+        for chain in self.layout():
+            spec = dict(chain)
+            clusters[spec.pop('name')] = spec
+        return yaml.safe_dump(dict(haproxy_sock=self.haproxy_sock, clusters=clusters),
+                              default_flow_style=False)
+
+    def write(self):
+        """
+        Writes every config under `root`, returning the processes to
+        start as `(name, argv, log)`.  Each redis logs to its stdout.
+        """
+        if not self.root.exists():
+            self.root.makedirs()
+        procs = []
+        for chain in self.layout():
+            upstream = None
+            for spec in chain['redi']:
+                port = self.port(spec)
+                conf = self.root / ('redis-%d.conf' % port)
+                config.od_to_redis_conf(self.redis_conf(port, upstream), conf)
+                procs.append(('redis-%d' % port, [self.redis_server, str(conf)],
+                              self.root / ('redis-%d.log' % port)))
+                upstream = port
+        conf = self.root / 'haproxy.cfg'
+        conf.write_text(self.haproxy_conf())
+        (self.root / 'clusters.yml').write_text(self.watcher_conf())
+        procs.append(('haproxy', [self.haproxy_bin, '-f', str(conf)], self.root / 'haproxy.log'))
+        return procs
+
+    def checks(self, timeout):
+        """
+        A readiness check for each process by name
+        """
+        out = dict(haproxy=lambda: stats_ready(self.haproxy_sock, timeout))
+        for chain in self.layout():
+            for spec in chain['redi']:
+                port = self.port(spec)
+                out['redis-%d' % port] = lambda port=port: ping(port, timeout)
+        return out
+
+    def up(self, timeout=10.0, poll=0.01):
+        """
+        Starts every process and returns once all are ready.  Stops
+        them again and raises a `ClusterError` if one exits or any is
+        not ready within `timeout` seconds.
+        """
+        state = self.state(self.root)
+        if state and any(started(proc) for proc in state['procs']):
+            raise ClusterError("a cluster is already up in %s" % self.root)
+        procs = [(name, spawn(argv, log), argv, log) for name, argv, log in self.write()]
+        self.save(procs)
+        try:
+            self.wait(procs, timeout, poll)
+        except:
+            self.down(self.root)
+            raise
+        return self.layout()
+
+    def wait(self, procs, timeout, poll):
+        checks = self.checks(max(poll, 0.05))
+        pending = dict((name, (proc, log)) for name, proc, argv, log in procs)
+        end = time() + timeout
+        while pending:
+            for name, (proc, log) in pending.items():
+                if proc.poll() is not None:
+                    raise ClusterError("%s exited with %s:\n%s" % (name, proc.returncode, tail(log)))
+                try:
+                    ready = checks[name]()
+                except Exception:
+                    ready = False
+                if ready:
+                    del pending[name]
+            if not pending:
+                return
+            if time() > end:
+                raise ClusterError("not ready after %ss: %s" % (timeout, ', '.join(sorted(pending))))
+            sleep(poll)
+
+    def save(self, procs):
+        """
+        Records `procs`, as `(name, popen, argv, log)`, as what was
+        started.  `spawn` makes each the leader of its own process
+        group.
+        """
+        self.write_state(self.root, dict(
+            root=str(self.root), haproxy_sock=self.haproxy_sock, chains=self.layout(),
+            procs=[dict(name=name, pid=proc.pid, pgid=proc.pid, argv=argv, log=str(log)) \
+                   for name, proc, argv, log in procs]))
+
+    @classmethod
+    def write_state(cls, root, state):
+        tmp = path(root).abspath() / (cls.state_file + '.tmp')
+        tmp.write_text(json.dumps(state, indent=2))
+        tmp.rename(path(root).abspath() / cls.state_file)
+
+    @classmethod
+    def state(cls, root):
+        """
+        What was started under `root`, or None
+        """
+        state_file = path(root).abspath() / cls.state_file
+        if not state_file.exists():
+            return None
+        return json.loads(state_file.text())
+
+    @classmethod
+    def respawn(cls, root, name):
+        """
+        Starts the process `name` of the cluster under `root` again,
+        as after it was killed, returning its `Popen`
+        """
+        state = cls.state(root)
+        if state is None:
+            raise ClusterError("no cluster is up in %s" % root)
+        for proc in state['procs']:
+            if proc['name'] == name:
+                popen = spawn(proc['argv'], proc['log'])
+                proc['pid'] = proc['pgid'] = popen.pid
+                cls.write_state(root, state)
+                return popen
+        raise ClusterError("no %s in the cluster in %s" % (name, root))
+
+    @classmethod
+    def down(cls, root, timeout=5.0, poll=0.01):
+        """
+        Stops everything started under `root` with SIGTERM, then
+        SIGKILL for whatever is still running after `timeout` seconds.
+        Only the process groups of processes that are still the ones
+        `started` are signalled.  Returns the names of the processes
+        stopped.
+        """
+        state = cls.state(root)
+        if state is None:
+            return []
+        procs = [proc for proc in state['procs'] if started(proc)]
+        stopped = [proc['name'] for proc in procs]
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            procs = [proc for proc in procs if alive(proc['pid'])]
+            for proc in procs:
+                try:
+                    os.killpg(proc['pgid'], sig)
+                except OSError:
+                    pass
+            end = time() + timeout
+            while time() < end and any(alive(proc['pid']) for proc in procs):
+                sleep(poll)
+        procs = [proc for proc in procs if alive(proc['pid'])]
+        if procs:
+            raise ClusterError("could not stop %s" % ', '.join(proc['name'] for proc in procs))
+        (path(root).abspath() / cls.state_file).remove()
+        sock = path(state['haproxy_sock'])
+        if sock.exists():
+            sock.remove()
+        return stopped
@@ -0,0 +1,392 @@
+"""
+The dundis commands
+
+Each command only imports what it runs once it runs, so that loading
+the CLI stays cheap and nothing is monkey patched until a command
+that needs gevent starts.
+"""
+from . import green
+from .detect import detectors
+from .roles import ChainRoles
+from .roles import defaults
+from cliff.command import Command
+from time import time
+import json
+
+
+class Watch(Command):
+    """
+    dundis command for running the watcher
+    """
+    def get_parser(self, name):
+        parser = super(Watch, self).get_parser(name)
+        parser.add_argument('-c', '--config', action='store',
+                            default=None, help='YAML config file of one or many clusters')
+
+        parser.add_argument('-r', '--redi', action='store',
+                            default=",".join(defaults['redi']),
+                            help='Redis instances (comma delimited)')
+
+        parser.add_argument('-p', '--proxy', action='store',
+                            default=defaults['redis_proxy'], help='Address of redis via haproxy')
+
+        parser.add_argument('--haproxy_sock', action='store',
+                            default=defaults['haproxy_sock'], help='HAProxy stats socket')
+        
+        parser.add_argument('--haproxy_backend', action='store',
+                            default=defaults['ha_backend'], help='HAProxy stats socket')
+        
+        parser.add_argument('--detector', action='store', default=None,
+                            choices=sorted(detectors),
+                            help='Heartbeat failure detector (default: blpop/ping monitors)')
+
+        parser.add_argument('--heartbeat_interval', action='store', type=float,
+                            default=0.5, help='Seconds between heartbeats')
+
+        parser.add_argument('--heartbeat_timeout', action='store', type=float,
+                            default=0.25, help='Seconds to wait for a heartbeat answer')
+
+        parser.add_argument('--heartbeat_misses', action='store', type=int,
+                            default=3, help='Missed heartbeats before an instance is down')
+
+        parser.add_argument('--phi_threshold', action='store', type=float,
+                            default=8.0, help='Suspicion level at which the phi detector fails an instance')
+
+        parser.add_argument('--promote_wait', action='store', type=float, default=0,
+                            help='Seconds to let lagging slaves catch up before promoting a new master')
+
+        parser.add_argument('--probe_timeout', action='store', type=float, default=None,
+                            help='Seconds before a command to an instance counts as failed')
+
+        parser.add_argument('--sync_timeout', action='store', type=float, default=5.0,
+                            help='Seconds to wait for SLAVEOF, then for slaves to replicate, '
+                                 'before weighting them (0 to not wait)')
+
+        parser.add_argument('--metrics_port', action='store', type=int, default=None,
+                            help='Serve Prometheus metrics over HTTP on this port')
+
+        parser.add_argument('--statsd', action='store', default=None,
+                            help='Push metrics to StatsD at host:port')
+
+        parser.add_argument('--stable_for', action='store', type=float, default=5.0,
+                            help='Seconds a returning instance must stay up before it is rechained')
+
+        parser.add_argument('--flap_half_life', action='store', type=float, default=60.0,
+                            help='Seconds for the flap penalty of an instance to halve')
+
+        parser.add_argument('--flap_suppress', action='store', type=float, default=2.5,
+                            help='Flap penalty at which an instance is held out of the chain')
+
+        parser.add_argument('--max_failovers', action='store', type=int, default=3,
+                            help='Most failovers allowed per minute')
+
+        parser.add_argument('--quorum_timeout', action='store', type=float, default=10.0,
+                            help='Seconds to hold off failing over an instance HAProxy '
+                                 'still passes checks on (0 to trust the watcher alone)')
+
+        parser.add_argument('--haproxy_poll', action='store', type=float, default=1.0,
+                            help='Seconds between polls of HAProxy health checks (0 to not poll)')
+
+        parser.add_argument('--haproxy_timeout', action='store', type=int, default=1000,
+                            help='Milliseconds before a call to the HAProxy stats socket gives up')
+
+        parser.add_argument('--publish_channel', action='store', default=None,
+                            help='Publish topology changes on this redis pub/sub channel '
+                                 '(e.g. redundis.topology)')
+
+        parser.add_argument('--publish_key', action='store', default=None,
+                            help='Also SET the latest topology on the master under this key '
+                                 '(with :<cluster> appended), for subscribers catching up')
+
+        parser.add_argument('--publish_sock', action='store', default=None,
+                            help='Serve topology changes on this UNIX socket')
+
+        parser.add_argument('--topology', action='store', default='chain',
+                            choices=ChainRoles.topologies,
+                            help='Daisy chain slaves behind each other or attach all to the master')
+
+        #@@ server prefix
+        return parser
+
+    def detector_args(self, args):
+        out = dict(interval=args.heartbeat_interval,
+                   timeout=args.heartbeat_timeout,
+                   misses=args.heartbeat_misses)
+        if args.detector == 'phi':
+            out['threshold'] = args.phi_threshold
+        return out
+
+    def damping_args(self, args):
+        return dict(stable_for=args.stable_for,
+                    half_life=args.flap_half_life,
+                    suppress=args.flap_suppress,
+                    max_failovers=args.max_failovers)
+
+    def start_metrics(self, args):
+        from . import metrics
+        if args.metrics_port:
+            metrics.MetricsServer(args.metrics_port).start()
+        if args.statsd:
+            host, port = args.statsd.split(':')
+            metrics.StatsdEmitter(host, int(port)).start()
+
+    def run(self, args):
+        green.patch()
+        from . import topology
+        from .watcher import Supervisor
+        from .watcher import Watcher
+        self.start_metrics(args)
+        if args.config:
+            with open(args.config) as stream:
+                supervisor = Supervisor.from_config(stream)
+            try:
+                supervisor.start().join()
+            except KeyboardInterrupt:
+                return
+            return
+        redi = args.redi.split(',')
+        watcher = Watcher(redi, args.haproxy_sock, args.proxy, args.haproxy_backend,
+                          detector=args.detector, detector_args=self.detector_args(args),
+                          promote_wait=args.promote_wait, topology=args.topology,
+                          probe_timeout=args.probe_timeout,
+                          damping_args=self.damping_args(args),
+                          quorum_timeout=args.quorum_timeout,
+                          haproxy_poll=args.haproxy_poll,
+                          haproxy_timeout=args.haproxy_timeout,
+                          sync_timeout=args.sync_timeout,
+                          publishers=topology.publishers(args.publish_channel, args.publish_sock,
+                                                         args.publish_key))
+        try:
+            watcher.start().join()
+        except KeyboardInterrupt:
+            return 
+
+
+class Bench(Command):
+    """
+    dundis command for benchmarking failover latency against fakes
+    """
+    def get_parser(self, name):
+        parser = super(Bench, self).get_parser(name)
+        parser.add_argument('-n', '--runs', action='store', type=int, default=20,
+                            help='Number of failovers to time')
+        parser.add_argument('-s', '--size', action='store', type=int, default=3,
+                            help='Instances in each chain')
+        parser.add_argument('-f', '--failure', action='store', default='kill',
+                            choices=('kill', 'hang', 'partition'), help='How the master fails')
+        parser.add_argument('--timeout', action='store', type=float, default=10,
+                            help='Seconds to wait for each failover')
+        parser.add_argument('--detector', action='store', default=None,
+                            help='Heartbeat failure detector for the watcher')
+        parser.add_argument('--probe_timeout', action='store', type=float, default=1,
+                            help='Seconds before a probe of a wedged instance gives up')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the report as JSON')
+        parser.add_argument('--startup', action='store', default=None, metavar='ARGS',
+                            help='Time `--runs` startups of `dundis ARGS` instead')
+        return parser
+
+    def run_startup(self, args):
+        from .bench import percentile
+        from .bench import startup_times
+        times = startup_times(args.startup.split(), args.runs)
+        report = dict(runs=args.runs, argv=args.startup,
+                      p50=percentile(times, 50), p99=percentile(times, 99), max=max(times))
+        if args.json:
+            self.app.stdout.write(json.dumps(report, indent=2) + '\n')
+            return
+        self.app.stdout.write("dundis %(argv)s: p50 %(p50).3fs p99 %(p99).3fs max %(max).3fs\n" % report)
+
+    def run(self, args):
+        if args.startup is not None:
+            return self.run_startup(args)
+        green.patch()
+        from .bench import FailoverBench
+        bench = FailoverBench(args.runs, args.size, args.failure, args.timeout,
+                              detector=args.detector, probe_timeout=args.probe_timeout)
+        report = bench.run()
+        if args.json:
+            self.app.stdout.write(json.dumps(report, indent=2) + '\n')
+            return
+        self.app.stdout.write("%(runs)d runs, %(missed)d missed, failure: %(failure)s\n" % report)
+        self.app.stdout.write("%-10s %10s %10s %10s\n" % ('stage', 'p50 ms', 'p99 ms', 'max ms'))
+        for stage in FailoverBench.stages:
+            row = [report[stage][x] for x in ('p50', 'p99', 'max')]
+            self.app.stdout.write("%-10s %10s %10s %10s\n" % tuple(
+                [stage] + [x is None and '-' or '%.1f' % (x * 1000) for x in row]))
+
+
+class Status(Command):
+    """
+    dundis command for a one-shot report on chain health
+    """
+    def get_parser(self, name):
+        parser = super(Status, self).get_parser(name)
+        parser.add_argument('-c', '--config', action='store',
+                            default=None, help='YAML config file of one or many clusters')
+        parser.add_argument('-r', '--redi', action='store',
+                            default=",".join(defaults['redi']),
+                            help='Redis instances (comma delimited)')
+        parser.add_argument('--haproxy_sock', action='store',
+                            default=defaults['haproxy_sock'], help='HAProxy stats socket')
+        parser.add_argument('--haproxy_backend', action='store',
+                            default=defaults['ha_backend'], help='HAProxy backend')
+        parser.add_argument('-t', '--timeout', action='store', type=float, default=0.5,
+                            help='Seconds to wait for all answers')
+        parser.add_argument('--workers', action='store', type=int, default=64,
+                            help='Most instances probed at once')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the report as JSON')
+        return parser
+
+    def clusters(self, args):
+        if not args.config:
+            return dict(default=dict(redi=args.redi, haproxy_sock=args.haproxy_sock,
+                                     ha_backend=args.haproxy_backend))
+        from .config import load_clusters
+        with open(args.config) as stream:
+            settings, clusters = load_clusters(stream)
+        if not clusters:
+            return dict(default=settings)
+        return dict((name, dict(settings, **spec)) for name, spec in clusters.items())
+
+    def run(self, args):
+        """
+        Exits 1 if any instance or weight could not be read
+        """
+        from . import status
+        report, elapsed = status.status(self.clusters(args), args.timeout, args.workers)
+        if args.json:
+            self.app.stdout.write(json.dumps(dict(clusters=report, elapsed=elapsed),
+                                             indent=2, sort_keys=True) + '\n')
+        else:
+            for line in status.table(report):
+                self.app.stdout.write(line + '\n')
+        return not status.healthy(report) and 1 or 0
+
+
+class Cluster(Command):
+    """
+    dundis command for bringing a local cluster of chains up or down
+    """
+    def get_parser(self, name):
+        parser = super(Cluster, self).get_parser(name)
+        parser.add_argument('action', choices=('up', 'down'),
+                            help='Start the cluster or stop the one running')
+        parser.add_argument('-d', '--root', action='store', default='/tmp/redundis-cluster',
+                            help='Directory for configs, data, logs and state')
+        parser.add_argument('-n', '--chains', action='store', type=int, default=1,
+                            help='Chains to start, each behind its own HAProxy backend')
+        parser.add_argument('-s', '--size', action='store', type=int, default=3,
+                            help='Instances in each chain')
+        parser.add_argument('--base_port', action='store', type=int, default=6379,
+                            help='Port of the first instance; the rest follow on')
+        parser.add_argument('--proxy_port', action='store', type=int, default=6666,
+                            help='HAProxy port of the first chain; the rest follow on')
+        parser.add_argument('--haproxy_sock', action='store',
+                            default=defaults['haproxy_sock'], help='HAProxy stats socket')
+        parser.add_argument('--template', action='store', default=None,
+                            help='Redis config to base each instance on')
+        parser.add_argument('-t', '--timeout', action='store', type=float, default=10.0,
+                            help='Seconds to wait for the cluster to be ready or stop')
+        return parser
+
+    def run(self, args):
+        from .cluster import LocalCluster
+        from .cluster import binary
+        if args.action == 'down':
+            for name in LocalCluster.down(args.root, args.timeout):
+                self.app.stdout.write("stopped %s\n" % name)
+            return
+        cluster = LocalCluster(args.root, args.chains, args.size, args.base_port,
+                               args.proxy_port, args.haproxy_sock, args.template,
+                               redis_server=binary('redis-server'), haproxy_bin=binary('haproxy'))
+        start = time()
+        for chain in cluster.up(args.timeout):
+            self.app.stdout.write("%s: %s via %s\n" % (chain['name'], ','.join(chain['redi']),
+                                                     chain['redis_proxy']))
+        self.app.stdout.write("ready in %.2fs; watch with `dundis watch --config=%s`\n" % (
+            time() - start, cluster.root / 'clusters.yml'))
+
+
+class Chaos(Command):
+    """
+    dundis command for measuring client load through failovers
+    """
+    def get_parser(self, name):
+        parser = super(Chaos, self).get_parser(name)
+        parser.add_argument('--cluster', action='store', default=None, metavar='ROOT',
+                            help='Fail the cluster `dundis cluster up` started under ROOT '
+                                 '(default: a chain of fakes)')
+        parser.add_argument('--chain', action='store', default=None,
+                            help='Chain of the cluster to fail (default: the first)')
+        parser.add_argument('-s', '--size', action='store', type=int, default=3,
+                            help='Instances in the fake chain')
+        parser.add_argument('-d', '--duration', action='store', type=float, default=30.0,
+                            help='Seconds of load')
+        parser.add_argument('-f', '--faults', action='store', default='kill',
+                            help='Faults to inject in turn: kill, hang and/or partition '
+                                 '(comma delimited)')
+        parser.add_argument('--every', action='store', type=float, default=5.0,
+                            help='Seconds between faults')
+        parser.add_argument('--heal_after', action='store', type=float, default=2.0,
+                            help='Seconds before a failed instance is healed or restarted')
+        parser.add_argument('-w', '--workers', action='store', type=int, default=16,
+                            help='Client greenlets')
+        parser.add_argument('--pipeline', action='store', type=int, default=10,
+                            help='Commands per pipeline')
+        parser.add_argument('--reads', action='store', type=float, default=0.8,
+                            help='Share of commands that are reads')
+        parser.add_argument('--interval', action='store', type=float, default=0.1,
+                            help='Seconds per bucket of the timeline')
+        parser.add_argument('--op_timeout', action='store', type=float, default=1.0,
+                            help='Seconds before a pipeline counts as failed')
+        parser.add_argument('--detector', action='store', default=None,
+                            help='Heartbeat failure detector for the watcher')
+        parser.add_argument('--probe_timeout', action='store', type=float, default=1,
+                            help='Seconds before a probe of a wedged instance gives up')
+        parser.add_argument('--timeline', action='store_true', default=False,
+                            help='Also print throughput, errors and latency per bucket')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the report as JSON')
+        return parser
+
+    def write(self, line=''):
+        self.app.stdout.write(line + '\n')
+
+    def run(self, args):
+        green.patch()
+        from .chaos import Chaos
+        ms = lambda x: x is None and '-' or '%.1f' % (x * 1000)
+        watcher_args = dict(detector=args.detector, probe_timeout=args.probe_timeout)
+        kw = dict(duration=args.duration, every=args.every, heal_after=args.heal_after,
+                  faults=args.faults.split(','), workers=args.workers, pipeline=args.pipeline,
+                  reads=args.reads, interval=args.interval, op_timeout=args.op_timeout)
+        if args.cluster:
+            chaos = Chaos.local(args.cluster, args.chain, watcher_args, **kw)
+        else:
+            chaos = Chaos.fakes(args.size, watcher_args, **kw)
+        chaos.logging_setup()
+        report = chaos.run()
+        if args.json:
+            return self.write(json.dumps(report, indent=2, sort_keys=True))
+        self.write("%(duration).1fs, %(ops)d ops (%(ops_per_sec).0f/s), %(errors)d errors" % report +
+                   ", p50 %sms p99 %sms" % (ms(report['p50']), ms(report['p99'])))
+        self.write("%-10s %8s %8s %10s %8s %12s %12s" % ('fault', 'at s', 'target', 'outage ms',
+                                                         'errors', 'dispatch ms', 'weights ms'))
+        for fault in report['faults']:
+            self.write("%-10s %8.1f %8s %10s %8d %12s %12s" % (
+                fault['fault'], fault['t'], fault['target'], ms(fault['outage']), fault['errors'],
+                ms(fault['dispatch']), ms(fault['weights'])))
+        if not args.timeline:
+            return
+        events = {}
+        for event in report['events']:
+            events.setdefault(int(event['t'] / args.interval), []).append(
+                '%(event)s %(detail)s' % event)
+        self.write()
+        self.write("%8s %10s %8s %8s %8s  %s" % ('t s', 'ops/s', 'errors', 'p50 ms', 'p99 ms', 'events'))
+        for i, row in enumerate(report['timeline']):
+            self.write(("%8.2f %10.0f %8d %8s %8s  %s" % (
+                row['t'], row['ops_per_sec'], row['errors'], ms(row['p50']), ms(row['p99']),
+                '; '.join(events.get(i, [])))).rstrip())
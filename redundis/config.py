@@ -16,6 +16,19 @@ def yml_load(stream, loader=Loader):
     return yaml.load_all(stream, loader)
 
 
+def load_clusters(stream):
+    """
+    Reads a watcher config from a YAML stream, returning the top level
+    settings and the mapping of cluster name to settings found under
+    `clusters`
+    """
+    settings, clusters = {}, {}
+    for doc in yml_load(stream):
+        clusters.update(doc.pop('clusters', None) or {})
+        settings.update(doc)
+    return settings, clusters
+
+
 #resolve = DottedNameResolver(None).maybe_resolve
     
 
@@ -1,8 +1,15 @@
+from . import resp
+from contextlib import contextmanager
 from redis.connection import Connection as BaseCxn
 from redis.connection import ConnectionPool as BaseCxnPool
 from redis.connection import DefaultParser
 from redis.exceptions import ConnectionError
 from itertools import count
+import json
+import redis
+from time import time
+import socket
+import threading
 import traceback
 import logging
 
@@ -30,6 +37,8 @@ class Connection(BaseCxn):
         failure_callback = args.pop('failure_callback')
         BaseCxn.__init__(self, **args)
         self.attempts = 0
+        self.depth = 0
+        self.generation = 0
         self._depth = count()
         self.failure_callback = failure_callback is not None and \
                                 failure_callback or self.default_callback
@@ -63,9 +72,9 @@ class Connection(BaseCxn):
         args = self.original_args.copy()
         args.update(**kwargs)
         
+        self.disconnect()
         [setattr(self, key, args[key]) for key in self.update_keys]
 
-        self._sock = None
         self.attempts = 0
 
     @property
@@ -73,17 +82,116 @@ class Connection(BaseCxn):
         return next(self._depth)
 
 
+class Health(object):
+    """
+    What the prober last saw of one failover candidate
+    """
+    alpha = 0.3
+
+    def __init__(self):
+        self.failures = 0
+        self.role = None
+        self.latency = None
+        self.lag = None
+        self.checked = None
+
+    @property
+    def up(self):
+        return not self.failures
+
+    @property
+    def score(self):
+        """
+        Sorts healthy candidates first, masters before slaves and then
+        by smoothed probe latency.  Lower is better.
+        """
+        return (self.failures, self.role not in (None, 'master'), self.latency or 0)
+
+    def observe(self, ok, latency=None, role=None, lag=None):
+        self.checked = time()
+        if not ok:
+            self.failures += 1
+            return self
+        self.failures = 0
+        self.role = role
+        self.lag = lag
+        if latency is not None:
+            self.latency = self.latency is None and latency or \
+                           self.alpha * latency + (1 - self.alpha) * self.latency
+        return self
+
+
+class HealthProber(threading.Thread):
+    """
+    Probes each of a pool's candidates every `interval` seconds with
+    `INFO replication` and has the pool rerank them
+    """
+    def __init__(self, pool, interval=1.0, timeout=0.25):
+        threading.Thread.__init__(self, name='redundis-prober')
+        self.daemon = True
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self.stopped = threading.Event()
+
+    def probe(self, spec):
+        start = time()
+        try:
+            sock = resp.connect(spec['host'], int(spec['port']), self.timeout)
+        except socket.error:
+            return False, None, None, None
+        fp = sock.makefile('rb')
+        try:
+            sock.sendall(resp.encode('INFO', 'replication'))
+            info = resp.parse_info(resp.read_reply(fp))
+            return True, time() - start, info.get('role'), self.lag(info)
+        except (IOError, socket.error, resp.ReplyError):
+            return False, None, None, None
+        finally:
+            fp.close()
+            sock.close()
+
+    @staticmethod
+    def lag(info):
+        """
+        Seconds a slave has gone without hearing from its master, None
+        if its link is down, 0 for a master
+        """
+        if info.get('role') != 'slave':
+            return 0
+        if info.get('master_link_status') != 'up':
+            return None
+        return int(info.get('master_last_io_seconds_ago', 0))
+
+    def probe_all(self):
+        for spec, health in zip(self.pool.candidates, self.pool.health_of(self.pool.candidates)):
+            health.observe(*self.probe(spec))
+        return self.pool.rank()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.probe_all()
+            except Exception:
+                logger.exception("Probing candidates failed")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
 class ConnectionPool(BaseCxnPool):
     """A connection pool that manages failover candidates"""
     default_spec = dict(host='localhost',
                         port=6379, db=0, password=None,
                         socket_timeout=None, encoding='utf-8',
                         encoding_errors='strict')
+    prober_class = HealthProber
     
     def __init__(self, connection_class=Connection, max_connections=None, failure_callback=None,
-                 candidates=None, retry=2, depth=1, **connection_kwargs):
+                 candidates=None, retry=2, depth=1, probe_interval=None, **connection_kwargs):
         """
-        adds `candidates` and `retry`
+        adds `candidates`, `retry` and `probe_interval`
 
         `candidates` is a list of maps whose members define how
         failover candidate differ from each other. For example, 3
@@ -96,28 +204,143 @@ class ConnectionPool(BaseCxnPool):
         `retry` defines how many times the connection pool will
         attempt to connect to the active candidate before failing
         over using the default failure callback.
+
+        With `probe_interval`, a `HealthProber` thread scores each
+        candidate every so many seconds and new connections go to the
+        best of them.
         """
         self.depth = depth
         self.retry = retry
         if failure_callback is None:
             failure_callback = self.callback
         
-        self.connection_kwargs = dict(self.default_spec,
-                                      failure_callback=failure_callback,
-                                      **connection_kwargs)
+        connection_kwargs = dict(self.default_spec,
+                                 failure_callback=failure_callback,
+                                 **connection_kwargs)
         
-        self.candidates = dict(dict(self.connection_kwargs, **c) for c in candidates)
+        self.candidates = [dict(connection_kwargs, **c) for c in candidates or ()]
+        if not self.candidates:
+            self.candidates.append(dict(connection_kwargs))
+        self.health = {}
+        self.generation = 0
+        self.failover_lock = threading.RLock()
+
+        BaseCxnPool.__init__(self, connection_class=connection_class,
+                             max_connections=max_connections,
+                             **dict(connection_kwargs, **self.address(self.candidates[0])))
+        self.prober = None
+        if probe_interval:
+            self.prober = self.prober_class(self, probe_interval)
+            self.prober.start()
+
+    @staticmethod
+    def address(spec):
+        return dict(host=spec['host'], port=spec['port'])
+
+    def key(self, spec):
+        return (spec['host'], int(spec['port']))
+
+    def health_of(self, specs):
+        return [self.health.setdefault(self.key(spec), Health()) for spec in specs]
+
+    @property
+    def primary(self):
+        return self.candidates[0]
+
+    def rank(self, failed=None):
+        """
+        Orders the candidates by health, best first, with a `failed`
+        candidate behind any of equal health.  Switches the pool to a
+        new primary if the best has changed.  Returns the primary.
+        """
+        with self.failover_lock:
+            ranked = list(self.candidates)
+            if failed is not None:
+                ranked.remove(failed)
+                ranked.append(failed)
+            scores = dict((self.key(spec), health.score) for spec, health \
+                          in zip(ranked, self.health_of(ranked)))
+            ranked.sort(key=lambda spec: scores[self.key(spec)])
+            self.candidates = ranked
+            if self.key(self.primary) != self.key(self.connection_kwargs):
+                self.switch(self.primary)
+            return self.primary
+
+    def switch(self, spec):
+        """
+        Moves the pool to a new primary `spec`: new connections go to
+        it, and existing ones as they are next checked out or released.
+        Connections are left alone here, since other threads check
+        them out and release them without `failover_lock`.
+        """
+        logger.warn("Failing over from %(host)s:%(port)s to " % self.connection_kwargs + \
+                    "%(host)s:%(port)s" % spec)
+        self.connection_kwargs.update(self.address(spec))
+        self.generation += 1
+
+    def recycle(self, cxn):
+        if cxn.generation != self.generation:
+            cxn.update(**self.address(self.primary))
+            cxn.generation = self.generation
+        return cxn
+
+    def make_connection(self):
+        cxn = BaseCxnPool.make_connection(self)
+        cxn.generation = self.generation
+        return cxn
 
-        BaseCxnPool.__init__(self, connection_class=Connection,
-                             max_connections=None,
-                             **connection_kwargs)
+    def get_connection(self, command_name, *keys, **options):
+        return self.recycle(BaseCxnPool.get_connection(self, command_name, *keys, **options))
+
+    def release(self, cxn):
+        self.recycle(cxn)
+        BaseCxnPool.release(self, cxn)
+
+    def disconnect(self):
+        if self.prober is not None:
+            self.prober.stop()
+        BaseCxnPool.disconnect(self)
+
+    def update_topology(self, doc):
+        """
+        Takes the chain as the watcher sees it: `doc` names the
+        `master` and the `chain` order as 'host:port' and optionally
+        the seconds of `lag` of each and those `down`.  Candidates are reordered to
+        match and the pool switches to the watcher's master.
+        """
+        specs = dict((self.key(spec), spec) for spec in self.candidates)
+        order = []
+        for name in doc['chain']:
+            host, port = name.rsplit(':', 1)
+            key = (host, int(port))
+            spec = specs.pop(key, None) or dict(self.connection_kwargs, host=host, port=int(port))
+            health = self.health_of([spec])[0]
+            if name in doc.get('down', ()):
+                health.observe(False)
+            else:
+                health.observe(True, health.latency, name == doc['master'] and 'master' or 'slave',
+                               doc.get('lag', {}).get(name))
+            order.append(spec)
+        with self.failover_lock:
+            self.candidates = order + specs.values()
+            if self.key(self.primary) != self.key(self.connection_kwargs):
+                self.switch(self.primary)
+        return self.primary
 
     def manage_failover(self, cxn):
         """
-        
+        Marks the connection's candidate as failed and moves the
+        connection to the best candidate left
         """
-        self.candidate.append(self.candidate.pop(0))
-        cxn.update(**self.candidate[0])
+        failed = [spec for spec in self.candidates \
+                  if self.key(spec) == (cxn.host, int(cxn.port))]
+        with self.failover_lock:
+            for health in self.health_of(failed):
+                health.observe(False)
+            self.rank(failed and failed[0] or None)
+        cxn.depth += 1
+        cxn.update(**self.address(self.primary))
+        cxn.generation = self.generation
         return cxn.connect()
 
     def callback(self, cxn, exc):
@@ -135,8 +358,220 @@ class ConnectionPool(BaseCxnPool):
         if self.retry > cxn.attempts:
             return cxn.connect()
 
-        if cxn.depth > self.depth * len(self.candidates):
+        if cxn.depth >= self.depth * len(self.candidates):
             return False
         
         return self.manage_failover(cxn)
 
+
+
+class TopologySubscriber(threading.Thread):
+    """
+    Follows the watcher's topology documents (see
+    `redundis.topology`) and hands each newer one to
+    `pool.update_topology`.
+
+    Documents are read from the watcher's UNIX socket at `path` if
+    given, otherwise from pub/sub `channel` on whichever of the pool's
+    candidates answers.  Only documents for `cluster` are taken.  If
+    the watcher stores documents (its `store_key`), give the same key
+    to catch up on (re)subscribing.
+    """
+    def __init__(self, pool, path=None, channel='redundis.topology', cluster='default',
+                 retry_interval=1.0, store_key=None):
+        threading.Thread.__init__(self, name='redundis-topology')
+        self.daemon = True
+        self.pool = pool
+        self.path = path
+        self.channel = channel
+        self.cluster = cluster
+        self.store_key = store_key
+        self.retry_interval = retry_interval
+        self.latest = None
+        self.stopped = threading.Event()
+
+    def apply(self, data):
+        if not data:
+            return None
+        doc = json.loads(data)
+        if doc.get('cluster') != self.cluster:
+            return None
+        if self.latest is not None and \
+               (doc['epoch'], doc['version']) <= (self.latest['epoch'], self.latest['version']):
+            return None
+        self.latest = doc
+        self.pool.update_topology(doc)
+        return doc
+
+    def follow_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        fp = sock.makefile('rb')
+        try:
+            for line in iter(fp.readline, ''):
+                self.apply(line)
+        finally:
+            fp.close()
+            sock.close()
+
+    def follow_channel(self, spec):
+        client = redis.StrictRedis(**dict(self.pool.address(spec), socket_timeout=None))
+        pubsub = client.pubsub()
+        pubsub.subscribe(self.channel)
+        try:
+            if self.store_key:
+                # catch up on anything published while we were away
+                self.apply(client.get('%s:%s' %(self.store_key, self.cluster)))
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    self.apply(message['data'])
+        finally:
+            pubsub.close()
+
+    def follow(self):
+        if self.path is not None:
+            return self.follow_socket()
+        for spec in list(self.pool.candidates):
+            try:
+                return self.follow_channel(spec)
+            except ConnectionError, e:
+                logger.debug("No topology from %(host)s:%(port)s" % spec + ": %s" % e)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.follow()
+            except (socket.error, IOError, ConnectionError, ValueError), e:
+                logger.debug("Lost topology subscription: %s", e)
+            self.stopped.wait(self.retry_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+# commands that never write, and so may be served by a slave
+READ_COMMANDS = frozenset("""
+BITCOUNT BITPOS DBSIZE DUMP EXISTS GET GETBIT GETRANGE HEXISTS HGET HGETALL
+HKEYS HLEN HMGET HSCAN HSTRLEN HVALS KEYS LINDEX LLEN LRANGE MGET PFCOUNT
+PTTL RANDOMKEY SCAN SCARD SDIFF SINTER SISMEMBER SMEMBERS SRANDMEMBER SSCAN
+STRLEN SUNION TTL TYPE ZCARD ZCOUNT ZLEXCOUNT ZRANGE ZRANGEBYLEX
+ZRANGEBYSCORE ZRANK ZREVRANGE ZREVRANGEBYLEX ZREVRANGEBYSCORE ZREVRANK ZSCAN
+ZSCORE
+""".split())
+
+
+class ReadWritePool(ConnectionPool):
+    """
+    A failover pool that sends reads to slaves.
+
+    Read commands go round robin to slaves no more than `max_lag`
+    seconds behind their master; everything else, and reads when no
+    slave is fresh enough or the chosen one fails, goes to the primary.  Reads are also kept
+    on the primary within `pinned()`, and for `stick_for` seconds
+    after a thread's last write so it can read its own writes.
+
+    Slave health and lag come from the prober (see `probe_interval`)
+    or the watcher's topology via `update_topology`.  The watcher only
+    publishes on a change, so without a prober reads go to a slave
+    for no more than `max_lag` seconds after the last document.
+    """
+    read_commands = READ_COMMANDS
+
+    def __init__(self, max_lag=1, stick_for=0, **kw):
+        self.max_lag = max_lag
+        self.stick_for = stick_for
+        self.replicas = {}
+        self.local = threading.local()
+        self.turn = count()
+        ConnectionPool.__init__(self, **kw)
+
+    @contextmanager
+    def pinned(self):
+        """
+        Sends every command in the block to the primary
+        """
+        depth = getattr(self.local, 'pinned', 0)
+        self.local.pinned = depth + 1
+        try:
+            yield self
+        finally:
+            self.local.pinned = depth
+
+    def is_pinned(self):
+        if getattr(self.local, 'pinned', 0):
+            return True
+        wrote = getattr(self.local, 'wrote', None)
+        return wrote is not None and time() - wrote < self.stick_for
+
+    def fresh(self, health):
+        """
+        Whether a slave may take reads: up, with its link up and no
+        more than `max_lag` seconds behind now.  Lag can only have
+        grown since it was observed, so the time since counts too.
+        """
+        if not health.up or health.role != 'slave' or health.lag is None:
+            return False
+        return health.lag + time() - health.checked <= self.max_lag
+
+    def readable(self):
+        """
+        The slaves reads may go to
+        """
+        slaves = self.candidates[1:]
+        return [spec for spec, health in zip(slaves, self.health_of(slaves)) \
+                if self.fresh(health)]
+
+    def replica_pool(self, spec):
+        key = self.key(spec)
+        with self.failover_lock:
+            if key not in self.replicas:
+                kwargs = dict(self.connection_kwargs, **self.address(spec))
+                kwargs['failure_callback'] = self.replica_callback
+                self.replicas[key] = BaseCxnPool(connection_class=self.connection_class, **kwargs)
+            return self.replicas[key]
+
+    def replica_callback(self, cxn, exc):
+        """
+        Failure callback of slave connections
+
+        Marks the slave failed and moves the connection to the
+        primary, so the read is served there.  A connection already
+        moved fails over as any other.
+        """
+        if (cxn.host, int(cxn.port)) != cxn.replica:
+            return self.callback(cxn, exc)
+        logger.warn("Slave %s:%s failed, reading from the primary: %s",
+                    cxn.host, cxn.port, exc)
+        with self.failover_lock:
+            self.health.setdefault(cxn.replica, Health()).observe(False)
+        cxn.update(**self.address(self.primary))
+        cxn.generation = self.generation
+        return cxn.connect()
+
+    def get_connection(self, command_name, *keys, **options):
+        if command_name.upper() not in self.read_commands:
+            self.local.wrote = time()
+        elif not self.is_pinned():
+            slaves = self.readable()
+            if slaves:
+                spec = slaves[next(self.turn) % len(slaves)]
+                cxn = self.replica_pool(spec).get_connection(command_name, *keys, **options)
+                cxn.replica = self.key(spec)
+                return cxn
+        cxn = ConnectionPool.get_connection(self, command_name, *keys, **options)
+        cxn.replica = None
+        return cxn
+
+    def release(self, cxn):
+        replica = getattr(cxn, 'replica', None)
+        if replica is not None:
+            if (cxn.host, int(cxn.port)) != replica:
+                # moved to the primary by `replica_callback`
+                cxn.update(host=replica[0], port=replica[1])
+            return self.replicas[replica].release(cxn)
+        return ConnectionPool.release(self, cxn)
+
+    def disconnect(self):
+        ConnectionPool.disconnect(self)
+        for pool in self.replicas.values():
+            pool.disconnect()
@@ -0,0 +1,133 @@
+"""
+Flap damping for instances rejoining the chain
+
+Every time an instance goes down it earns a penalty of 1, which decays
+by half every `half_life` seconds.  Once the penalty reaches
+`suppress` the instance is held out of the chain until it decays to
+`reuse`, and any instance that went down must stay up for
+`stable_for` seconds before it is chained again.  Each rechain of a
+returning instance may cost a full resync, so a flapping instance
+is left at weight 0 rather than reattached on every bounce.
+
+No more than `max_failovers` promotions are allowed in any
+`failover_window` seconds.
+"""
+from collections import deque
+from math import log
+from time import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Flaps(object):
+    """
+    Damping state of one instance
+    """
+    def __init__(self):
+        self.penalty = 0.0
+        self.updated = None
+        self.up_since = None
+        self.suppressed = False
+
+
+class Damper(object):
+    """
+    Decides which instances may be chained and whether a failover may
+    go ahead.  Instances are keyed by whatever the caller passes.
+    """
+    def __init__(self, half_life=60.0, suppress=2.5, reuse=1.0, stable_for=5.0,
+                 max_failovers=3, failover_window=60.0):
+        self.half_life = half_life
+        self.suppress = suppress
+        self.reuse = reuse
+        self.stable_for = stable_for
+        self.max_failovers = max_failovers
+        self.failover_window = failover_window
+        self.state = {}
+        self.failovers = deque()
+        self.deferred = False
+
+    def penalty(self, key, now=None):
+        flaps = self.state.get(key)
+        if flaps is None or flaps.updated is None:
+            return 0.0
+        now = now is not None and now or time()
+        return flaps.penalty * 0.5 ** ((now - flaps.updated) / self.half_life)
+
+    def record(self, key, up, now=None):
+        """
+        Notes that `key` was seen going up or down
+        """
+        now = now is not None and now or time()
+        flaps = self.state.setdefault(key, Flaps())
+        if up:
+            flaps.up_since = now
+            return flaps
+        flaps.penalty = self.penalty(key, now) + 1
+        flaps.updated = now
+        flaps.up_since = None
+        if flaps.penalty >= self.suppress and not flaps.suppressed:
+            flaps.suppressed = True
+            logger.warning("%s suppressed after flapping (penalty %.2f)", key, flaps.penalty)
+        return flaps
+
+    def returned(self, key, now=None):
+        """
+        Notes that `key` is up again if it was last seen going down,
+        as when a probe finds it back before its monitor does
+        """
+        flaps = self.state.get(key)
+        if flaps is not None and flaps.up_since is None:
+            self.record(key, True, now)
+        return flaps
+
+    def admit(self, key, now=None):
+        """
+        Whether `key` may be chained: it is not suppressed and has been
+        up for `stable_for` seconds since it last went down.
+        """
+        flaps = self.state.get(key)
+        if flaps is None:
+            return True
+        now = now is not None and now or time()
+        if flaps.suppressed:
+            if self.penalty(key, now) > self.reuse:
+                return False
+            flaps.suppressed = False
+            logger.info("%s no longer suppressed", key)
+        return flaps.up_since is not None and now - flaps.up_since >= self.stable_for
+
+    def failover(self, now=None):
+        """
+        Claims a failover, returning False if `max_failovers` have
+        already happened in the last `failover_window` seconds.
+        """
+        now = now is not None and now or time()
+        while self.failovers and self.failovers[0] <= now - self.failover_window:
+            self.failovers.popleft()
+        if len(self.failovers) >= self.max_failovers:
+            self.deferred = True
+            return False
+        self.deferred = False
+        self.failovers.append(now)
+        return True
+
+    def reviews(self):
+        for flaps in self.state.values():
+            if flaps.suppressed and flaps.penalty > self.reuse:
+                yield flaps.updated + self.half_life * log(flaps.penalty / self.reuse, 2)
+            if flaps.up_since is not None:
+                yield flaps.up_since + self.stable_for
+        if self.deferred and self.failovers:
+            yield self.failovers[0] + self.failover_window
+
+    def next_review(self, now=None):
+        """
+        Seconds until a held back instance may be admitted or a
+        deferred failover allowed, or None if nothing is waiting.
+        """
+        now = now is not None and now or time()
+        pending = [t - now for t in self.reviews() if t > now]
+        return pending and min(pending) or None
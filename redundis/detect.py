@@ -0,0 +1,147 @@
+"""
+Failure detectors for redis instances
+
+A detector heartbeats its instance over a dedicated socket and judges
+from the answers whether the instance is alive.  Unlike a hanging
+`blpop`, a heartbeat bounds how long a half-open connection can hide a
+dead instance to roughly `interval * misses + timeout`.
+"""
+from . import resp
+from collections import deque
+from math import erfc
+from math import log10
+from math import sqrt
+from time import sleep
+from time import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Heartbeat(object):
+    """
+    PINGs an instance every `interval` seconds.  The instance is
+    judged down once `misses` consecutive heartbeats go unanswered
+    within `timeout` seconds, and up again on the first answer.
+    """
+    def __init__(self, host, port, interval=0.5, timeout=0.25, misses=3):
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.timeout = timeout
+        self.misses = misses
+        self.sock = None
+        self.fp = None
+        self.missed = 0
+        self.alive = None
+        self.last_ok = None
+        self.latency = None
+
+    def connect(self):
+        self.sock = resp.connect(self.host, self.port, self.timeout)
+        self.fp = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.fp.close()
+            self.sock.close()
+        self.sock = self.fp = None
+
+    def beat(self):
+        """
+        Sends one heartbeat, returning whether it was answered in time
+        """
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.sendall(resp.PING)
+            resp.read_reply(self.fp)
+            return True
+        except resp.ReplyError:
+            # an error reply (LOADING, BUSY...) is still an answer
+            return True
+        except (IOError, OSError):
+            self.close()
+            return False
+        except BaseException:
+            # killed mid-reply, the stream can't be trusted
+            self.close()
+            raise
+
+    def record(self, ok, now):
+        if ok:
+            self.missed = 0
+            self.last_ok = now
+        else:
+            self.missed += 1
+
+    def judge(self, now):
+        return self.missed < self.misses
+
+    def observe(self, ok, now):
+        """
+        Records a heartbeat's outcome and returns the resulting
+        judgement of liveness
+        """
+        self.record(ok, now)
+        alive = self.judge(now)
+        if self.alive and not alive and self.last_ok is not None:
+            self.latency = now - self.last_ok
+            logger.info("%s:%s down, detected %.3fs after last answer",
+                        self.host, self.port, self.latency)
+        self.alive = alive
+        return alive
+
+    def wait_for(self, alive):
+        """
+        Heartbeats until the instance is judged `alive` (or not)
+        """
+        while True:
+            start = time()
+            ok = self.beat()
+            now = time()
+            if self.observe(ok, now) == alive:
+                return alive
+            sleep(max(0, self.interval - (now - start)))
+
+
+class PhiAccrual(Heartbeat):
+    """
+    Judges liveness by the phi accrual method: the suspicion level phi
+    grows with the time since the last answer, measured against the
+    observed distribution of answer intervals.  The instance is down
+    once phi exceeds `threshold`.
+    """
+    def __init__(self, host, port, interval=0.5, timeout=0.25, misses=3,
+                 threshold=8.0, window=100, min_std=0.05):
+        super(PhiAccrual, self).__init__(host, port, interval, timeout, misses)
+        self.threshold = threshold
+        self.min_std = min_std
+        self.intervals = deque(maxlen=window)
+
+    def record(self, ok, now):
+        if ok and self.last_ok is not None:
+            self.intervals.append(now - self.last_ok)
+        super(PhiAccrual, self).record(ok, now)
+
+    def phi(self, now):
+        if self.last_ok is None:
+            return float('inf')
+        intervals = self.intervals or [self.interval]
+        mean = sum(intervals) / float(len(intervals))
+        var = sum((x - mean) ** 2 for x in intervals) / float(len(intervals))
+        std = max(sqrt(var), self.min_std)
+        p_later = 0.5 * erfc((now - self.last_ok - mean) / (std * sqrt(2)))
+        if p_later <= 0:
+            return float('inf')
+        return -log10(p_later)
+
+    def judge(self, now):
+        if not self.missed:
+            return True
+        return self.phi(now) < self.threshold
+
+
+detectors = dict(heartbeat=Heartbeat,
+                 phi=PhiAccrual)
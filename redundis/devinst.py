@@ -1,3 +1,4 @@
+from .utils import BuildCache
 from .utils import Downloader
 from .utils import parse_cmd
 from .utils import pushd
@@ -12,48 +13,89 @@ import os
 class DevInstall(Command):
     """
     Create a local install for development and testing
+
+    Built binaries are kept in a build cache keyed on the source
+    tarball, the install actions and the platform, and restored into
+    `$VIRTUAL_ENV/bin` without compiling when they are there.
     """
     log = logging.getLogger(__name__)
 
     haproxy = spec(url='http://haproxy.1wt.eu/download/1.4/src/haproxy-1.4.20.tar.gz',
-                       install=['sh:make TARGET=generic',
-                                'sh:make install DESTDIR=$VIRTUAL_ENV',
-                                'self:link_redis'])
+                   install=['sh:make TARGET=generic',
+                            'self:link_haproxy'],
+                   binaries=['haproxy'])
 
     redis = spec(url="http://redis.googlecode.com/files/redis-2.4.11.tar.gz",
                  install=['sh:make',
-                          'self:link_redis'])
+                          'self:link_redis'],
+                 binaries=['src/redis-server', 'src/redis-cli', 'src/redis-benchmark'])
     grab = None
     venv = path(os.environ.get('VIRTUAL_ENV') and os.environ['VIRTUAL_ENV'] or '')
     
     parse_action = staticmethod(parse_cmd)
 
+    def link(self, spec):
+        """
+        Copies the binaries of `spec` built in the current directory
+        into the virtualenv's bin
+        """
+        bindir = self.venv / 'bin'
+        if not bindir.exists():
+            bindir.makedirs()
+        for binary in spec.binaries:
+            path(binary).copy2(bindir / path(binary).name)
+
     def link_redis(self):
-        pass
+        self.link(self.redis)
 
     def link_haproxy(self):
-        pass
+        self.link(self.haproxy)
 
     def get_parser(self, name):
         parser = super(DevInstall, self).get_parser(name)
+        parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                            help='Compile even if a cached build exists')
         return parser
 
-    def download_and_install(self, name, spec, overwrite=False):
+    def downloader(self):
         if self.grab is None:
             self.grab = Downloader()
-        out = self.grab(spec.url, self.venv / 'src' / name, overwrite)
+        return self.grab
+
+    def builds(self):
+        return BuildCache(self.downloader().cache / 'builds')
+
+    def download_and_install(self, name, spec, overwrite=False):
+        out = self.downloader()(spec.url, self.venv / 'src' / name, overwrite,
+                                spec.get('sha256'))
         with pushd(out):
             for action in spec.install:
                 out = self.run_action(action)
                 if not out is None:
                     self.app.stdout.write(out)
+
+    def install(self, name, spec, cache=True):
+        """
+        Restores a cached build of `spec` into the virtualenv, or builds
+        and caches it
+        """
+        grab = self.downloader()
+        grab.download(spec.url, spec.get('sha256'))
+        builds = self.builds()
+        key = builds.key(grab.manifest[spec.url]['sha256'], spec.install)
+        if cache and builds.restore(key, self.venv / 'bin'):
+            self.log.info('Restored %s from build cache (%s)', name, key[:12])
+            return
+        # a fresh tree: stale sources would be stored under this key
+        self.download_and_install(name, spec, overwrite=True)
+        src = self.venv / 'src' / name
+        builds.store(key, [src / binary for binary in spec.binaries])
     
     def run_action(self, action):
         kind, todo = action.split(':', 1)
         return getattr(self, '_action_%s' %kind)(todo)
     
     def _action_self(self, todo):
-        import pdb;pdb.set_trace()
         cmd, args, kwargs = self.parse_action(todo)
         return getattr(self, cmd)(*args, **kwargs)
 
@@ -61,10 +103,7 @@ class DevInstall(Command):
 
     def run(self, parsed_args):
         self.log.info('And so it begins')
-        self.download_and_install('redis', self.redis)
-        self.download_and_install('haproxy', self.haproxy)
-        self.log.debug('debugging')
-        self.app.stdout.write('hi!\n')
-
-
-
+        # fetch everything at once; building stays one at a time
+        self.downloader().fetch_all([self.redis.url, self.haproxy.url])
+        self.install('redis', self.redis, parsed_args.cache)
+        self.install('haproxy', self.haproxy, parsed_args.cache)
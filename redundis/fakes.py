@@ -0,0 +1,333 @@
+"""
+In-process stand ins for redis and HAProxy, for exercising the watcher
+without real servers
+"""
+from . import resp
+from gevent import socket
+from gevent.event import Event
+from gevent.pool import Pool
+from gevent.server import StreamServer
+from time import time
+import gevent
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class FakeRedis(object):
+    """
+    Speaks enough of the redis protocol for the watcher: PING, INFO,
+    SLAVEOF and BLPOP (which blocks until the connection drops), and
+    for load: GET and SET, which a slave refuses as read only.  Data is
+    not replicated.
+
+    Failures can be injected:
+
+     - `kill`: the listener and every connection are closed, as when
+       the process dies.  `restart` brings it back as a fresh master.
+     - `hang`: connections stay open but nothing is answered, as when
+       the process is stopped.  Its slaves lose their link.
+     - `partition`: nothing is answered, but slaves keep replicating,
+       as when only the watcher is cut off.
+
+    `heal` ends a hang or partition.
+    """
+    registry = {}
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.mode = None
+        self.healed = Event()
+        self.healed.set()
+        self.clients = 0
+        self.data = {}
+        self.reset()
+
+    def reset(self):
+        self.role = 'master'
+        self.master = None
+        self.started = time()
+
+    @property
+    def spec(self):
+        return '%s:%s' %(self.host, self.port)
+
+    def start(self):
+        self.server = StreamServer((self.host, self.port), self.handle, spawn=Pool())
+        self.server.start()
+        self.port = self.server.server_port
+        self.registry[(self.host, self.port)] = self
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop(timeout=0)
+        self.server = None
+
+    @property
+    def alive(self):
+        return self.server is not None and self.mode != 'hang'
+
+    def kill(self):
+        self.stop()
+
+    def restart(self):
+        self.reset()
+        return self.start()
+
+    def hang(self, mode='hang'):
+        self.mode = mode
+        self.healed.clear()
+
+    def partition(self):
+        self.hang('partition')
+
+    def heal(self):
+        self.mode = None
+        self.healed.set()
+
+    @property
+    def upstream(self):
+        if self.master is None:
+            return None
+        return self.registry.get(self.master)
+
+    @property
+    def offset(self):
+        if self.role == 'master':
+            return int((time() - self.started) * 1000)
+        upstream = self.upstream
+        if upstream is None or not upstream.alive:
+            return 0
+        return upstream.offset
+
+    def info(self, section=None):
+        lines = ['# Replication', 'role:%s' % self.role]
+        if self.role == 'master':
+            lines.append('master_repl_offset:%d' % self.offset)
+        else:
+            upstream = self.upstream
+            link = upstream is not None and upstream.alive and 'up' or 'down'
+            lines.extend(['master_host:%s' % self.master[0],
+                          'master_port:%s' % self.master[1],
+                          'master_link_status:%s' % link,
+                          'master_last_io_seconds_ago:%d' % (link == 'up' and 0 or -1),
+                          'slave_repl_offset:%d' % self.offset])
+        if section is None:
+            lines.extend(['# Clients', 'connected_clients:%d' % self.clients,
+                          '# Memory', 'used_memory:%d' % (1 << 20)])
+        return '\r\n'.join(lines) + '\r\n'
+
+    def execute(self, args):
+        cmd = args[0].upper()
+        if cmd == 'PING':
+            return '+PONG\r\n'
+        if cmd == 'INFO':
+            body = self.info(*args[1:])
+            return '$%d\r\n%s\r\n' %(len(body), body)
+        if cmd == 'SLAVEOF':
+            host, port = args[1:3]
+            if host.upper() == 'NO' and port.upper() == 'ONE':
+                if self.role == 'slave':
+                    self.started = time() - self.offset / 1000.0
+                self.role, self.master = 'master', None
+            else:
+                self.role, self.master = 'slave', (host, int(port))
+            return '+OK\r\n'
+        if cmd == 'GET':
+            value = self.data.get(args[1])
+            return value is None and '$-1\r\n' or '$%d\r\n%s\r\n' %(len(value), value)
+        if cmd == 'SET':
+            if self.role == 'slave':
+                return "-READONLY You can't write against a read only slave.\r\n"
+            self.data[args[1]] = args[2]
+            return '+OK\r\n'
+        if cmd == 'BLPOP':
+            Event().wait()
+        return '-ERR unknown command %r\r\n' % cmd
+
+    def handle(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        fp = sock.makefile('rb')
+        self.clients += 1
+        try:
+            while True:
+                args = resp.read_reply(fp)
+                self.healed.wait()
+                sock.sendall(self.execute(args))
+        except (IOError, resp.ReplyError):
+            pass
+        finally:
+            self.clients -= 1
+            fp.close()
+            sock.close()
+
+
+class FakeHAProxy(object):
+    """
+    Serves an HAProxy style stats socket on a temporary UNIX socket,
+    keeping server weights and a timestamped `history` of every weight
+    change.  Supports `prompt`, `get weight`, `set weight`, `show
+    stat` and `show info`.  Servers report no health checks unless
+    given a check status in `checks`.
+    """
+    def __init__(self, servers=(), backend='redis', path=None):
+        self.path = path is not None and path or \
+                    tempfile.mktemp(prefix='redundis-', suffix='.sock')
+        self.backend = backend
+        self.weights = dict(((backend, server), weight) for server, weight in servers)
+        self.initial = dict(self.weights)
+        self.checks = {}
+        self.history = []
+        self.changed = Event()
+        self.server = None
+
+    def start(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(16)
+        self.server = StreamServer(listener, self.handle, spawn=Pool())
+        self.server.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop(timeout=0)
+        self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def weight(self, server, backend=None):
+        return self.weights.get((backend or self.backend, server))
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Waits until `predicate(self)` holds after a weight change,
+        returning the time it first held or `None` on timeout.
+        """
+        end = timeout is not None and time() + timeout or None
+        while not predicate(self):
+            remaining = end is not None and end - time() or None
+            if remaining is not None and remaining <= 0:
+                return None
+            self.changed.clear()
+            self.changed.wait(remaining)
+        return time()
+
+    def execute(self, line):
+        words = line.split()
+        if words[:2] == ['get', 'weight']:
+            key = tuple(words[2].split('/', 1))
+            if key not in self.weights:
+                return 'No such server.\n'
+            return '%s (initial %s)\n' %(self.weights[key], self.initial[key])
+        if words[:2] == ['set', 'weight']:
+            key = tuple(words[2].split('/', 1))
+            if key not in self.weights:
+                return 'No such server.\n'
+            self.weights[key] = int(words[3])
+            self.history.append((time(), key[1], self.weights[key]))
+            self.changed.set()
+            return ''
+        if words[:2] == ['show', 'info']:
+            return 'Name: FakeHAProxy\n'
+        if words[:2] == ['show', 'stat']:
+            return self.show_stat()
+        return 'Unknown command.\n'
+
+    def show_stat(self):
+        lines = ['# pxname,svname,qcur,qmax,scur,smax,status,weight,check_status,']
+        for (backend, server), weight in sorted(self.weights.items()):
+            lines.append('%s,%s,0,0,0,0,UP,%d,%s,' %(backend, server, weight,
+                                                     self.checks.get(server, '')))
+        for backend in sorted(set(backend for backend, server in self.weights)):
+            lines.append('%s,BACKEND,0,0,0,0,UP,%d,,' %(backend, sum(
+                w for (bk, server), w in self.weights.items() if bk == backend)))
+        return '\n'.join(lines) + '\n\n'
+
+    def handle(self, sock, address):
+        fp = sock.makefile('rb')
+        interactive = False
+        try:
+            for line in iter(fp.readline, ''):
+                line = line.strip()
+                if line == 'prompt':
+                    interactive = True
+                    sock.sendall('\n> ')
+                    continue
+                out = ''.join(self.execute(cmd.strip()) for cmd in line.split(';') if cmd.strip())
+                if not interactive:
+                    sock.sendall(out)
+                    break
+                sock.sendall(out + '\n> ')
+        except IOError:
+            pass
+        finally:
+            fp.close()
+            sock.close()
+
+
+class FakeProxy(object):
+    """
+    A frontend for a `FakeHAProxy`: each new connection is piped to the
+    instance with the highest weight in its backend, or closed if none
+    has any.  `instances` maps server names to `FakeRedis`.  As with
+    HAProxy, open connections stay with their instance until either
+    end closes.
+    """
+    def __init__(self, haproxy, instances, host='127.0.0.1', port=0):
+        self.haproxy = haproxy
+        self.instances = instances
+        self.host = host
+        self.port = port
+        self.server = None
+
+    @property
+    def spec(self):
+        return '%s:%s' %(self.host, self.port)
+
+    def start(self):
+        self.server = StreamServer((self.host, self.port), self.handle, spawn=Pool())
+        self.server.start()
+        self.port = self.server.server_port
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop(timeout=0)
+        self.server = None
+
+    def route(self):
+        weighted = [(weight, server) for server, weight in \
+                    ((s, self.haproxy.weight(s)) for s in sorted(self.instances)) if weight]
+        return weighted and self.instances[max(weighted)[1]] or None
+
+    def pipe(self, src, dest):
+        try:
+            for data in iter(lambda: src.recv(65536), ''):
+                dest.sendall(data)
+        except IOError:
+            pass
+        finally:
+            src.close()
+            dest.close()
+
+    def handle(self, sock, address):
+        inst = self.route()
+        try:
+            if inst is None:
+                raise IOError('no server has any weight')
+            upstream = socket.create_connection((inst.host, inst.port))
+        except IOError:
+            sock.close()
+            return
+        for end in sock, upstream:
+            end.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        back = gevent.spawn(self.pipe, upstream, sock)
+        self.pipe(sock, upstream)
+        back.join()
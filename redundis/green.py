@@ -0,0 +1,19 @@
+"""
+Deferred gevent monkey patching
+
+Nothing in redundis patches the process on import or when a
+`Watcher`, `Supervisor` or fake is made.  Only the commands that run
+greenlets (watch, bench and chaos) call `patch`, so importing redundis
+from an asyncio or threaded program leaves it alone.  Library and test
+code that runs the watcher or the fakes on gevent calls `patch`
+itself, before any socket is opened.
+"""
+
+
+def patch():
+    """
+    Monkey patches the process for gevent, once
+    """
+    import gevent.monkey
+    if not gevent.monkey.is_module_patched('socket'):
+        gevent.monkey.patch_all()
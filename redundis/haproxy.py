@@ -1,21 +1,150 @@
 # all credit to: http://www.gefira.pl/blog/2011/07/01/accessing-haproxy-statistics-with-python/
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from cStringIO import StringIO
+from . import metrics
+from collections import namedtuple
 from contextlib import contextmanager
 from time import time
 from traceback import format_exc
 import logging
+import socket
+import threading
 
 
 logger = logging.getLogger(__name__)
- 
+
+roundtrip = metrics.timed('redundis_haproxy_roundtrip_seconds',
+                          'Round trips to the HAProxy stats socket')
+reconnects = metrics.registry.counter('redundis_haproxy_reconnects_total',
+                                      'Stats sessions reopened after an error')
+timeouts = metrics.registry.counter('redundis_haproxy_timeouts_total',
+                                    'Stats socket calls that missed their deadline')
+
+
+class StatsError(IOError):
+    """
+    The stats socket hung up or could not be reached
+    """
+
+
+class StatsTimeout(StatsError):
+    """
+    HAProxy did not answer before the deadline
+    """
+
+
+def stats_error(e):
+    """
+    `e`, a failure talking to the stats socket, as a `StatsError`
+    """
+    if isinstance(e, StatsError):
+        return e
+    return StatsError('haproxy stats socket failed: %s' % e)
+
+
+def remaining(deadline):
+    """
+    Seconds left until `deadline`, raising `StatsTimeout` if none are
+    """
+    left = deadline - time()
+    if left <= 0:
+        timeouts.inc()
+        raise StatsTimeout('no answer from haproxy in time')
+    return left
+
+
+@contextmanager
+def until(client, deadline):
+    """
+    Bounds the socket calls made on `client` in the block by
+    `deadline`, turning a socket timeout into `StatsTimeout`
+    """
+    client.settimeout(remaining(deadline))
+    try:
+        yield client
+    except socket.timeout:
+        timeouts.inc()
+        raise StatsTimeout('no answer from haproxy in time')
+
+
+def send(client, data, deadline):
+    with until(client, deadline):
+        client.sendall(data)
+
+
+class Buffer(object):
+    """
+    Bytes read from a socket straight into a preallocated bytearray,
+    which is compacted or doubled only when full.  Offsets are relative
+    to the unread data.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.data = bytearray(size)
+        self.start = self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv(self, client, deadline):
+        """
+        Receives what `client` has before `deadline`.  Returns the
+        number of bytes read, 0 once the peer has hung up.
+        """
+        if self.end == len(self.data):
+            self.data[:len(self)] = self.data[self.start:self.end]
+            self.start, self.end = 0, len(self)
+        if self.end == len(self.data):
+            self.data.extend(bytearray(max(len(self.data), self.size)))
+        view = memoryview(self.data)[self.end:]
+        try:
+            with until(client, deadline):
+                count = client.recv_into(view)
+        finally:
+            view = None
+        self.end += count
+        return count
+
+    def find(self, sub):
+        at = self.data.find(sub, self.start, self.end)
+        if at < 0:
+            return at
+        return at - self.start
+
+    def startswith(self, prefix):
+        return self.data[self.start:self.start + len(prefix)] == prefix
+
+    def take(self, size, skip=0):
+        """
+        Removes and returns the next `size` bytes, dropping `skip`
+        more after them
+        """
+        out = bytes(self.data[self.start:self.start + size])
+        self.start += size + skip
+        return out
+
+    def lines(self):
+        """
+        Takes each complete line, without its line ending
+        """
+        at = self.find(b'\n')
+        while at >= 0:
+            yield self.take(at, 1)
+            at = self.find(b'\n')
+
 
 class StatsSocket(object):
     """ Used for communicating with HAProxy through its local UNIX socket interface.
+
+    Every call is bounded by a deadline `timeout` milliseconds off and
+    raises `StatsTimeout` if HAProxy is not done by then.
     """
-    def __init__(self, socket_name=None):
+    def __init__(self, socket_name=None, timeout=1000):
         self.socket_name = socket_name
+        self.timeout = timeout
+        self.weight_cache = {}
+        self.stat_cache = {}
+        self.stat_time = None
 
     def get_weight(self, backend, server):
         return self.execute("get weight",  "%s/%s" %(backend, server))
@@ -34,44 +163,414 @@ class StatsSocket(object):
 
     def disable(self, backend, server):
         self.execute('disable server', '%s/%s' %(backend, server))
-        
-    def execute(self, command, extra="", timeout=200):
+
+    def set_weights(self, backend, weights):
+        """
+        Sets the weight for each `(server, weight)` pair in `weights`
+        and reads each back, returning the current weights in order.
+        """
+        commands = []
+        for server, weight in weights:
+            commands.append("set weight %s/%s %s" %(backend, server, weight))
+            commands.append("get weight %s/%s" %(backend, server))
+        out = [x.strip() for x in self.execute_many(commands)[1::2]]
+        self.cache_weights(backend, (server for server, _ in weights), out)
+        return out
+
+    def get_weights(self, backend, servers):
+        servers = list(servers)
+        commands = ["get weight %s/%s" %(backend, server) for server in servers]
+        out = [x.strip() for x in self.execute_many(commands)]
+        self.cache_weights(backend, servers, out)
+        return out
+
+    def cache_weights(self, backend, servers, responses):
+        for server, resp in zip(servers, responses):
+            self.weight_cache[(backend, server)] = parse_weight(resp)
+
+    def cached_weights(self, backend):
+        """
+        The last weights HAProxy reported for `backend`'s servers
+        """
+        return dict((server, weight) for (bk, server), weight \
+                    in self.weight_cache.items() if bk == backend)
+
+    @roundtrip
+    def show_stat(self, backend=None, max_age=None):
+        """
+        Reads the state of every server (of `backend` only, if given)
+        with one streamed `show stat`, caching and returning them as a
+        dict of server name, or `(backend, server)` without `backend`,
+        to `ServerStat`.  With `max_age`, a cache refreshed in the last
+        `max_age` seconds is returned instead.
+        """
+        if max_age is not None and self.stat_time is not None \
+               and time() - self.stat_time < max_age:
+            return self.cached_stats(backend)
+        out = {}
+        for stat in parse_stat(self.iter_lines('show stat -1 4 -1')):
+            key = (stat.backend, stat.server)
+            self.stat_cache[key] = stat
+            self.weight_cache[key] = stat.weight
+            if backend is None:
+                out[key] = stat
+            elif stat.backend == backend:
+                out[stat.server] = stat
+        self.stat_time = time()
+        return out
+
+    def cached_stats(self, backend=None):
+        """
+        The servers of `backend` (or all) as of the last `show stat`
+        """
+        if backend is None:
+            return dict(self.stat_cache)
+        return dict((server, stat) for (bk, server), stat \
+                    in self.stat_cache.items() if bk == backend)
+
+    def deadline(self, timeout=None):
+        """
+        When a call started now must be done by, `timeout` (or the
+        socket's) milliseconds off
+        """
+        return time() + (timeout is not None and timeout or self.timeout) / 1000
+
+    def execute_many(self, commands, timeout=None):
+        """
+        Executes each of `commands`, returning a list of responses
+        """
+        deadline = self.deadline(timeout)
+        return [self.execute(command, timeout=remaining(deadline) * 1000) \
+                for command in commands]
+
+    def iter_lines(self, command):
+        """
+        Sends `command` and yields the response a line at a time as it
+        arrives
+        """
+        logger.debug('haproxy: %s', command)
+        deadline = self.deadline()
+        buff = Buffer()
+        with unixsocket(self.socket_name, deadline) as client:
+            send(client, command + '\n', deadline)
+            while buff.recv(client, deadline):
+                for line in buff.lines():
+                    yield line
+        if buff:
+            yield buff.take(len(buff))
+
+    @roundtrip
+    def execute(self, command, extra="", timeout=None):
         """
         Executes a HAProxy command by sending a message to a HAProxy's
-        local UNIX socket and waiting up to 'timeout' milliseconds for
-        the response.
+        local UNIX socket and waiting up to `timeout` milliseconds (by
+        default the socket's `timeout`) for the response.
         """
         if extra:
             command = command + ' ' + extra
 
         logger.debug('haproxy: %s', command)
-        
-        buff = StringIO()
-        end = time() + timeout
 
-        with unixsocket(self.socket_name) as client:
-            client.send(command + '\n')
-            while time() <=  end:
-                data = client.recv(4096)
-                if data:
-                    buff.write(data)
-                else:
-                    return buff.getvalue()
+        deadline = self.deadline(timeout)
+        buff = Buffer()
+        with unixsocket(self.socket_name, deadline) as client:
+            send(client, command + '\n', deadline)
+            while buff.recv(client, deadline):
+                pass
+        return buff.take(len(buff))
+
+
+class ServerStat(namedtuple('ServerStat', 'backend server status weight sessions queue check')):
+    """
+    One server's row of `show stat`: its `status` (UP, DOWN, MAINT,
+    ...), `weight`, current `sessions` and `queue` and the result of
+    its last health `check`
+    """
+
+
+# only a check that talked to redis says it is answering: a plain
+# `check` (L4OK) passes a stopped or wedged redis that still accepts
+# connections
+passed_checks = ('L7OK', 'L7OKC')
+failed_checks = ('SOCKERR', 'L4TOUT', 'L4CON', 'L6TOUT', 'L6RSP', 'L7TOUT', 'L7RSP', 'L7STS')
+
+
+def check_passed(stat):
+    """
+    What HAProxy's last health check of a server said: True if an
+    L7 or `tcp-check` check passed, False if any check failed and None
+    if HAProxy does not check the server, has yet to, only checks that
+    it accepts connections or it is in maintenance
+    """
+    if stat is None or stat.status.startswith('MAINT'):
+        return None
+    check = stat.check.lstrip('* ')
+    if check in passed_checks:
+        return True
+    if check in failed_checks:
+        return False
+    return None
+
+
+def stat_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_stat(lines):
+    """
+    Turns the CSV lines of a `show stat` into a `ServerStat` per
+    server, skipping the frontend and backend rows.  Columns are found
+    by the header so any HAProxy version will do.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith('# '):
+            break
+    else:
+        return
+    fields = line[2:].split(',')
+    cols = [fields.index(name) for name in \
+            ('pxname', 'svname', 'status', 'weight', 'scur', 'qcur', 'check_status')]
+    for line in lines:
+        if not line:
+            continue
+        row = line.split(',')
+        backend, server, status, weight, scur, qcur, check = [row[i] for i in cols]
+        if server in ('FRONTEND', 'BACKEND'):
+            continue
+        yield ServerStat(backend, server, status, stat_int(weight),
+                         stat_int(scur), stat_int(qcur), check)
+
+
+def parse_weight(resp):
+    """
+    Pulls the current weight out of a `get weight` response such as
+    '150 (initial 150)'.  Returns `None` for errors.
+    """
+    try:
+        return int(resp.split(None, 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+class WeightPlan(object):
+    """
+    The weights a backend should carry for a chain and the smallest set
+    of changes that takes it there from what HAProxy last reported.
+
+    `diff` is a list of `(server, old, new)` ordered so that servers
+    losing weight are drained before any server gains weight; applying
+    it never leaves two masters weighted at once.
+    """
+    def __init__(self, backend, target, current=None):
+        self.backend = backend
+        self.target = list(target)
+        self.current = current is not None and current or {}
+        self.diff = self.compute()
+
+    @classmethod
+    def from_chain(cls, backend, servers, weights, idle=(), current=None):
+        """
+        Weights `servers` by their position in the chain using
+        `weights`.  Servers past the end of `weights` and any `idle`
+        servers are weighted 0.
+        """
+        target = [(server, i < len(weights) and int(weights[i]) or 0) \
+                  for i, server in enumerate(servers)]
+        target.extend((server, 0) for server in idle)
+        return cls(backend, target, current)
+
+    @staticmethod
+    def draining_first(change):
+        server, old, new = change
+        return (new > (old or 0), new)
+
+    def compute(self):
+        changes = [(server, self.current.get(server), weight) \
+                   for server, weight in self.target \
+                   if self.current.get(server) != weight]
+        return sorted(changes, key=self.draining_first)
+
+    def apply(self, stats):
+        """
+        Sends the whole diff through `stats` as one batch and returns
+        the diff applied.
+        """
+        if self.diff:
+            self.readback = stats.set_weights(self.backend,
+                                              [(server, new) for server, _, new in self.diff])
+        return self.diff
+
+
+class StatsSession(StatsSocket):
+    """
+    A persistent connection to HAProxy's stats socket held in
+    interactive (`prompt`) mode.
+
+    Batches of commands are written in one go and the responses are
+    split apart on the prompt HAProxy emits after each command.  A
+    broken connection is reopened and the batch resent up to `retry`
+    times.
+    """
+    def __init__(self, socket_name=None, retry=1, timeout=1000):
+        super(StatsSession, self).__init__(socket_name, timeout)
+        self.lock = threading.RLock()
+        self.retry = retry
+        self.client = None
+        self.buff = Buffer()
+
+    def connect(self, deadline=None):
+        self.close()
+        deadline = deadline is not None and deadline or self.deadline()
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with until(client, deadline):
+            client.connect(self.socket_name)
+        self.client = client
+        send(client, b'prompt\n', deadline)
+        self.read_responses(1, deadline)
+        logger.debug('haproxy: session open on %s', self.socket_name)
+        return client
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.buff = Buffer()
+
+    def recv(self, deadline):
+        if not self.buff.recv(self.client, deadline):
+            raise StatsError('haproxy closed the stats session')
+
+    def next_prompt(self):
+        """
+        Where the next prompt starts and ends in the buffer, if it has
+        arrived
+        """
+        if self.buff.startswith(b'> '):
+            return 0, 2
+        at = self.buff.find(b'\n> ')
+        return at >= 0 and (at, at + 3) or None
+
+    def read_responses(self, count, deadline):
+        """
+        Reads from the session until `count` prompts have been seen,
+        returning the text that preceded each one.
+        """
+        out = []
+        while len(out) < count:
+            at = self.next_prompt()
+            if at is None:
+                self.recv(deadline)
+                continue
+            start, end = at
+            out.append(self.buff.take(start, end - start))
+        return out
+
+    @roundtrip
+    def execute_many(self, commands, timeout=None):
+        """
+        Pipelines `commands` down the session in a single write and
+        returns their responses in order.  A timeout is not retried:
+        the deadline covers reconnecting too.
+        """
+        payload = ''.join('%s\n' % command for command in commands)
+        logger.debug('haproxy: %s', '; '.join(commands))
+        deadline = self.deadline(timeout)
+        with self.lock:
+            for attempt in range(self.retry + 1):
+                try:
+                    if self.client is None:
+                        self.connect(deadline)
+                    send(self.client, payload, deadline)
+                    return self.read_responses(len(commands), deadline)
+                except StatsTimeout, e:
+                    self.close()
+                    logger.error('haproxy: session timed out, e=[%s]', e)
+                    raise
+                except (IOError, OSError), e:
+                    self.close()
+                    if attempt >= self.retry:
+                        logger.error('haproxy: session failed, e=[%s]', e)
+                        raise stats_error(e)
+                    logger.warn('haproxy: reconnecting session, e=[%s]', e)
+                    reconnects.inc()
+
+    def execute(self, command, extra="", timeout=None):
+        if extra:
+            command = command + ' ' + extra
+        return self.execute_many([command], timeout)[0]
+
+    def read_lines(self, deadline):
+        """
+        Yields lines from the session until the next prompt
+        """
+        while True:
+            if self.buff.startswith(b'> '):
+                self.buff.take(0, 2)
+                return
+            at = self.buff.find(b'\n')
+            if at >= 0:
+                yield self.buff.take(at, 1)
+                continue
+            self.recv(deadline)
+
+    def iter_lines(self, command):
+        """
+        Yields the response to `command` a line at a time as it
+        arrives.  A broken connection is reopened and the command
+        resent only if nothing has been yielded yet; the session is
+        closed if the response is not read to the end.
+        """
+        logger.debug('haproxy: %s', command)
+        deadline = self.deadline()
+        with self.lock:
+            for attempt in range(self.retry + 1):
+                started = False
+                try:
+                    if self.client is None:
+                        self.connect(deadline)
+                    send(self.client, command + '\n', deadline)
+                    for line in self.read_lines(deadline):
+                        started = True
+                        yield line
+                    return
+                except GeneratorExit:
+                    self.close()
+                    raise
+                except StatsTimeout, e:
+                    self.close()
+                    logger.error('haproxy: session timed out, e=[%s]', e)
+                    raise
+                except (IOError, OSError), e:
+                    self.close()
+                    if started or attempt >= self.retry:
+                        logger.error('haproxy: session failed, e=[%s]', e)
+                        raise stats_error(e)
+                    logger.warn('haproxy: reconnecting session, e=[%s]', e)
+                    reconnects.inc()
 
 
 @contextmanager
-def unixsocket(sockname):
+def unixsocket(sockname, deadline=None):
     """
     sets up a unix socket and closes it when the block exits. Catches errors.
     """
-    from gevent import socket
     client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        client.connect(sockname)
+        if deadline is not None:
+            with until(client, deadline):
+                client.connect(sockname)
+        else:
+            client.connect(sockname)
         yield client
     except Exception, e:
         msg = 'An error has occurred, e=[{e}]'.format(e=format_exc(e))
         logger.error(msg)
+        if isinstance(e, socket.error):
+            raise stats_error(e)
         raise
     finally:
         client.close()
@@ -0,0 +1,228 @@
+"""
+Counters and histograms for the watcher's hot path
+
+Metrics live in a `Registry` (the module level `registry` by default)
+and can be scraped as Prometheus text over HTTP with `MetricsServer`
+or pushed to StatsD over UDP with `StatsdEmitter`.  Both run as
+greenlets in the watcher's hub.
+"""
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+import bisect
+import logging
+import socket
+
+
+logger = logging.getLogger(__name__)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' %(k, v) for k, v in pairs)
+
+
+class Counter(object):
+    """
+    A count that only goes up, per set of labels
+    """
+    kind = 'counter'
+
+    def __init__(self, registry, name, help):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+        self.registry.notify(self, amount, labels)
+
+    def value(self, **labels):
+        return self.values.get(label_key(labels), 0)
+
+    def render(self):
+        return ['%s%s %s' %(self.name, format_labels(key), value) \
+                for key, value in sorted(self.values.items())]
+
+
+class Histogram(object):
+    """
+    Observations (usually seconds) counted into cumulative buckets,
+    per set of labels
+    """
+    kind = 'histogram'
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, registry, name, help, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, total + value)
+        self.registry.notify(self, value, labels)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def count(self, **labels):
+        counts, total = self.values.get(label_key(labels), ([0], 0))
+        return sum(counts)
+
+    def render(self):
+        out = []
+        for key, (counts, total) in sorted(self.values.items()):
+            running = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                running += count
+                out.append('%s_bucket%s %s' %(self.name, format_labels(key, [('le', bound)]), running))
+            out.append('%s_sum%s %s' %(self.name, format_labels(key), total))
+            out.append('%s_count%s %s' %(self.name, format_labels(key), running))
+        return out
+
+
+class Registry(object):
+    """
+    Holds metrics by name and tells `listeners` of every update
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.listeners = []
+
+    def get(self, cls, name, help, **kw):
+        if name not in self.metrics:
+            self.metrics[name] = cls(self, name, help, **kw)
+        return self.metrics[name]
+
+    def counter(self, name, help=''):
+        return self.get(Counter, name, help)
+
+    def histogram(self, name, help='', buckets=None):
+        return self.get(Histogram, name, help, buckets=buckets)
+
+    def notify(self, metric, value, labels):
+        for listener in self.listeners:
+            listener(metric, value, labels)
+
+    def render(self):
+        """
+        The registry in the Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP %s %s' %(name, metric.help))
+            lines.append('# TYPE %s %s' %(name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def timed(name, help='', **labels):
+    """
+    Decorates a function to observe how long each call takes in the
+    histogram `name`.  The call is otherwise untouched.
+    """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kw):
+            with registry.histogram(name, help).time(**labels):
+                return func(*args, **kw)
+        return wrapper
+    return decorate
+
+
+class MetricsServer(object):
+    """
+    Serves `registry` as Prometheus text at any path over HTTP
+    """
+    def __init__(self, port, host='', registry=registry):
+        self.address = (host, port)
+        self.registry = registry
+        self.server = None
+
+    def app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [self.registry.render()]
+
+    def start(self):
+        from gevent.pywsgi import WSGIServer
+        self.server = WSGIServer(self.address, self.app, log=None)
+        self.server.start()
+        logger.info("Serving metrics on %s:%s", *self.address)
+        return self.server
+
+
+class StatsdEmitter(object):
+    """
+    Pushes every update to `registry` to StatsD, batched into UDP
+    packets every `interval` seconds.  Counters are sent as counts and
+    histograms as timers in milliseconds; labels become name segments.
+    """
+    max_packet = 512
+
+    def __init__(self, host, port=8125, prefix='redundis', interval=1.0,
+                 registry=registry):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.interval = interval
+        self.registry = registry
+        self.pending = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, metric, value, labels):
+        name = '.'.join([self.prefix, metric.name] + \
+                        [str(v).replace('.', '_').replace(':', '_') for k, v in sorted(labels.items())])
+        if metric.kind == 'counter':
+            self.pending.append('%s:%s|c' %(name, value))
+        else:
+            self.pending.append('%s:%.3f|ms' %(name, value * 1000))
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        packet = []
+        for line in pending:
+            if packet and len('\n'.join(packet + [line])) > self.max_packet:
+                self.send('\n'.join(packet))
+                packet = []
+            packet.append(line)
+        if packet:
+            self.send('\n'.join(packet))
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data, self.address)
+        except socket.error, e:
+            logger.debug("statsd send failed: %s", e)
+
+    def run(self):
+        from gevent import sleep
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        import gevent
+        self.registry.listeners.append(self.record)
+        return gevent.spawn(self.run)
@@ -0,0 +1,90 @@
+"""
+Just enough of the redis protocol to talk to an instance over a bare
+socket
+"""
+import socket
+import struct
+
+
+class ReplyError(Exception):
+    """
+    Redis answered with an error reply
+    """
+
+
+def encode(*args):
+    """
+    Encodes a command as a RESP multi-bulk request
+    """
+    args = [str(x) for x in args]
+    parts = ['*%d\r\n' % len(args)]
+    parts.extend('$%d\r\n%s\r\n' %(len(x), x) for x in args)
+    return ''.join(parts)
+
+
+PING = encode('PING')
+
+
+def read_reply(fp):
+    """
+    Reads one reply (or request) from the file-like `fp`
+    """
+    line = fp.readline()
+    if not line.endswith('\r\n'):
+        raise IOError('connection closed mid-reply')
+    kind, rest = line[0], line[1:-2]
+    if kind == '+':
+        return rest
+    if kind == '-':
+        raise ReplyError(rest)
+    if kind == ':':
+        return int(rest)
+    if kind == '$':
+        size = int(rest)
+        if size < 0:
+            return None
+        data = fp.read(size + 2)
+        if len(data) != size + 2:
+            raise IOError('connection closed mid-reply')
+        return data[:-2]
+    if kind == '*':
+        size = int(rest)
+        if size < 0:
+            return None
+        return [read_reply(fp) for x in range(size)]
+    raise ReplyError('unknown reply type %r' % kind)
+
+
+def parse_info(text):
+    """
+    Parses the body of an INFO reply into a dict
+    """
+    out = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#') or ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        out[key] = value
+    return out
+
+
+def connect(host, port, timeout=None, keepalive=True):
+    """
+    Opens a socket to a redis instance.  `timeout` (seconds) bounds
+    connecting and each read, including via SO_RCVTIMEO for sockets
+    not managed by gevent.  `keepalive` turns on TCP keepalive so
+    half-open connections are eventually torn down by the kernel.
+    """
+    sock = socket.create_connection((host, port), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if keepalive:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, value in (('TCP_KEEPIDLE', 1), ('TCP_KEEPINTVL', 1), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+    if timeout:
+        secs = int(timeout)
+        usecs = int((timeout - secs) * 1e6)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO,
+                        struct.pack('ll', secs, usecs))
+    return sock
@@ -0,0 +1,337 @@
+"""
+The engine independent half of the watcher
+
+How a chain is classified from the roles of its members, and what is
+done about each state, without any I/O.  An engine (`watcher.Watcher`
+on gevent, or the asyncio one in `examples/aio`) subclasses
+`ChainRoles` and provides its abstract `rechain`, `drain_lag`,
+`await_sync` and `assign_weights`.  Nothing here may import gevent.
+"""
+from collections import namedtuple
+import abc
+import inspect as ins
+import logging
+
+
+defaults = dict(redi=['localhost:6379',
+                      'localhost:6380',
+                      'localhost:6381'],
+                redis_proxy='localhost:6666',
+                haproxy_sock='/tmp/redundis-haproxy.sock',
+                ha_backend='redis',
+                ha_prefix='redis-%s')
+
+
+class Logged(object):
+    logger = logging.getLogger('redundis.watcher')
+    info = logger.info
+    warn = logger.warning
+    error = logger.error
+    debug = logger.debug
+
+    def logging_setup(self, loglevel=logging.INFO):
+        logging.basicConfig(level=loglevel,
+                            format='[%(levelname)s] %(message)s')
+
+
+class Snapshot(namedtuple('Snapshot', 'role link offset lag')):
+    """
+    What one `INFO replication` says about an instance: its `role`,
+    the slave's master `link` status, its replication `offset` and
+    seconds of `lag` since it last heard from its master.  An instance
+    that could not be reached has a role of `None`.
+    """
+    @classmethod
+    def from_info(cls, info):
+        role = info.get('role')
+        if role == 'slave':
+            return cls(role, info.get('master_link_status'),
+                       info.get('slave_repl_offset'),
+                       info.get('master_last_io_seconds_ago'))
+        return cls(role, None, info.get('master_repl_offset'), 0)
+
+    @property
+    def up(self):
+        return bool(self.role)
+
+    def __str__(self):
+        if not self.up:
+            return 'down'
+        return "%s link=%s offset=%s lag=%s" % self
+
+Snapshot.down = Snapshot(None, None, None, None)
+
+
+def for_roles(*pattern):
+    """
+    Annotates a function with the chain states (see `classify`) it
+    handles
+    """
+    def register(func):
+        rp = getattr(func, '_role_pattern', None)
+        if rp is None:
+            rp = []
+        rp.extend(pattern)
+        func._role_pattern = rp
+        return func
+    return register
+
+
+def classify(roles):
+    """
+    Names the state of a chain from the roles of its members in chain
+    order, `None` standing for an instance that is down.
+    """
+    up = [role for role in roles if role]
+    if not up:
+        return 'all_down'
+    if len(up) == 1:
+        return 'only_%s' % up[0]
+    masters = up.count('master')
+    if len(up) < len(roles):
+        if not masters:
+            return 'dead_master'
+        if masters > 1:
+            return 'double_master'
+        if up[0] == 'master':
+            return 'dead_slave'
+        return 'flipped_master'
+    if not masters:
+        return 'all_slaves'
+    if up[0] != 'master':
+        return 'reversed'
+    return 'chained'
+
+
+def register_patterns(cls):
+    funcs = [x for x in list(cls.__dict__.values()) \
+             if ins.isroutine(x) and getattr(x, '_role_pattern', False)]
+    mapping = cls._role_patterns = {}
+    for func in funcs:
+        for pattern in func._role_pattern:
+            mapping[pattern] = func.__name__
+    return cls
+
+
+# a base with abstract methods under both Python 2 and 3
+_Engine = abc.ABCMeta('_Engine', (Logged,), {})
+
+
+@register_patterns
+class ChainRoles(_Engine):
+    """
+    The role dispatch table and its handlers.  Handlers reorder
+    `instances` and call on the engine to rechain and weight them.
+    """
+    weights = (150, 1, 0)
+    topologies = ('chain', 'star')
+
+    classify = staticmethod(classify)
+
+    # handlers that promote a slave because the master is gone
+    failover_handlers = ('dead_master', 'only_slave')
+
+    instances = None
+    damper = None
+    name = 'default'
+
+    # slaves left out of the weights of the current dispatch because
+    # their replication was not up in time
+    syncing = frozenset()
+
+    def handler_for(self, roles):
+        """
+        The name of the handler for `roles`, or None for a failover
+        the damper holds back
+        """
+        name = self._role_patterns.get(self.classify(roles), 'default_role_handler')
+        if name in self.failover_handlers and self.damper is not None \
+               and not self.damper.failover():
+            self.warn("%s: failover cap reached, holding chain at %s", self.name, roles)
+            return None
+        return name
+
+    def rejoined(self, inst, up):
+        """
+        Lets the damper know `inst` is back when a probe finds it `up`
+        while its monitor still expects it down.  The monitor is
+        replaced by one expecting it up, so no change would be
+        published and the instance would never be admitted again.
+        """
+        if up and not inst.connected and self.damper is not None:
+            self.damper.returned(inst)
+
+    @abc.abstractmethod
+    def rechain(self, insts, promote=False):
+        """
+        Points each of `insts` at its upstream (see
+        `replication_pairs`), first making the head a master if
+        `promote`
+        """
+
+    @abc.abstractmethod
+    def drain_lag(self, master, slaves):
+        """
+        Gives `slaves` a chance to catch up with the `master` about to
+        be promoted, returning those still behind
+        """
+
+    @abc.abstractmethod
+    def await_sync(self, insts):
+        """
+        Waits for the slaves of `insts` to replicate, leaving those
+        that do not in `syncing`
+        """
+
+    @abc.abstractmethod
+    def assign_weights(self, *insts):
+        """
+        Weights `insts` in chain order and the other instances 0
+        """
+
+    def reconfigure(self, insts, promote=False):
+        """
+        Rechains `insts`, waits for their slaves to replicate, then
+        weights them, leaving out any slave still syncing
+        """
+        self.rechain(insts, promote)
+        self.await_sync(insts)
+        self.assign_weights(*insts)
+
+    def synced(self, insts):
+        """
+        Those of `insts` that may take traffic by their last snapshot:
+        the head, and each slave whose link to its upstream is up when
+        that upstream may take traffic too
+        """
+        ok = set(insts[:1])
+        for inst, upstream in self.replication_pairs(insts):
+            if upstream in ok and inst.snapshot.up and inst.snapshot.link == 'up':
+                ok.add(inst)
+        return [inst for inst in insts if inst in ok]
+
+    def weighted(self, insts):
+        return [inst for inst in insts if inst not in self.syncing]
+
+    def default_role_handler(self, roles):
+        if not any(roles):
+            return self.instances
+        return self.all_up_reversed(roles)
+
+    @for_roles('all_down')
+    def all_down(self, roles):
+        """
+        No instances are up. Do nothing.
+        """
+        return self.instances
+
+    @for_roles('chained')  # normal or initial order, but may need rechain
+    def masterup_fix_chain(self, roles):
+        """
+        A master is in the master position. Chain redis to each
+        other. If not a condition of initialization, an abberation has
+        occurred
+        """
+        self.reconfigure(self.instances)
+        return self.instances
+
+    # likely the result of intermittent network issues.
+    @for_roles('all_slaves')
+    def abberation(self, roles):
+        self.warn("abberation '%s'" %roles)
+        return self.all_up_reversed(roles)
+
+    @for_roles('reversed')
+    def all_up_reversed(self, roles):
+        """
+        Everything is up but the head of the chain is not a master:
+        promote it and chain the rest behind it
+        """
+        self.reconfigure(self.instances, promote=True)
+        return self.instances
+
+    @for_roles('only_master')
+    def only_master(self, roles):
+        self.instances.insert(0, self.instances.pop(roles.index('master')))
+        self.assign_weights(self.instances[0])
+        return self.instances
+
+    @for_roles('only_slave')
+    def only_slave(self, roles):
+        """
+        Promote to master, await return of other redi
+        """
+        self.instances.insert(0, self.instances.pop(roles.index('slave')))
+        self.reconfigure(self.instances[:1], promote=True)
+        return self.instances
+
+    def replication_pairs(self, insts):
+        """
+        Pairs each of `insts` after the first with the instance it
+        should replicate from: its predecessor in a chain, or the
+        head of `insts` in a star.
+        """
+        if self.topology == 'star':
+            return [(inst, insts[0]) for inst in insts[1:]]
+        return list(zip(insts[1:], insts[:-1]))
+
+    @staticmethod
+    def rank_by_offset(insts):
+        """
+        Orders `insts` most caught up first by the replication offset
+        of their last snapshot.  Instances reporting no offset (redis
+        before 2.8) keep their chain order behind those that do.
+        """
+        return sorted(insts, key=lambda inst: -(inst.snapshot.offset or -1))
+
+    def heal(self, roles, rank=False):
+        """
+        Chain the instances that are up in their current order, with
+        those that are down at the caboose.  With `rank`, the most
+        caught up instance is promoted.
+        """
+        survivors = [inst for inst, role in zip(self.instances, roles) if role]
+        offline = [inst for inst, role in zip(self.instances, roles) if not role]
+        if rank:
+            survivors = self.rank_by_offset(survivors)
+            self.drain_lag(survivors[0], survivors[1:])
+        self.instances = survivors + offline
+        self.reconfigure(survivors, promote=True)
+        return self.instances
+
+    @for_roles('dead_master')
+    def dead_master(self, roles):
+        """
+        Promote whichever surviving slave has replicated the most
+        """
+        return self.heal(roles, rank=True)
+
+    @for_roles('dead_slave')
+    def dead_slave(self, roles):
+        """
+        Redi are still down, enforce normal configuration
+        """
+        return self.heal(roles)
+
+    @for_roles('flipped_master')
+    def flipped_master(self, roles):
+        """
+        hypothetically, several redi have gone down and one has returned
+        """
+        return self.heal(roles)
+
+    @for_roles('double_master')
+    def double_master(self, roles):
+        """
+        Several redi up, others lagging to return.  Hypothetically a
+        full failure of all redi or on initialization
+        """
+        return self.heal(roles)
+
+    def weight_for(self, position):
+        """
+        The haproxy weight for the instance at `position` in the
+        chain.  Positions past the end of `weights` take its last.
+        """
+        return self.weights[min(position, len(self.weights) - 1)]
+
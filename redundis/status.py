@@ -0,0 +1,233 @@
+"""
+A one-shot, read-only report of chain health
+
+Every instance is asked for `INFO` over a bare socket and each HAProxy
+stats socket for a `show stat` of all its servers, all at once
+on worker threads, so a report takes about as long as its slowest
+probe and never longer than `timeout`.  Nothing here touches gevent.
+"""
+from . import haproxy
+from . import resp
+from .roles import defaults
+from Queue import Empty
+from Queue import Queue
+from time import time
+import threading
+
+
+class Timeout(Exception):
+    """
+    A call did not finish before the deadline
+    """
+
+
+def in_parallel(calls, timeout, workers=64):
+    """
+    Runs each of `calls` on up to `workers` daemon threads, returning
+    their results in order once all have finished or `timeout` seconds
+    have passed.  A call that raised gives its exception and a call
+    still running at the deadline gives a `Timeout`.
+    """
+    calls = list(calls)
+    out = [Timeout('no answer in %ss' % timeout)] * len(calls)
+    todo, done = Queue(), Queue()
+    for i, call in enumerate(calls):
+        todo.put((i, call))
+
+    def work():
+        while True:
+            try:
+                i, call = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                done.put((i, call()))
+            except Exception, e:
+                done.put((i, e))
+
+    for x in range(min(workers, len(calls))):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+
+    end = time() + timeout
+    for x in range(len(calls)):
+        remaining = end - time()
+        if remaining <= 0:
+            break
+        try:
+            i, result = done.get(timeout=remaining)
+        except Empty:
+            break
+        out[i] = result
+    return out
+
+
+def split_spec(spec):
+    host, port = spec.split(':')
+    return host, int(port)
+
+
+def number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe(spec, timeout):
+    """
+    `INFO` from the instance at `spec` summarised as a dict
+    """
+    start = time()
+    sock = resp.connect(*split_spec(spec), timeout=timeout, keepalive=False)
+    try:
+        sock.sendall(resp.encode('INFO'))
+        fp = sock.makefile('rb')
+        info = resp.parse_info(resp.read_reply(fp))
+        fp.close()
+    finally:
+        sock.close()
+    return summarize(spec, info, time() - start)
+
+
+def summarize(spec, info, latency=None):
+    role = info.get('role')
+    out = dict(instance=spec, role=role, master=None, link=None, lag=None,
+               behind=None, offset=None, error=None,
+               used_memory=number(info.get('used_memory')),
+               clients=number(info.get('connected_clients')),
+               slaves=number(info.get('connected_slaves')),
+               latency=latency)
+    if role == 'slave':
+        out.update(master='%s:%s' %(info.get('master_host'), info.get('master_port')),
+                   link=info.get('master_link_status'),
+                   lag=number(info.get('master_last_io_seconds_ago')),
+                   offset=number(info.get('slave_repl_offset')))
+    else:
+        out.update(offset=number(info.get('master_repl_offset')), lag=0)
+    return out
+
+
+def failed(spec, error):
+    return dict(instance=spec, role=None, error=str(error) or error.__class__.__name__)
+
+
+def fill_behind(rows):
+    """
+    Sets `behind` on each slave whose master was also probed to the
+    bytes of replication it has yet to apply
+    """
+    offsets = dict((row['instance'], row.get('offset')) for row in rows)
+    for row in rows:
+        if row.get('role') == 'master':
+            row['behind'] = 0
+        upstream = offsets.get(row.get('master'))
+        if upstream is not None and row.get('offset') is not None:
+            row['behind'] = max(0, upstream - row['offset'])
+    return rows
+
+
+def read_weights(sock, servers, timeout=1.0):
+    """
+    The weights of `servers`, `(backend, server)` pairs, behind the
+    stats socket `sock` read with one `show stat`, as a dict
+    """
+    session = haproxy.StatsSession(sock, retry=0, timeout=timeout * 1000)
+    try:
+        stats = session.show_stat()
+    finally:
+        session.close()
+    return dict((key, stats[key].weight) for key in servers if key in stats)
+
+
+def cluster_settings(spec):
+    """
+    The instances, stats socket, backend and server name pattern of a
+    cluster from its watcher settings
+    """
+    redi = spec.get('redi') or defaults['redi']
+    if isinstance(redi, basestring):
+        redi = redi.split(',')
+    return (list(redi),
+            spec.get('haproxy_sock') or defaults['haproxy_sock'],
+            spec.get('backend') or spec.get('ha_backend') or defaults['ha_backend'],
+            spec.get('ha_prefix') or defaults['ha_prefix'])
+
+
+def status(clusters, timeout=1.0, workers=64):
+    """
+    Reports on every cluster in `clusters`, a mapping of name to
+    watcher settings.  Returns a dict of cluster name to its rows, one
+    per instance, and the seconds the whole report took.
+    """
+    start = time()
+    settings = dict((name, cluster_settings(spec)) for name, spec in clusters.items())
+
+    specs = sorted(set(spec for redi, _, _, _ in settings.values() for spec in redi))
+    servers = {}
+    for redi, sock, backend, prefix in settings.values():
+        servers.setdefault(sock, set()).update(
+            (backend, prefix % split_spec(spec)[1]) for spec in redi)
+    socks = sorted(servers)
+    for sock in socks:
+        servers[sock] = sorted(servers[sock])
+
+    calls = [lambda spec=spec: probe(spec, timeout) for spec in specs] + \
+            [lambda sock=sock: read_weights(sock, servers[sock], timeout) for sock in socks]
+    results = in_parallel(calls, timeout, workers)
+
+    rows = {}
+    for spec, result in zip(specs, results):
+        rows[spec] = isinstance(result, Exception) and failed(spec, result) or result
+    fill_behind(rows.values())
+    weights = dict(zip(socks, results[len(specs):]))
+
+    out = {}
+    for name, (redi, sock, backend, prefix) in sorted(settings.items()):
+        found = weights[sock]
+        out[name] = []
+        for spec in redi:
+            row = dict(rows[spec])
+            if isinstance(found, Exception):
+                row['weight'] = None
+                row['haproxy_error'] = str(found) or found.__class__.__name__
+            else:
+                row['weight'] = found.get((backend, prefix % split_spec(spec)[1]))
+            out[name].append(row)
+    return out, time() - start
+
+
+columns = (('instance', '%s'), ('role', '%s'), ('master', '%s'), ('link', '%s'),
+           ('lag', '%s'), ('behind', '%s'), ('used_memory', '%s'), ('clients', '%s'),
+           ('weight', '%s'), ('latency', '%.1f'), ('error', '%s'))
+
+
+def cell(row, key, fmt):
+    value = row.get(key)
+    if value is None:
+        return key == 'role' and 'down' or '-'
+    if key == 'latency':
+        value = value * 1000
+    return fmt % value
+
+
+def table(report):
+    """
+    `report` as lines of fixed width text, one line per instance
+    """
+    head = ['cluster'] + [key == 'latency' and 'ms' or key for key, _ in columns]
+    lines = [head]
+    for name, rows in sorted(report.items()):
+        for row in rows:
+            lines.append([name] + [cell(row, key, fmt) for key, fmt in columns])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(head))]
+    return ['  '.join(x.ljust(w) for x, w in zip(line, widths)).rstrip() for line in lines]
+
+
+def healthy(report):
+    """
+    Whether every instance answered and every weight was read
+    """
+    return all(row.get('role') and row.get('weight') is not None \
+               for rows in report.values() for row in rows)
@@ -0,0 +1,93 @@
+import unittest
+
+
+class TestFakes(unittest.TestCase):
+
+    def setUp(self):
+        from redundis import green
+        green.patch()
+
+    def test_session_against_fake_haproxy(self):
+        from redundis import fakes
+        from redundis import haproxy
+        ha = fakes.FakeHAProxy([('redis-1', 0), ('redis-2', 0)]).start()
+        try:
+            session = haproxy.StatsSession(ha.path)
+            out = session.set_weights('redis', [('redis-1', 150), ('redis-2', 1)])
+            assert out == ['150 (initial 0)', '1 (initial 0)'], out
+            assert [x[1:] for x in ha.history] == [('redis-1', 150), ('redis-2', 1)]
+            session.close()
+        finally:
+            ha.stop()
+
+    def test_show_stat_against_fake_haproxy(self):
+        from redundis import fakes
+        from redundis import haproxy
+        ha = fakes.FakeHAProxy([('redis-1', 150), ('redis-2', 0)]).start()
+        try:
+            for stats in haproxy.StatsSocket(ha.path), haproxy.StatsSession(ha.path):
+                out = stats.show_stat('redis')
+                assert dict((k, v.weight) for k, v in out.items()) == \
+                       {'redis-1': 150, 'redis-2': 0}, out
+            stats.close()
+        finally:
+            ha.stop()
+
+    def test_fake_redis_slaveof(self):
+        import redis
+        from redundis import fakes
+        master, slave = fakes.FakeRedis().start(), fakes.FakeRedis().start()
+        try:
+            client = redis.StrictRedis(port=slave.port)
+            client.slaveof(master.host, master.port)
+            info = client.info('replication')
+            assert info['role'] == 'slave'
+            assert info['master_link_status'] == 'up'
+            master.kill()
+            assert client.info('replication')['master_link_status'] == 'down'
+        finally:
+            master.stop()
+            slave.stop()
+
+    def test_fake_proxy_follows_weights(self):
+        import redis
+        from redundis import fakes
+        master, slave = fakes.FakeRedis().start(), fakes.FakeRedis().start()
+        servers = dict(('redis-%s' % r.port, r) for r in (master, slave))
+        ha = fakes.FakeHAProxy([(name, 0) for name in servers]).start()
+        proxy = fakes.FakeProxy(ha, servers).start()
+        try:
+            client = redis.StrictRedis(port=proxy.port, socket_timeout=1)
+            self.assertRaises(redis.ConnectionError, client.ping)
+            ha.weights[('redis', 'redis-%s' % slave.port)] = 150
+            client.connection_pool.disconnect()
+            slave.execute(['SLAVEOF', master.host, str(master.port)])
+            self.assertRaises(redis.ResponseError, client.set, 'key', 'value')
+            slave.execute(['SLAVEOF', 'NO', 'ONE'])
+            assert client.set('key', 'value')
+            assert client.get('key') == 'value'
+            assert slave.data == {'key': 'value'}
+        finally:
+            for x in (proxy, ha, master, slave):
+                x.stop()
+
+
+class TestFailoverBench(unittest.TestCase):
+
+    def setUp(self):
+        from redundis import green
+        green.patch()
+
+    def test_kill(self):
+        from redundis import bench
+        fb = bench.FailoverBench(runs=2, failure='kill', timeout=5)
+        report = fb.run()
+        assert report['missed'] == 0, report
+        assert 0 < report['total']['p50'] < 5, report
+
+    def test_percentile(self):
+        from redundis.bench import percentile
+        values = range(1, 101)
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([], 50) is None
@@ -0,0 +1,57 @@
+from mock import Mock
+import unittest
+
+
+class TestChaos(unittest.TestCase):
+
+    def makeone(self, **kw):
+        from redundis.chaos import Chaos
+        kw.setdefault('duration', 1.0)
+        kw.setdefault('every', 0.4)
+        return Chaos('127.0.0.1:1', {}, Mock(), **kw)
+
+    def test_schedule(self):
+        chaos = self.makeone(faults=('kill', 'hang'))
+        assert chaos.schedule() == [(0.4, 'kill'), (0.8, 'hang')]
+
+    def test_outage(self):
+        chaos = self.makeone()
+        chaos.buckets = {4: [10, 0, []], 5: [0, 0, []], 6: [5, 3, []], 7: [10, 0, []],
+                        8: [10, 0, []], 9: [10, 0, []]}
+        assert round(chaos.outage(0.4, 1.0), 6) == 0.3
+        assert chaos.outage(0.7, 1.0) == 0.0
+
+    def test_partition_needs_client_pause(self):
+        from mock import patch
+        from path import path
+        from redundis.chaos import Chaos
+        from redundis.chaos import Member
+        from redundis.cluster import ClusterError
+        from redundis.cluster import LocalCluster
+        import tempfile
+        root = path(tempfile.mkdtemp())
+        try:
+            LocalCluster(root, size=2, haproxy_sock=root / 'ha.sock').save([])
+            with patch.object(Member, 'version', return_value='2.4.11'):
+                self.assertRaises(ClusterError, Chaos.local, root, faults=('kill', 'partition'))
+                assert Chaos.local(root, faults=('kill',)).members[6379].port == 6379
+            with patch.object(Member, 'version', return_value='3.0.7'):
+                assert Chaos.local(root, faults=('partition',))
+        finally:
+            root.rmtree()
+
+    def test_fakes(self):
+        from redundis import green
+        green.patch()
+        from redundis.chaos import Chaos
+        chaos = Chaos.fakes(duration=1.2, every=0.5, heal_after=0.3, workers=4,
+                            faults=('kill', 'hang'), watcher_args=dict(probe_timeout=0.5))
+        report = chaos.run()
+        assert report['ops'] > 0, report
+        kill, hang = report['faults']
+        assert (kill['fault'], hang['fault']) == ('kill', 'hang')
+        assert kill['dispatch'] is not None and kill['weights'] is not None, kill
+        assert kill['outage'] < 0.5, kill
+        assert len(report['timeline']) == 12
+        assert [e['event'] for e in report['events'] if e['event'] in ('kill', 'hang', 'heal')] == \
+               ['kill', 'heal', 'hang', 'heal']
@@ -0,0 +1,137 @@
+from mock import Mock
+from path import path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+class TestLocalCluster(unittest.TestCase):
+
+    def setUp(self):
+        self.root = path(tempfile.mkdtemp())
+        self.sock = self.root / 'haproxy.sock'
+
+    def tearDown(self):
+        self.root.rmtree()
+
+    def makeone(self, **kw):
+        from redundis.cluster import LocalCluster
+        kw.setdefault('haproxy_sock', str(self.sock))
+        return LocalCluster(self.root, **kw)
+
+    def test_defaults_match_the_watcher(self):
+        from redundis.roles import defaults
+        chain, = self.makeone().layout()
+        assert chain['redi'] == defaults['redi']
+        assert chain['backend'] == defaults['ha_backend']
+        assert chain['ha_prefix'] == defaults['ha_prefix']
+        assert chain['redis_proxy'] == defaults['redis_proxy']
+
+    def test_chains_get_their_own_ports_and_backend(self):
+        first, second = self.makeone(chains=2, size=2).layout()
+        assert first['redi'] == ['localhost:6379', 'localhost:6380']
+        assert second['redi'] == ['localhost:6381', 'localhost:6382']
+        assert second['backend'] == 'redis1'
+        assert second['redis_proxy'] == 'localhost:6667'
+
+    def test_write(self):
+        from redundis import config
+        procs = self.makeone(redis_server='redis-server', haproxy_bin='haproxy').write()
+        assert [name for name, _, _ in procs] == ['redis-6379', 'redis-6380', 'redis-6381', 'haproxy']
+        assert procs[0][1] == ['redis-server', self.root / 'redis-6379.conf']
+
+        conf = config.redis_conf_to_dict(self.root / 'redis-6380.conf')
+        assert conf['port'] == '6380'
+        assert conf['daemonize'] == 'no'
+        assert conf['slaveof'] == '127.0.0.1 6379'
+        assert 'slaveof' not in config.redis_conf_to_dict(self.root / 'redis-6379.conf')
+
+        ha = (self.root / 'haproxy.cfg').text()
+        assert 'stats socket %s level admin' % self.sock in ha
+        assert 'bind 127.0.0.1:6666' in ha
+        assert 'server redis-6379 127.0.0.1:6379 check inter 500 weight 150' in ha
+        assert 'server redis-6381 127.0.0.1:6381 check inter 500 weight 0' in ha
+
+    def test_watcher_config(self):
+        from redundis import config
+        cluster = self.makeone(chains=2)
+        cluster.write()
+        with open(self.root / 'clusters.yml') as stream:
+            settings, clusters = config.load_clusters(stream)
+        assert settings == dict(haproxy_sock=self.sock)
+        assert sorted(clusters) == ['redis', 'redis1']
+        assert clusters['redis1']['redi'] == ['localhost:6382', 'localhost:6383', 'localhost:6384']
+
+    def test_template(self):
+        template = path(__file__).parent.parent / 'etc' / '1.redis.conf'
+        conf = self.makeone(template=template).redis_conf(6400)
+        assert conf['port'] == '6400'
+        assert conf['dir'] == self.root
+        assert not [key for key in conf if key.startswith('vm-') or key == 'logfile']
+
+    def test_process_exits(self):
+        from redundis.cluster import ClusterError
+        from redundis.cluster import LocalCluster
+        cluster = self.makeone(size=1, redis_server=sys.executable, haproxy_bin=sys.executable)
+        self.assertRaises(ClusterError, cluster.up, 5)
+        assert LocalCluster.state(self.root) is None
+
+    sleep = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+    def test_down(self):
+        from redundis.cluster import LocalCluster
+        from redundis.cluster import alive
+        from redundis.cluster import spawn
+        cluster = self.makeone(size=1)
+        sleeper = spawn(self.sleep, self.root / 'redis-6379.log')
+        cluster.save([('redis-6379', sleeper, self.sleep, self.root / 'redis-6379.log')])
+        self.sock.write_text('')
+        assert LocalCluster.down(self.root) == ['redis-6379']
+        assert not alive(sleeper.pid)
+        assert LocalCluster.state(self.root) is None
+        assert not self.sock.exists()
+        assert LocalCluster.down(self.root) == []
+
+    def test_down_leaves_reused_pids_alone(self):
+        from redundis.cluster import LocalCluster
+        from redundis.cluster import alive
+        from redundis.cluster import spawn
+        cluster = self.makeone(size=2)
+        log = self.root / 'other.log'
+        others = [subprocess.Popen(self.sleep), spawn(self.sleep, log)]
+        try:
+            cluster.save([('redis-6379', others[0], self.sleep, log),
+                          ('redis-6380', others[1], ['redis-server', 'redis-6380.conf'], log)])
+            assert LocalCluster.down(self.root) == []
+            assert all(alive(other.pid) for other in others)
+            assert LocalCluster.state(self.root) is None
+        finally:
+            for other in others:
+                other.kill()
+                other.wait()
+
+    def test_respawn(self):
+        from redundis.cluster import ClusterError
+        from redundis.cluster import LocalCluster
+        cluster = self.makeone(size=1)
+        cluster.save([('redis-6379', Mock(pid=1 << 22), self.sleep, self.root / 'redis-6379.log')])
+        started = LocalCluster.respawn(self.root, 'redis-6379')
+        try:
+            proc, = LocalCluster.state(self.root)['procs']
+            assert proc['pid'] == proc['pgid'] == started.pid
+            self.assertRaises(ClusterError, LocalCluster.respawn, self.root, 'redis-6380')
+        finally:
+            LocalCluster.down(self.root)
+
+    def test_refuses_to_start_twice(self):
+        from redundis.cluster import ClusterError
+        from redundis.cluster import spawn
+        cluster = self.makeone(size=1)
+        sleeper = spawn(self.sleep, self.root / 'redis-6379.log')
+        try:
+            cluster.save([('redis-6379', sleeper, self.sleep, self.root / 'redis-6379.log')])
+            self.assertRaises(ClusterError, cluster.up, 1)
+        finally:
+            sleeper.kill()
+            sleeper.wait()
@@ -0,0 +1,65 @@
+from mock import Mock
+import subprocess
+import sys
+import unittest
+
+
+def run_python(code):
+    return subprocess.check_output([sys.executable, '-c', code]).strip()
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_cli_import_is_light(self):
+        out = run_python("import sys, redundis.cli, redundis.commands;"
+                         "print([m for m in ('gevent', 'redis', 'yaml', 'requests', 'stuf',"
+                         " 'redundis.watcher') if m in sys.modules])")
+        assert out == '[]', out
+
+    def test_watcher_import_does_not_patch(self):
+        out = run_python("import redundis.watcher, gevent.monkey;"
+                         "print(gevent.monkey.is_module_patched('socket'))")
+        assert out == 'False', out
+
+    def test_version_looked_up_only_when_asked(self):
+        from mock import patch
+        from redundis import cli
+        with patch.object(cli, 'version', return_value='1.2') as version:
+            app = cli.Dundis()
+            assert not version.called
+            with patch.object(app.parser, 'exit', side_effect=SystemExit) as exit:
+                self.assertRaises(SystemExit, app.parser.parse_known_args, ['--version'])
+            version.assert_called_once_with()
+            exit.assert_called_once_with(message='%s 1.2\n' % app.parser.prog)
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_parser_defaults(self):
+        from redundis import commands
+
+        class Watch(commands.Watch):
+            take_action = Mock()
+
+        args = Watch(Mock(), None).get_parser('watch').parse_args([])
+        assert args.redi == 'localhost:6379,localhost:6380,localhost:6381'
+        assert args.topology == 'chain'
+
+
+class TestCluster(unittest.TestCase):
+
+    def test_down_without_a_cluster(self):
+        from redundis import commands
+        import shutil
+        import tempfile
+
+        class Cluster(commands.Cluster):
+            take_action = Mock()
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        command = Cluster(Mock(), None)
+        args = command.get_parser('cluster').parse_args(['down', '--root', root])
+        assert args.chains == 1 and args.size == 3
+        command.run(args)
+        assert not command.app.stdout.write.called
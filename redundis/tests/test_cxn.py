@@ -46,6 +46,134 @@ class TestConnection(unittest.TestCase):
 class TestConnectionPool(unittest.TestCase):
     """
     exercise the ConnectionPool
+
+    CAVEAT!!! assumes ports 0 and 1 are not available to test process.
     """
-    def makeone(self):
-        pass
+    def makeone(self, **kw):
+        from redundis import cxn
+        kw.setdefault('candidates', [dict(port=0), dict(port=1)])
+        return cxn.ConnectionPool(**kw)
+
+    def test_candidates(self):
+        pool = self.makeone()
+        assert [c['port'] for c in pool.candidates] == [0, 1]
+        assert pool.connection_kwargs['port'] == 0
+        assert pool.make_connection().failure_callback == pool.callback
+
+    @tools.raises(redis.ConnectionError)
+    def test_all_candidates_down(self):
+        pool = self.makeone(retry=1)
+        pool.get_connection('PING').connect()
+
+    def test_failover_moves_connection(self):
+        pool = self.makeone()
+        cxn = pool.make_connection()
+        with mock.patch.object(cxn, 'connect') as connect:
+            pool.manage_failover(cxn)
+        assert connect.called
+        assert cxn.port == 1
+        assert cxn.depth == 1
+        assert pool.primary['port'] == 1
+        assert pool.health[('localhost', 0)].failures == 1
+
+    def test_rank_prefers_healthy_master(self):
+        pool = self.makeone(candidates=[dict(port=0), dict(port=1), dict(port=2)])
+        idle = pool.get_connection('PING')
+        busy = pool.get_connection('PING')
+        pool.release(idle)
+        h0, h1, h2 = pool.health_of(pool.candidates)
+        h0.observe(False)
+        h1.observe(True, 0.001, 'slave')
+        h2.observe(True, 0.002, 'master')
+        assert pool.rank()['port'] == 2
+        assert [c['port'] for c in pool.candidates] == [2, 1, 0]
+        assert pool.generation == 1
+        # connections move to the new primary only as they pass through
+        # get_connection or release, never under another thread
+        assert idle.port == 0 and busy.port == 0
+        assert pool.get_connection('PING') is idle
+        assert idle.port == 2 and idle.generation == 1
+        pool.release(busy)
+        assert busy.port == 2
+
+    def test_probe_refused(self):
+        from redundis import cxn
+        prober = cxn.HealthProber(self.makeone(), timeout=0.1)
+        assert prober.probe(dict(host='localhost', port=0)) == (False, None, None, None)
+
+
+class TestReadWritePool(unittest.TestCase):
+
+    def makeone(self, **kw):
+        from redundis import cxn
+        pool = cxn.ReadWritePool(candidates=[dict(port=0), dict(port=1), dict(port=2)], **kw)
+        pool.update_topology(dict(master='localhost:0',
+                                  chain=['localhost:0', 'localhost:1', 'localhost:2'],
+                                  lag={'localhost:1': 0, 'localhost:2': 5}))
+        return pool
+
+    def test_update_topology(self):
+        pool = self.makeone()
+        pool.update_topology(dict(master='localhost:2', chain=['localhost:2', 'localhost:1', 'localhost:0'],
+                                  down=['localhost:0']))
+        assert pool.primary['port'] == 2
+        assert pool.generation == 1
+        assert not pool.health[('localhost', 0)].up
+
+    def test_reads_to_fresh_slaves(self):
+        pool = self.makeone()
+        read = pool.get_connection('GET')
+        write = pool.get_connection('SET')
+        assert (read.port, read.replica) == (1, ('localhost', 1))
+        assert (write.port, write.replica) == (0, None)
+        pool.release(read)
+        pool.release(write)
+        assert pool.replicas[('localhost', 1)]._available_connections == [read]
+        assert pool._available_connections == [write]
+
+    def test_lag_bound(self):
+        pool = self.makeone(max_lag=10)
+        ports = set(pool.get_connection('GET').port for x in range(4))
+        assert ports == set([1, 2])
+
+    def test_pinned(self):
+        pool = self.makeone()
+        with pool.pinned():
+            assert pool.get_connection('GET').port == 0
+        assert pool.get_connection('GET').port == 1
+
+    def test_read_your_writes(self):
+        pool = self.makeone(stick_for=60)
+        pool.get_connection('SET')
+        assert pool.get_connection('GET').port == 0
+
+    def test_topology_lag_ages(self):
+        pool = self.makeone(max_lag=10)
+        with mock.patch('redundis.cxn.time', return_value=pool.health[('localhost', 2)].checked + 6):
+            assert set(pool.get_connection('GET').port for x in range(4)) == set([1])
+        pool.update_topology(dict(master='localhost:0',
+                                  chain=['localhost:0', 'localhost:1', 'localhost:2'],
+                                  lag={'localhost:1': None, 'localhost:2': 5}))
+        assert set(pool.get_connection('GET').port for x in range(4)) == set([2])
+
+    def test_failed_slave_falls_back(self):
+        from redundis import cxn
+        pool = self.makeone()
+        def connect(self):
+            if self.port == 1:
+                raise cxn.ConnectionError('refused')
+        read = pool.get_connection('GET')
+        with mock.patch.object(cxn.BaseCxn, 'connect', connect):
+            read.connect()
+        assert (read.port, read.replica) == (0, ('localhost', 1))
+        assert not pool.health[('localhost', 1)].up
+        pool.release(read)
+        assert read.port == 1
+        assert pool.replicas[('localhost', 1)]._available_connections == [read]
+        assert pool.get_connection('GET').port == 0
+
+    def test_no_fresh_slave(self):
+        pool = self.makeone(max_lag=0)
+        pool.update_topology(dict(master='localhost:0', chain=['localhost:0', 'localhost:1'],
+                                  down=['localhost:1']))
+        assert pool.get_connection('GET').port == 0
@@ -0,0 +1,52 @@
+import unittest
+
+
+class TestDamper(unittest.TestCase):
+
+    def makeone(self, **kw):
+        from redundis import damping
+        return damping.Damper(**kw)
+
+    def test_unknown_admitted(self):
+        d = self.makeone()
+        assert d.admit('r1', 100.0)
+        assert d.next_review(100.0) is None
+
+    def test_stable_for(self):
+        d = self.makeone(stable_for=5)
+        d.record('r1', False, 100.0)
+        assert not d.admit('r1', 101.0)
+        d.record('r1', True, 102.0)
+        assert not d.admit('r1', 104.0)
+        assert d.next_review(104.0) == 3.0
+        assert d.admit('r1', 107.0)
+
+    def test_returned(self):
+        d = self.makeone(stable_for=5)
+        d.returned('r1', 100.0)
+        assert 'r1' not in d.state
+        d.record('r1', False, 100.0)
+        d.returned('r1', 101.0)
+        d.returned('r1', 103.0)
+        assert d.next_review(104.0) == 2.0
+        assert d.admit('r1', 106.0)
+
+    def test_suppress_and_reuse(self):
+        d = self.makeone(half_life=10, suppress=2.5, reuse=1, stable_for=0)
+        for t in (100.0, 100.5, 101.0):
+            d.record('r1', False, t)
+            d.record('r1', True, t + 0.1)
+        assert d.state['r1'].suppressed
+        assert not d.admit('r1', 102.0)
+        review = d.next_review(102.0)
+        assert 14 < review < 15, review
+        assert d.admit('r1', 102.0 + review + 0.01)
+        assert not d.state['r1'].suppressed
+
+    def test_failover_cap(self):
+        d = self.makeone(max_failovers=2, failover_window=60)
+        assert d.failover(100.0)
+        assert d.failover(110.0)
+        assert not d.failover(120.0)
+        assert d.next_review(120.0) == 40.0
+        assert d.failover(160.0)
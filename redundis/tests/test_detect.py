@@ -0,0 +1,48 @@
+from mock import patch
+import unittest
+
+
+class TestHeartbeat(unittest.TestCase):
+
+    def makeone(self, **kw):
+        from redundis import detect
+        return detect.Heartbeat('localhost', 0, **kw)
+
+    def test_down_after_misses(self):
+        hb = self.makeone(misses=3)
+        assert hb.observe(True, 0.0)
+        assert hb.observe(False, 0.5)
+        assert hb.observe(False, 1.0)
+        assert not hb.observe(False, 1.5)
+        assert hb.latency == 1.5
+
+    def test_up_on_first_answer(self):
+        hb = self.makeone(misses=1)
+        assert not hb.observe(False, 0.0)
+        assert hb.observe(True, 0.5)
+
+    def test_refused_beat(self):
+        hb = self.makeone(timeout=0.1)
+        assert hb.beat() is False
+        assert hb.sock is None
+
+    def test_wait_for(self):
+        hb = self.makeone(interval=0, misses=2)
+        with patch.object(hb, 'beat', return_value=False) as beat:
+            assert hb.wait_for(False) is False
+        assert beat.call_count == 2
+
+
+class TestPhiAccrual(unittest.TestCase):
+
+    def makeone(self, **kw):
+        from redundis import detect
+        return detect.PhiAccrual('localhost', 0, **kw)
+
+    def test_suspicion_grows(self):
+        phi = self.makeone(interval=0.5, threshold=8.0)
+        for i in range(10):
+            assert phi.observe(True, i * 0.5)
+        assert phi.observe(False, 5.0)
+        assert phi.phi(5.0) < phi.phi(5.5)
+        assert not phi.observe(False, 6.0)
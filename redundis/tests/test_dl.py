@@ -1,6 +1,7 @@
 from mock import Mock
 from mock import patch
 from path import path
+import hashlib
 import tempfile
 import unittest
 
@@ -17,21 +18,68 @@ class TestDL(unittest.TestCase):
         from redundis import utils
         return utils.Downloader(cache=cache)
 
+    def response(self, data, **headers):
+        resp = Mock(name='response')
+        resp.headers = headers
+        resp.iter_content.side_effect = lambda size: [data[i:i + size] \
+                                                      for i in range(0, len(data), size)]
+        return resp
+
     def test_downloader(self):
         dl = self.makeone()
+        dl.chunk_size = 100
+        data = self.fake.bytes()
         with patch.object(dl, 'GET') as get:
-            get.return_value = Mock(name='response')
-            get.return_value.content = self.fake.bytes()
+            get.return_value = self.response(data, **{'content-length': str(len(data))})
             out = dl.download(self.url)
-            
+        get.assert_called_once_with(self.url, stream=True)
         assert out.exists()
-        assert out.bytes() == self.fake.bytes()
+        assert out.bytes() == data
+        entry = dl.manifest[self.url]
+        assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+        assert entry['size'] == len(data)
+        assert self.makeone().cached(self.url) == out
+
+    def test_truncated_download_not_cached(self):
+        from redundis import utils
+        dl = self.makeone()
+        data = self.fake.bytes()
+        with patch.object(dl, 'GET') as get:
+            get.return_value = self.response(data[:10], **{'content-length': str(len(data))})
+            self.assertRaises(utils.DownloadError, dl.download, self.url)
+        assert dl.cached(self.url) is None
+        assert dl.cache.files() == []
+
+    def test_checksum_mismatch(self):
+        from redundis import utils
+        dl = self.makeone()
+        with patch.object(dl, 'GET') as get:
+            get.return_value = self.response(self.fake.bytes())
+            self.assertRaises(utils.DownloadError, dl.download, self.url, sha256='0' * 64)
+        assert dl.cached(self.url) is None
+
+    def test_fetch_all(self):
+        dl = self.makeone()
+        urls = [self.url, self.url + '?other']
+        with patch.object(dl, 'GET') as get:
+            get.side_effect = lambda url, stream: self.response(url)
+            out = dl.fetch_all(urls)
+        assert [x.bytes() for x in out] == urls
+        assert sorted(dl.manifest) == sorted(urls)
 
     def place_file(self, dl):
         thefile = dl.cache / dl.quote(self.url)
         thefile.write_text(self.fake.bytes())
+        dl.record(self.url, thefile, hashlib.sha256(self.fake.bytes()).hexdigest(),
+                  thefile.getsize())
         return thefile
 
+    def test_changed_file_is_a_miss(self):
+        dl = self.makeone()
+        thefile = self.place_file(dl)
+        thefile.write_text('short')
+        assert dl.cached(self.url) is None
+
     def test_cache_hit(self):
         dl = self.makeone()
         self.place_file(dl)
@@ -54,3 +102,63 @@ class TestDL(unittest.TestCase):
         assert out.isdir()
         assert (out / 'README').exists()
 
+    def test_unpack_to_replaces_old_tree(self):
+        dl = self.makeone()
+        thefile = self.place_file(dl)
+        dest = self.cache / 'out-stale'
+        dest.makedirs()
+        (dest / 'stale.o').write_bytes('old')
+        out = dl.unpack_to(thefile, dest)
+        assert (out / 'README').exists()
+        assert not (out / 'stale.o').exists()
+        (out / 'stale.o').write_bytes('old')
+        assert dl.unpack_to(thefile, dest, overwrite=False) == dest
+        assert (out / 'stale.o').exists()
+
+    def test_unpack_skips_escaping_members(self):
+        import tarfile
+        dl = self.makeone()
+        thefile = self.cache / 'evil.tar.gz'
+        with tarfile.open(thefile, mode='w:gz') as archive:
+            archive.add(self.fake, arcname='pkg/wee.tar.gz')
+            archive.add(self.fake, arcname='pkg/../../escaped')
+        out = dl.unpack_to(thefile, self.cache / 'evil-out')
+        assert (out / 'pkg' / 'wee.tar.gz').exists()
+        assert not (self.cache / 'escaped').exists()
+        assert not (self.cache.parent / 'escaped').exists()
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.root.rmtree()
+
+    def makeone(self):
+        from redundis import utils
+        return utils.BuildCache(self.root / 'builds')
+
+    def test_key(self):
+        builds = self.makeone()
+        key = builds.key('abc', ['sh:make'], 'Linux-x86_64')
+        assert key == builds.key('abc', ['sh:make'], 'Linux-x86_64')
+        assert key != builds.key('abd', ['sh:make'], 'Linux-x86_64')
+        assert key != builds.key('abc', ['sh:make TARGET=generic'], 'Linux-x86_64')
+        assert key != builds.key('abc', ['sh:make'], 'Darwin-arm64')
+
+    def test_store_and_restore(self):
+        builds = self.makeone()
+        binary = self.root / 'redis-server'
+        binary.write_bytes('ELF')
+        binary.chmod(0755)
+        assert builds.restore('k', self.root / 'bin') is None
+        builds.store('k', [binary])
+        builds.store('k', [binary])
+        out = builds.restore('k', self.root / 'bin')
+        assert out == [self.root / 'bin' / 'redis-server']
+        assert out[0].bytes() == 'ELF'
+        assert out[0].stat().st_mode & 0111
+        assert [x.name for x in builds.root.dirs()] == ['k']
+
@@ -0,0 +1,195 @@
+from mock import Mock
+from mock import patch
+from time import time
+import unittest
+
+
+class FakeClient(object):
+    """
+    Stands in for the stats socket, replaying `chunks` on recv
+    """
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv_into(self, buf):
+        chunk = self.chunks and self.chunks.pop(0) or ''
+        if len(chunk) > len(buf):
+            chunk, rest = chunk[:len(buf)], chunk[len(buf):]
+            self.chunks.insert(0, rest)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        pass
+
+
+class TestStatsSession(unittest.TestCase):
+
+    def makeone(self, client):
+        from redundis import haproxy
+        session = haproxy.StatsSession('/tmp/no-such.sock')
+        session.client = client
+        return session
+
+    def test_pipelined_write(self):
+        client = FakeClient('\n> 150 (initial 150)\n\n> ', '\n> 1 (initial 1)\n\n> ')
+        session = self.makeone(client)
+        out = session.set_weights('redis', [('redis-6379', 150),
+                                            ('redis-6380', 1)])
+        assert out == ['150 (initial 150)', '1 (initial 1)'], out
+        assert len(client.sent) == 1
+        assert client.sent[0] == ('set weight redis/redis-6379 150\n'
+                                  'get weight redis/redis-6379\n'
+                                  'set weight redis/redis-6380 1\n'
+                                  'get weight redis/redis-6380\n')
+
+    def test_split_prompt(self):
+        client = FakeClient('0 (initial 0)\n', '\n', '> ')
+        session = self.makeone(client)
+        assert session.execute('get weight', 'redis/redis-6381') == '0 (initial 0)\n'
+
+    def test_reconnect(self):
+        session = self.makeone(FakeClient())
+        fresh = FakeClient('1 (initial 1)\n\n> ')
+
+        def connect(deadline=None):
+            session.client = fresh
+        with patch.object(session, 'connect', Mock(side_effect=connect)) as cxn:
+            out = session.get_weights('redis', ['redis-6380'])
+        assert cxn.called
+        assert out == ['1 (initial 1)']
+
+
+class TestDeadlines(unittest.TestCase):
+
+    def setUp(self):
+        import socket
+        import tempfile
+        self.path = tempfile.mktemp(prefix='redundis-', suffix='.sock')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(4)
+
+    def tearDown(self):
+        import os
+        self.listener.close()
+        os.remove(self.path)
+
+    def test_wedged_haproxy_times_out(self):
+        from redundis import haproxy
+        for stats in (haproxy.StatsSocket(self.path, timeout=50),
+                      haproxy.StatsSession(self.path, timeout=50)):
+            start = time()
+            self.assertRaises(haproxy.StatsTimeout, stats.get_weights, 'redis', ['redis-6379'])
+            assert time() - start < 0.5
+
+    def test_timeout_is_a_stats_error(self):
+        from redundis import haproxy
+        assert issubclass(haproxy.StatsTimeout, haproxy.StatsError)
+        assert issubclass(haproxy.StatsError, IOError)
+
+
+class TestShowStat(unittest.TestCase):
+
+    header = ('# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,ereq,'
+              'econ,eresp,wretr,wredis,status,weight,act,bck,chkfail,chkdown,lastchg,'
+              'downtime,qlimit,pid,iid,sid,throttle,lbtot,tracked,type,rate,rate_lim,'
+              'rate_max,check_status,\n')
+
+    def makeone(self, client):
+        from redundis import haproxy
+        session = haproxy.StatsSession('/tmp/no-such.sock')
+        session.client = client
+        return session
+
+    def row(self, server, status, weight, scur=0, qcur=0, check='L4OK'):
+        cols = ['redis', server, str(qcur), '0', str(scur)] + [''] * 12 + \
+               [status, str(weight)] + [''] * 17 + [check, '']
+        return ','.join(cols) + '\n'
+
+    def test_parse_stat(self):
+        from redundis import haproxy
+        text = self.header + self.row('redis-6379', 'UP', 150, scur=12, qcur=2) + \
+               self.row('redis-6380', 'DOWN', 1, check='L4CON') + \
+               self.row('BACKEND', 'UP', 151) + '\n'
+        out = list(haproxy.parse_stat(text.split('\n')))
+        assert out == [haproxy.ServerStat('redis', 'redis-6379', 'UP', 150, 12, 2, 'L4OK'),
+                       haproxy.ServerStat('redis', 'redis-6380', 'DOWN', 1, 0, 0, 'L4CON')], out
+
+    def test_check_passed(self):
+        from redundis import haproxy
+        stat = lambda status, check: haproxy.ServerStat('redis', 'redis-6379', status,
+                                                        1, 0, 0, check)
+        assert haproxy.check_passed(stat('UP', 'L7OK'))
+        assert haproxy.check_passed(stat('UP 1/3', '* L7OK'))
+        assert haproxy.check_passed(stat('UP', 'L4OK')) is None
+        assert haproxy.check_passed(stat('DOWN', 'L4CON')) is False
+        assert haproxy.check_passed(stat('no check', '')) is None
+        assert haproxy.check_passed(stat('MAINT', 'L4CON')) is None
+        assert haproxy.check_passed(None) is None
+
+    def test_buffer_lines(self):
+        from redundis import haproxy
+        buff = haproxy.Buffer(size=8)
+        client = FakeClient('a,b', ',c\nd,', 'e\n', '\nfghijklmnop')
+        out = []
+        while buff.recv(client, time() + 1):
+            out.extend(buff.lines())
+        assert out == ['a,b,c', 'd,e', ''], out
+        assert buff.take(len(buff)) == 'fghijklmnop'
+
+    def test_streamed_session(self):
+        text = self.header + self.row('redis-6379', 'UP', 150) + self.row('redis-6380', 'UP', 1)
+        client = FakeClient(text[:50], text[50:130], text[130:] + '\n', '> ')
+        session = self.makeone(client)
+        out = session.show_stat('redis')
+        assert sorted(out) == ['redis-6379', 'redis-6380']
+        assert out['redis-6379'].weight == 150
+        assert client.sent == ['show stat -1 4 -1\n']
+        assert session.cached_weights('redis') == {'redis-6379': 150, 'redis-6380': 1}
+        assert session.cached_stats('redis')['redis-6380'].status == 'UP'
+        assert session.client is client
+
+    def test_abandoned_stream_closes(self):
+        client = FakeClient(self.header, self.row('redis-6379', 'UP', 150), '\n> ')
+        session = self.makeone(client)
+        lines = session.iter_lines('show stat')
+        next(lines)
+        lines.close()
+        assert session.client is None
+
+
+class TestWeightPlan(unittest.TestCase):
+
+    def makeone(self, servers, current, idle=()):
+        from redundis import haproxy
+        return haproxy.WeightPlan.from_chain('redis', servers, (150, 1, 0), idle, current)
+
+    def test_failover_drains_first(self):
+        current = {'redis-6379': 150, 'redis-6380': 1, 'redis-6381': 0}
+        plan = self.makeone(['redis-6380', 'redis-6381'], current, idle=['redis-6379'])
+        assert plan.diff == [('redis-6379', 150, 0),
+                             ('redis-6381', 0, 1),
+                             ('redis-6380', 1, 150)], plan.diff
+
+    def test_minimal_diff(self):
+        current = {'redis-6379': 150, 'redis-6380': 1, 'redis-6381': 0}
+        plan = self.makeone(['redis-6379', 'redis-6380', 'redis-6381'], current)
+        assert plan.diff == []
+        stats = Mock()
+        assert plan.apply(stats) == []
+        assert not stats.set_weights.called
+
+    def test_apply_single_batch(self):
+        plan = self.makeone(['redis-6379', 'redis-6380'], {})
+        stats = Mock()
+        plan.apply(stats)
+        stats.set_weights.assert_called_once_with('redis', [('redis-6380', 1),
+                                                            ('redis-6379', 150)])
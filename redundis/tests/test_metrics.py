@@ -0,0 +1,48 @@
+import unittest
+
+
+class TestRegistry(unittest.TestCase):
+
+    def makeone(self):
+        from redundis import metrics
+        return metrics.Registry()
+
+    def test_counter(self):
+        reg = self.makeone()
+        counter = reg.counter('hits_total', 'Hits')
+        counter.inc(handler='dead_master')
+        counter.inc(handler='dead_master')
+        assert counter.value(handler='dead_master') == 2
+        assert 'hits_total{handler="dead_master"} 2' in reg.render()
+
+    def test_histogram(self):
+        reg = self.makeone()
+        hist = reg.histogram('lat_seconds', 'Latency', buckets=(0.1, 1))
+        hist.observe(0.05)
+        hist.observe(0.5)
+        hist.observe(5)
+        text = reg.render()
+        assert '# TYPE lat_seconds histogram' in text
+        assert 'lat_seconds_bucket{le="0.1"} 1' in text
+        assert 'lat_seconds_bucket{le="1"} 2' in text
+        assert 'lat_seconds_bucket{le="+Inf"} 3' in text
+        assert 'lat_seconds_count 3' in text
+
+    def test_timed(self):
+        from redundis import metrics
+
+        @metrics.timed('test_timed_seconds')
+        def work(x):
+            return x * 2
+        assert work(2) == 4
+        assert metrics.registry.histogram('test_timed_seconds').count() == 1
+
+    def test_statsd_lines(self):
+        from redundis import metrics
+        reg = self.makeone()
+        emitter = metrics.StatsdEmitter('127.0.0.1', registry=reg)
+        reg.listeners.append(emitter.record)
+        reg.counter('flaps_total').inc(instance='localhost:6379')
+        reg.histogram('probe_seconds').observe(0.002)
+        assert emitter.pending == ['redundis.flaps_total.localhost_6379:1|c',
+                                   'redundis.probe_seconds:2.000|ms'], emitter.pending
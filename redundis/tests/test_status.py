@@ -0,0 +1,79 @@
+from time import time
+import threading
+import unittest
+
+
+class TestInParallel(unittest.TestCase):
+
+    def test_results_errors_and_timeouts(self):
+        from redundis import status
+
+        def boom():
+            raise ValueError('boom')
+
+        start = time()
+        out = status.in_parallel([lambda: 1, boom, lambda: threading.Event().wait(5)], 0.2)
+        assert time() - start < 1
+        assert out[0] == 1
+        assert isinstance(out[1], ValueError)
+        assert isinstance(out[2], status.Timeout)
+
+
+class TestStatus(unittest.TestCase):
+
+    def setUp(self):
+        from redundis import fakes
+        from redundis import green
+        green.patch()
+        self.master = fakes.FakeRedis().start()
+        self.slave = fakes.FakeRedis().start()
+        self.wedged = fakes.FakeRedis().start()
+        self.slave.execute(['SLAVEOF', self.master.host, str(self.master.port)])
+        self.wedged.execute(['SLAVEOF', self.slave.host, str(self.slave.port)])
+        self.redi = [self.master.spec, self.slave.spec, self.wedged.spec]
+        self.ha = fakes.FakeHAProxy([('redis-%s' % x.port, w) for x, w in \
+                                     ((self.master, 150), (self.slave, 1), (self.wedged, 0))]).start()
+
+    def tearDown(self):
+        for inst in (self.master, self.slave, self.wedged):
+            inst.stop()
+        self.ha.stop()
+
+    def report(self, timeout=1.0):
+        from redundis import status
+        return status.status(dict(default=dict(redi=self.redi, haproxy_sock=self.ha.path)), timeout)
+
+    def test_healthy_chain(self):
+        from redundis import status
+        report, elapsed = self.report()
+        rows = report['default']
+        assert [row['role'] for row in rows] == ['master', 'slave', 'slave']
+        assert [row['weight'] for row in rows] == [150, 1, 0]
+        assert rows[1]['master'] == self.master.spec
+        assert rows[1]['link'] == 'up'
+        assert rows[1]['behind'] is not None
+        assert rows[0]['used_memory'] == 1 << 20
+        assert status.healthy(report)
+        lines = status.table(report)
+        assert len(lines) == 4
+        assert lines[1].startswith('default')
+
+    def test_wedged_instance_bounded_by_timeout(self):
+        from redundis import status
+        self.wedged.hang()
+        report, elapsed = self.report(0.3)
+        assert elapsed < 0.6, elapsed
+        rows = report['default']
+        assert [row['role'] for row in rows] == ['master', 'slave', None]
+        assert rows[2]['error']
+        assert rows[2]['weight'] == 0
+        assert not status.healthy(report)
+        assert 'down' in status.table(report)[3]
+
+    def test_haproxy_unreachable(self):
+        from redundis import status
+        self.ha.stop()
+        report, elapsed = self.report()
+        assert [row['weight'] for row in report['default']] == [None] * 3
+        assert report['default'][0]['haproxy_error']
+        assert not status.healthy(report)
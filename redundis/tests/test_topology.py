@@ -0,0 +1,91 @@
+from mock import Mock
+import json
+import unittest
+
+
+def doc(version, epoch=1, cluster='default'):
+    return dict(cluster=cluster, epoch=epoch, version=version, master='localhost:6379',
+                chain=['localhost:6379'], down=[], weights={}, lag={})
+
+
+class TestSocketPublisher(unittest.TestCase):
+
+    def test_subscriber_gets_latest_and_updates(self):
+        import tempfile
+        from gevent import socket
+        from redundis import topology
+        pub = topology.SocketPublisher(tempfile.mktemp(suffix='.sock'))
+        pub.publish(doc(1))
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(pub.path)
+            fp = sock.makefile('rb')
+            assert json.loads(fp.readline())['version'] == 1
+            pub.publish(doc(2))
+            assert json.loads(fp.readline())['version'] == 2
+            fp.close()
+            sock.close()
+        finally:
+            pub.stop()
+
+    def test_slow_subscriber_dropped(self):
+        import gevent
+        import tempfile
+        import time
+        from gevent import socket
+        from redundis import topology
+        pub = topology.SocketPublisher(tempfile.mktemp(suffix='.sock'), backlog=4)
+        pub.publish(doc(1))
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(pub.path)
+            gevent.sleep(0.05)
+            assert len(pub.subscribers) == 1
+            big = doc(2)
+            big['chain'] = ['localhost:%d' % x for x in range(20000)]
+            start = time.time()
+            for version in range(2, 50):
+                big['version'] = version
+                pub.publish(big)
+                gevent.sleep(0)
+            assert time.time() - start < 2
+            assert not pub.subscribers
+            sock.close()
+        finally:
+            pub.stop()
+
+class TestChannelPublisher(unittest.TestCase):
+
+    def watcher(self):
+        master, slave = Mock(name='master'), Mock(name='slave')
+        watcher = Mock(name='watcher', instances=[master, slave])
+        watcher.pool.map.side_effect = lambda func, insts: [func(inst) for inst in insts]
+        return watcher
+
+    def test_publish_only(self):
+        from redundis import topology
+        watcher = self.watcher()
+        topology.ChannelPublisher('redundis.topology').publish(doc(1), watcher)
+        for inst in watcher.instances:
+            inst.cxn.publish.assert_called_once_with('redundis.topology', topology.dumps(doc(1)))
+            assert not inst.cxn.set.called
+
+    def test_store_key(self):
+        from redundis import topology
+        watcher = self.watcher()
+        topology.ChannelPublisher('redundis.topology', 'topo').publish(doc(1), watcher)
+        master, slave = watcher.instances
+        master.cxn.set.assert_called_once_with('topo:default', topology.dumps(doc(1)))
+        assert not slave.cxn.set.called
+
+class TestTopologySubscriber(unittest.TestCase):
+
+    def test_apply_newer_only(self):
+        from redundis import cxn
+        pool = Mock(name='pool')
+        sub = cxn.TopologySubscriber(pool)
+        assert sub.apply(json.dumps(doc(2)))['version'] == 2
+        assert sub.apply(json.dumps(doc(1))) is None
+        assert sub.apply(json.dumps(doc(1, cluster='other'))) is None
+        assert sub.apply(json.dumps(doc(1, epoch=2)))['epoch'] == 2
+        assert pool.update_topology.call_count == 2
@@ -0,0 +1,474 @@
+from mock import Mock
+from mock import patch
+from path import path
+from stuf import frozenstuf
+import unittest
+
+
+class FakeInst(object):
+    """
+    A chain member that reports a canned role
+    """
+    def __init__(self, port, role, offset=0):
+        from redundis import watcher
+        self.cxn_args = frozenstuf(host='localhost', port=port)
+        self.host, self.port = 'localhost', port
+        self.role = role
+        self.offset = offset
+        self.link = 'up'
+        self.master = None
+        self.snapshot = watcher.Snapshot.down
+        self.probes = 0
+
+    def probe(self):
+        from redundis import watcher
+        self.probes += 1
+        if self.role is None:
+            self.snapshot = watcher.Snapshot.down
+        else:
+            self.snapshot = watcher.Snapshot(self.role, self.link, self.offset, 0)
+        return self.snapshot
+
+    def slaveof(self, rcxn=None):
+        self.master = rcxn
+        self.role = rcxn is None and 'master' or 'slave'
+
+    def __repr__(self):
+        return '<FakeInst %s %s>' %(self.port, self.role)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_from_slave_info(self):
+        from redundis import watcher
+        snap = watcher.Snapshot.from_info(dict(role='slave', master_link_status='up',
+                                               slave_repl_offset=42,
+                                               master_last_io_seconds_ago=1))
+        assert snap == ('slave', 'up', 42, 1)
+        assert snap.up
+
+    def test_down(self):
+        from redundis import watcher
+        assert not watcher.Snapshot.down.up
+
+
+class TestRedisCxn(unittest.TestCase):
+
+    def test_refused_info_is_down(self):
+        import redis
+        from redundis import watcher
+
+        class Cxn(watcher.RedisCxn):
+            redis_class = Mock(name='StrictRedis')
+
+        inst = Cxn(host='localhost', port=6379)
+        inst.cxn.info.side_effect = redis.ResponseError('NOAUTH Authentication required.')
+        assert inst.probe() == watcher.Snapshot.down
+        assert [args for args, kw in inst.cxn.info.call_args_list] == [('replication',), (None,)]
+        assert inst.probe() == watcher.Snapshot.down
+        assert inst.cxn.info.call_count == 3
+
+class WatcherTest(unittest.TestCase):
+
+    def makeone(self, *roles):
+        from redundis import haproxy
+        from redundis import watcher
+        w = watcher.Watcher()
+        w.haproxy = Mock(name='haproxy')
+        w.haproxy.cached_weights.return_value = {}
+        w.checks = {}
+        w.haproxy.show_stat.side_effect = lambda backend, max_age=None: dict(
+            ('redis-%s' % inst.port, haproxy.ServerStat(backend, 'redis-%s' % inst.port, 'UP', 0,
+                                                        0, 0, w.checks.get(inst.port, ''))) \
+            for inst in w.instances)
+        w.instances = [FakeInst(6379 + i, role) for i, role in enumerate(roles)]
+        return w
+
+
+class TestDispatch(WatcherTest):
+
+    def test_probes_once(self):
+        w = self.makeone('master', 'slave', 'slave')
+        out = w.do_dispatch()
+        # slaves the watcher has just pointed are checked for replication
+        assert [inst.probes for inst in w.instances] == [1, 2, 2]
+        assert [up for up, _, _ in out] == [True, True, True]
+        w.do_dispatch()
+        assert [inst.probes for inst in w.instances] == [2, 3, 3]
+
+    def test_dead_master(self):
+        w = self.makeone(None, 'slave', 'slave')
+        r1, r2, r3 = w.instances
+        out = w.do_dispatch()
+        assert w.instances == [r2, r3, r1]
+        assert r2.role == 'master'
+        assert r3.master is r2
+        assert [up for up, _, _ in out] == [True, True, False]
+
+    def test_dead_master_promotes_most_caught_up(self):
+        w = self.makeone(None, 'slave', 'slave')
+        r1, r2, r3 = w.instances
+        r2.offset, r3.offset = 100, 250
+        w.do_dispatch()
+        assert w.instances == [r3, r2, r1]
+        assert r3.role == 'master'
+        assert r2.master is r3
+
+    def test_returning_instance_held_back(self):
+        w = self.makeone('master', 'slave', 'slave')
+        r1, r2, r3 = w.instances
+        w.damper.record(r3, False)
+        w.damper.record(r3, True)
+        assert w.roles() == ['master', 'slave', None]
+
+    def test_failover_cap(self):
+        w = self.makeone(None, 'slave', 'slave')
+        w.damper.max_failovers = 1
+        w.damper.failover()
+        r1, r2, r3 = w.instances
+        assert w.dispatch_for_roles(w.roles()) == [r1, r2, r3]
+        assert r2.role == 'slave'
+        assert w.damper.next_review() > 0
+
+    def test_drain_lag(self):
+        w = self.makeone('slave', 'slave')
+        w.promote_wait = 1
+        master, slave = w.instances
+        master.offset, slave.offset = 100, 90
+        [inst.probe() for inst in w.instances]
+        slave.offset = 100
+        assert w.drain_lag(master, [slave]) == []
+        assert slave.probes == 2
+
+
+class TestWeights(WatcherTest):
+
+    def test_weights_retried_after_stats_error(self):
+        from redundis import haproxy
+        w = self.makeone('master', 'slave', 'slave')
+        w.haproxy.set_weights.side_effect = [haproxy.StatsTimeout('slow'), ['150', '1', '0']]
+        assert w.review_in() is None
+        w.do_dispatch()
+        assert w.weights_pending
+        assert w.review_in() == w.haproxy_poll
+        w.do_dispatch()
+        assert not w.weights_pending
+        assert w.haproxy.set_weights.call_count == 2
+
+    def test_unreadable_weights(self):
+        from redundis import haproxy
+        w = self.makeone('master', 'slave')
+        w.haproxy.show_stat.side_effect = haproxy.StatsError('gone')
+        assert w.check_weights(*w.instances) == [None, None]
+
+
+class TestSync(WatcherTest):
+
+    def weights(self, w):
+        return dict(w.haproxy.set_weights.call_args[0][1])
+
+    def test_syncing_slaves_left_at_zero(self):
+        w = self.makeone('master', 'slave', 'slave')
+        w.sync_timeout = 0.05
+        r1, r2, r3 = w.instances
+        r2.link = 'down'
+        w.do_dispatch()
+        # r3 replicates from r2, so it is no further along
+        assert w.syncing == set([r2, r3])
+        assert self.weights(w) == {'redis-6379': 150, 'redis-6380': 0, 'redis-6381': 0}
+        assert r2.probes > 2
+        assert w.review_in() == w.haproxy_poll
+
+        r2.link = 'up'
+        w.do_dispatch()
+        assert not w.syncing
+        assert self.weights(w) == {'redis-6379': 150, 'redis-6380': 1, 'redis-6381': 0}
+
+    def test_star_weights_synced_slave(self):
+        w = self.makeone('master', 'slave', 'slave')
+        w.topology = 'star'
+        w.sync_timeout = 0.05
+        r1, r2, r3 = w.instances
+        r2.link = 'down'
+        w.do_dispatch()
+        assert w.syncing == set([r2])
+        assert self.weights(w) == {'redis-6379': 150, 'redis-6380': 0, 'redis-6381': 1}
+
+    def test_head_weighted_before_slaves_sync(self):
+        import gevent
+        w = self.makeone(None, 'slave', 'slave')
+        w.sync_timeout = 5
+        r1, r2, r3 = w.instances
+        r3.link = 'down'
+        dispatch = gevent.spawn(w.do_dispatch)
+        gevent.sleep(0.05)
+        assert self.weights(w) == {'redis-6379': 0, 'redis-6380': 150, 'redis-6381': 0}
+        r3.link = 'up'
+        dispatch.join(timeout=1)
+        assert dispatch.ready()
+        assert self.weights(w)['redis-6381'] == 1
+        assert not w.syncing
+
+    def test_no_barrier(self):
+        w = self.makeone('master', 'slave', 'slave')
+        w.sync_timeout = 0
+        w.instances[1].link = 'down'
+        w.do_dispatch()
+        assert [inst.probes for inst in w.instances] == [1, 1, 1]
+        assert not w.syncing
+
+
+class TestQuorum(WatcherTest):
+
+    def test_blip_holds_chain(self):
+        w = self.makeone(None, 'slave', 'slave')
+        w.checks[6379] = 'L7OK'
+        r1, r2, r3 = w.instances
+        w.do_dispatch()
+        assert w.instances == [r1, r2, r3]
+        assert r2.role == 'slave'
+        assert w.held() == [r1]
+
+    def test_l4_check_is_no_vote(self):
+        w = self.makeone(None, 'slave', 'slave')
+        # a SIGSTOPped redis still accepts connections
+        w.checks[6379] = 'L4OK'
+        r1, r2, r3 = w.instances
+        w.do_dispatch()
+        assert w.instances == [r2, r3, r1]
+        assert r2.role == 'master'
+        assert not w.disputes
+
+    def test_outage_seen_by_both(self):
+        w = self.makeone(None, 'slave', 'slave')
+        w.checks[6379] = 'L4CON'
+        r1, r2, r3 = w.instances
+        w.do_dispatch()
+        assert w.instances == [r2, r3, r1]
+        assert r2.role == 'master'
+        assert not w.disputes
+
+    def test_dispute_times_out(self):
+        w = self.makeone(None, 'slave', 'slave')
+        w.checks[6379] = 'L7OK'
+        r1, r2, r3 = w.instances
+        w.do_dispatch()
+        w.disputes[r1] -= w.quorum_timeout
+        w.do_dispatch()
+        assert w.instances == [r2, r3, r1]
+        assert w.disputes and not w.held()
+
+    def test_failing_check_prompts_dispatch(self):
+        import gevent
+        w = self.makeone('master', 'slave', 'slave')
+        poller = gevent.spawn(w.watch_haproxy, 0.01)
+        try:
+            gevent.sleep(0.05)
+            assert w.changes.empty()
+            w.checks[6380] = 'L4TOUT'
+            assert w.changes.get(timeout=1) == (w.instances[1], None)
+            gevent.sleep(0.05)
+            assert w.changes.empty()
+        finally:
+            poller.kill()
+
+
+class TestMonitors(unittest.TestCase):
+
+    def setUp(self):
+        from redundis import green
+        green.patch()
+
+    def test_slave_flap_keeps_healthy_monitors(self):
+        import gevent
+        from redundis import fakes
+        from redundis import watcher
+        redi = [fakes.FakeRedis().start() for x in range(3)]
+        ha = fakes.FakeHAProxy([('redis-%s' % r.port, 0) for r in redi]).start()
+        w = watcher.Watcher([r.spec for r in redi], ha.path, down_poll=0.05)
+        loop = gevent.spawn(w.loop)
+        try:
+            master, middle, tail = redi
+            weighted = lambda port, weight: lambda ha: ha.weight('redis-%s' % port) == weight
+            assert ha.wait_for(weighted(master.port, 150), 5)
+            gevent.sleep(0.1)
+            first = dict(w.watches)
+            assert len(first) == 3
+            tail.kill()
+            gevent.sleep(0.2)
+            assert w.instances[-1].port == tail.port
+            head, second = w.instances[:2]
+            assert w.watches[head] is first[head]
+            assert w.watches[second] is first[second]
+            assert len(w.monitors) == 3
+        finally:
+            loop.kill()
+            w.monitors.kill()
+            w.haproxy.close()
+            [r.stop() for r in redi]
+            ha.stop()
+
+    def test_restart_seen_by_probe_admitted(self):
+        import gevent
+        from redundis import fakes
+        from redundis import watcher
+        redi = [fakes.FakeRedis().start() for x in range(3)]
+        ha = fakes.FakeHAProxy([('redis-%s' % r.port, 0) for r in redi]).start()
+        # the monitor of a down instance never polls within the test
+        w = watcher.Watcher([r.spec for r in redi], ha.path, down_poll=30,
+                            damping_args=dict(stable_for=1))
+        loop = gevent.spawn(w.loop)
+        try:
+            master, middle, tail = redi
+            assert ha.wait_for(lambda ha: ha.weight('redis-%s' % master.port) == 150, 5)
+            assert tail.role == 'slave'
+            tail.kill()
+            gevent.sleep(0.2)
+            inst = w.instances[-1]
+            assert inst.port == tail.port
+            assert not inst.connected
+            tail.restart()
+            w.changes.put((inst, None))
+            gevent.sleep(0.2)
+            assert inst.connected
+            assert tail.role == 'master'
+            for x in range(30):
+                if tail.role == 'slave':
+                    break
+                gevent.sleep(0.1)
+            assert tail.role == 'slave'
+        finally:
+            loop.kill()
+            w.monitors.kill()
+            w.haproxy.close()
+            [r.stop() for r in redi]
+            ha.stop()
+
+
+class TestPublish(WatcherTest):
+
+    def test_publish_on_change(self):
+        w = self.makeone(None, 'slave', 'slave')
+        publisher = Mock(name='publisher')
+        w.publishers = [publisher]
+        doc = w.publish(w.do_dispatch())
+        assert doc['version'] == 1
+        assert doc['master'] == 'localhost:6380'
+        assert doc['chain'] == ['localhost:6380', 'localhost:6381', 'localhost:6379']
+        assert doc['down'] == ['localhost:6379']
+        assert doc['weights'] == {'localhost:6380': 0, 'localhost:6381': 0, 'localhost:6379': 0}
+        publisher.publish.assert_called_once_with(doc, w)
+        assert w.publish(w.do_dispatch()) is None
+        assert publisher.publish.call_count == 1
+
+    def test_publish_on_link_down(self):
+        w = self.makeone('master', 'slave', 'slave')
+        w.sync_timeout = 0
+        w.publishers = [Mock(name='publisher')]
+        r1, r2, r3 = w.instances
+        assert w.publish(w.do_dispatch())['lag'] == {'localhost:6379': 0, 'localhost:6380': 0,
+                                                     'localhost:6381': 0}
+        r3.link = 'down'
+        doc = w.publish(w.do_dispatch())
+        assert doc['version'] == 2
+        assert doc['lag']['localhost:6381'] is None
+        assert doc['weights']['localhost:6381'] == 0
+        r3.link = 'up'
+        assert w.publish(w.do_dispatch())['version'] == 3
+
+
+class TestChainRoles(unittest.TestCase):
+
+    def test_engine_hooks_are_abstract(self):
+        from redundis.roles import ChainRoles
+
+        class Partial(ChainRoles):
+            def rechain(self, insts, promote=False):
+                pass
+
+        self.assertRaises(TypeError, ChainRoles)
+        self.assertRaises(TypeError, Partial)
+
+
+class TestClassify(unittest.TestCase):
+
+    def test_states(self):
+        from redundis.watcher import classify
+        assert classify([None, None, None]) == 'all_down'
+        assert classify(['master', 'master', 'master']) == 'chained'
+        assert classify(['master', 'slave', 'slave', 'slave', 'slave']) == 'chained'
+        assert classify(['slave', 'master', 'slave', 'slave']) == 'reversed'
+        assert classify(['slave', 'slave', 'slave']) == 'all_slaves'
+        assert classify([None, 'slave', None, 'slave']) == 'dead_master'
+        assert classify(['master', None, 'slave']) == 'dead_slave'
+        assert classify([None, 'slave', 'master']) == 'flipped_master'
+        assert classify(['master', 'master', None]) == 'double_master'
+        assert classify([None, 'slave', None]) == 'only_slave'
+
+
+class TestTopology(WatcherTest):
+
+    def test_chain_of_five(self):
+        w = self.makeone('master', 'master', 'master', 'master', 'master')
+        w.do_dispatch()
+        r1, r2, r3, r4, r5 = w.instances
+        assert [r.master for r in w.instances] == [None, r1, r2, r3, r4]
+        batch = w.haproxy.set_weights.call_args[0][1]
+        assert dict(batch) == {'redis-6379': 150, 'redis-6380': 1,
+                               'redis-6381': 0, 'redis-6382': 0, 'redis-6383': 0}
+
+    def test_star(self):
+        w = self.makeone('slave', 'master', 'master', 'slave')
+        w.topology = 'star'
+        w.do_dispatch()
+        r1, r2, r3, r4 = w.instances
+        assert r1.role == 'master'
+        assert [r.master for r in w.instances] == [None, r1, r1, r1]
+
+    def test_lone_slave_promoted(self):
+        w = self.makeone(None, None, 'slave')
+        w.do_dispatch()
+        assert w.instances[0].role == 'master'
+        assert w.instances[0].port == 6381
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def test_from_config(self):
+        from redundis import watcher
+        with open(path(__file__).parent.parent / 'etc' / 'clusters.yml') as stream:
+            with patch.object(watcher.Watcher, 'load_inst'):
+                sup = watcher.Supervisor.from_config(stream)
+        assert sorted(sup.watchers) == ['cache', 'sessions']
+        cache, sessions = sup.watchers['cache'], sup.watchers['sessions']
+        assert cache.ha_backend == 'cache'
+        assert cache.topology == 'star'
+        assert cache.detector_class is sessions.detector_class is not None
+        assert cache.haproxy is sessions.haproxy
+        assert cache.pool.shared is sessions.pool.shared
+
+    def test_single_cluster_config(self):
+        from redundis import watcher
+        sup = watcher.Supervisor.from_config("redi: ['localhost:6379']\nha_backend: solo\n")
+        assert sup.watchers['default'].redi == ['localhost:6379']
+        assert sup.watchers['default'].ha_backend == 'solo'
+
+    def test_cluster_share(self):
+        import gevent
+        from redundis import watcher
+        from gevent.lock import Semaphore
+        shared = Semaphore(3)
+        one, two = watcher.ClusterPool(shared, 2), watcher.ClusterPool(shared, 2)
+        running = []
+
+        def work(name):
+            running.append(name)
+            gevent.sleep(0.01)
+        spawner = gevent.spawn(lambda: [one.spawn(work, 'one') for x in range(4)])
+        gevent.sleep(0)
+        two.spawn(work, 'two')
+        gevent.sleep(0)
+        assert running.count('one') == 2
+        assert running.count('two') == 1
+        spawner.join(); one.join(); two.join()
+        assert shared.counter == 3
@@ -0,0 +1,173 @@
+"""
+Publishing the watcher's view of a chain to clients
+
+On every change the watcher publishes a topology document as JSON::
+
+  {"cluster": "default", "epoch": 1364428800, "version": 3,
+   "master": "10.0.0.2:6379",
+   "chain": ["10.0.0.2:6379", "10.0.0.3:6379", "10.0.0.1:6379"],
+   "down": ["10.0.0.1:6379"],
+   "weights": {"10.0.0.2:6379": 150, "10.0.0.3:6379": 1, "10.0.0.1:6379": 0},
+   "lag": {"10.0.0.2:6379": 0, "10.0.0.3:6379": 0}}
+
+`lag` has the seconds each instance that is up is behind its master,
+null for a slave whose link is down.  Lag alone changing does not
+prompt a document, a slave's link going down or up does.
+
+`epoch` is when the watcher started and `version` counts documents
+since, so a client keeps whichever has the greater `(epoch,
+version)`.  Documents can go out over redis pub/sub on every instance
+that is up (`ChannelPublisher`) and to subscribers of a local UNIX
+socket, one document per line (`SocketPublisher`).
+"""
+from gevent import socket
+from gevent.pool import Pool
+from gevent.queue import Full
+from gevent.queue import Queue
+from gevent.server import StreamServer
+import gevent
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+channel = 'redundis.topology'
+
+
+def newer(doc, than):
+    """
+    Whether `doc` supersedes the document `than`
+    """
+    if than is None:
+        return True
+    return (doc['epoch'], doc['version']) > (than['epoch'], than['version'])
+
+
+def dumps(doc):
+    return json.dumps(doc, sort_keys=True)
+
+
+class ChannelPublisher(object):
+    """
+    PUBLISHes each document on `channel` of every instance that is up.
+
+    Nothing is written to the keyspace unless asked: with `store_key`
+    the latest document is also SET on the master under
+    `store_key:cluster`, from where it replicates to the slaves, for
+    subscribers to read when they (re)subscribe.
+    """
+    def __init__(self, channel=channel, store_key=None):
+        self.channel = channel
+        self.store_key = store_key
+
+    def key(self, cluster):
+        return '%s:%s' %(self.store_key, cluster)
+
+    def publish(self, doc, watcher):
+        data = dumps(doc)
+        if self.store_key and doc['master'] is not None:
+            master = watcher.instances[0]
+            try:
+                master.cxn.set(self.key(doc['cluster']), data)
+            except Exception, e:
+                logger.warn("Could not store topology on %s:%s: %s", master.host, master.port, e)
+        insts = [inst for inst in watcher.instances if inst.snapshot.up]
+        return watcher.pool.map(lambda inst: self.send(inst, data), insts)
+
+    def send(self, inst, data):
+        try:
+            return inst.cxn.publish(self.channel, data)
+        except Exception, e:
+            logger.warn("Could not publish to %s:%s: %s", inst.host, inst.port, e)
+
+
+class SocketPublisher(object):
+    """
+    Serves documents on a UNIX socket at `path`.  A subscriber is sent
+    the latest document of each cluster on connecting and every
+    document after, one per line.
+
+    Publishing never waits on a subscriber: each has a queue of up to
+    `backlog` documents written out by a greenlet of its own, and one
+    that lets its queue fill is dropped.
+    """
+    def __init__(self, path, backlog=16):
+        self.path = path
+        self.backlog = backlog
+        self.latest = {}
+        self.subscribers = {}
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(64)
+        self.server = StreamServer(listener, self.handle, spawn=Pool())
+        self.server.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop(timeout=0)
+        self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(self, sock, queue):
+        try:
+            for line in queue:
+                sock.sendall(line)
+        except socket.error:
+            pass
+
+    def handle(self, sock, address):
+        queue = Queue(self.backlog)
+        writer = None
+        try:
+            for doc in self.latest.values():
+                sock.sendall(dumps(doc) + '\n')
+            self.subscribers[sock] = queue
+            writer = gevent.spawn(self.write, sock, queue)
+            # nothing is read; wait for the subscriber to hang up
+            while sock.recv(1024):
+                pass
+        except socket.error:
+            pass
+        finally:
+            self.subscribers.pop(sock, None)
+            if writer is not None:
+                writer.kill()
+            sock.close()
+
+    def drop(self, sock):
+        logger.warn("Dropping a topology subscriber %d documents behind", self.backlog)
+        self.subscribers.pop(sock, None)
+        sock.close()
+
+    def publish(self, doc, watcher=None):
+        if self.server is None:
+            self.start()
+        self.latest[doc['cluster']] = doc
+        line = dumps(doc) + '\n'
+        for sock, queue in self.subscribers.items():
+            try:
+                queue.put_nowait(line)
+            except Full:
+                self.drop(sock)
+
+
+def publishers(channel=None, sock=None, store_key=None):
+    """
+    Publishers for a pub/sub `channel`, storing the latest document
+    under `store_key` if given, and/or UNIX socket path `sock`
+    """
+    out = []
+    if channel:
+        out.append(ChannelPublisher(channel, store_key))
+    if sock:
+        out.append(SocketPublisher(sock))
+    return out
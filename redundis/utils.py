@@ -1,14 +1,19 @@
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from path import path
 from stuf import frozenstuf
 from urllib import quote_plus as quote
 from urllib import unquote
+import hashlib
+import json
 import logging
 import os
+import platform
 import requests
 import subprocess
 import tarfile
 import tempfile
+import threading
 
 
 logger = logging.getLogger(__name__)
@@ -16,51 +21,216 @@ logger = logging.getLogger(__name__)
 environ = frozenstuf([(x,k) for x, k in os.environ.items() if not x.startswith('_')])
 
 
+class DownloadError(RuntimeError):
+    """
+    A download came back short or not matching its checksum
+    """
+
+
 class Downloader(object):
     """
     Downloading object for setting up a cluster
+
+    Downloads are streamed to a temporary file in the cache and renamed
+    into place once complete, so a file in the cache is never partial.
+    A manifest in the cache records the sha256 and size of each file
+    by url.
     """
+    manifest_name = 'manifest.json'
+    chunk_size = 64 * 1024
 
-    def __init__(self, cache=path(environ.VIRTUAL_ENV) / '.download_cache'):
+    def __init__(self, cache=path(environ.VIRTUAL_ENV) / '.download_cache', workers=4):
         self.cache = path(cache)
         if not self.cache.exists():
             self.cache.makedirs()
+        self.workers = workers
+        self.lock = threading.Lock()
+        self._manifest = None
 
-    tempdir = staticmethod(tempfile.mkdtemp)
     quote = staticmethod(quote)
     unquote = staticmethod(unquote)
     GET = staticmethod(requests.get)
 
-    def download(self, url):
-        thefile = self.cache / quote(url)
-        if thefile in self.cache.files():
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            thefile = self.cache / self.manifest_name
+            self._manifest = thefile.exists() and json.loads(thefile.text()) or {}
+        return self._manifest
+
+    def record(self, url, thefile, sha256, size):
+        with self.lock:
+            self.manifest[url] = dict(name=thefile.name, sha256=sha256, size=size)
+            fd, tmp = tempfile.mkstemp(dir=self.cache, prefix='.manifest-')
+            with os.fdopen(fd, 'w') as out:
+                json.dump(self.manifest, out, indent=1, sort_keys=True)
+            os.rename(tmp, self.cache / self.manifest_name)
+
+    def cached(self, url, sha256=None):
+        """
+        The cached file for `url`, if the manifest has it (with
+        `sha256`, if given) and it is still the size recorded
+        """
+        entry = self.manifest.get(url)
+        if entry is None or sha256 is not None and entry['sha256'] != sha256:
+            return None
+        thefile = self.cache / entry['name']
+        if not thefile.exists() or thefile.getsize() != entry['size']:
+            return None
+        return thefile
+
+    def download(self, url, sha256=None):
+        thefile = self.cached(url, sha256)
+        if thefile is not None:
             logger.info('Return %s from cach @ %s' %(url, self.cache))
             return thefile
-        resp = self.GET(url)
-        thefile.write_bytes(resp.content)
+        thefile = self.cache / quote(url)
+        resp = self.GET(url, stream=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cache, prefix='.partial-')
+        try:
+            digest, size = hashlib.sha256(), 0
+            with os.fdopen(fd, 'wb') as out:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(self.chunk_size):
+                    out.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            expected = resp.headers.get('content-length')
+            if expected is not None and 'content-encoding' not in resp.headers \
+                   and int(expected) != size:
+                raise DownloadError('%s: got %d of %s bytes' %(url, size, expected))
+            if sha256 is not None and digest.hexdigest() != sha256:
+                raise DownloadError('%s: sha256 %s, expected %s' %(url, digest.hexdigest(), sha256))
+            os.rename(tmp, thefile)
+        finally:
+            resp.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.record(url, thefile, digest.hexdigest(), size)
         return thefile
 
+    def fetch_all(self, urls):
+        """
+        Downloads each of `urls` on up to `workers` threads, returning
+        their files in order
+        """
+        urls = list(urls)
+        pool = ThreadPool(max(1, min(self.workers, len(urls))))
+        try:
+            return pool.map(self.download, urls)
+        finally:
+            pool.close()
+
+    @staticmethod
+    def members(archive):
+        """
+        The members of `archive`, less the top level directory if all
+        share one, skipping any that would land outside the destination
+        """
+        members = archive.getmembers()
+        names = [os.path.normpath(member.name) for member in members]
+        tops = set(name.split(os.sep, 1)[0] for name in names)
+        strip = len(tops) == 1 and any(os.sep in name for name in names)
+
+        def relative(name):
+            name = os.path.normpath(name)
+            if strip:
+                name = name.partition(os.sep)[2]
+            return name
+
+        for member, name in zip(members, names):
+            name = relative(name)
+            if not name or os.path.isabs(name) or name.split(os.sep)[0] == '..':
+                continue
+            member.name = name
+            if member.islnk():
+                member.linkname = relative(member.linkname)
+            yield member
+
     def unpack_to(self, thefile, dest, overwrite=True):
+        """
+        Extracts the tarball `thefile` into `dest`, replacing whatever
+        was there unless `overwrite` is false
+        """
         dest = path(dest)
-        if not overwrite and dest.exists():
-            return dest
-        tmp = path(self.tempdir())
+        if dest.exists():
+            if not overwrite:
+                return dest
+            dest.rmtree()
+        dest.makedirs()
         with tarfile.open(thefile, mode='r:gz') as archive:
-            archive.extractall(tmp)
-
-        if len(tmp.dirs()) == 1:
-            tmp.dirs()[0].copytree(dest)
-        else:
-            if not dest.exists(): dest.mkdir()
-            for member in tmp.dirs():
-                member.copytree(dest)
+            archive.extractall(dest, members=self.members(archive))
         return dest
 
-    def __call__(self, url, dest, overwrite=True):
-        thefile = self.download(url)
+    def __call__(self, url, dest, overwrite=True, sha256=None):
+        thefile = self.download(url, sha256)
         return self.unpack_to(thefile, dest, overwrite)
 
 
+def build_platform():
+    """
+    What a compiled binary depends on: OS, machine and C library
+    """
+    return '-'.join([platform.system(), platform.machine()] + \
+                    [x for x in platform.libc_ver() if x])
+
+
+class BuildCache(object):
+    """
+    Build outputs kept under a key of the source tarball's sha256, the
+    build actions and the platform, so that a build is only compiled
+    once per kind of machine
+    """
+    def __init__(self, root):
+        self.root = path(root)
+        if not self.root.exists():
+            self.root.makedirs()
+
+    @staticmethod
+    def key(sha256, actions, platform=None):
+        digest = hashlib.sha256()
+        for part in [sha256, platform or build_platform()] + list(actions):
+            digest.update(part + '\n')
+        return digest.hexdigest()
+
+    def restore(self, key, dest):
+        """
+        Copies the files stored under `key` into `dest`, returning
+        their new paths, or None for a miss
+        """
+        entry = self.root / key
+        if not entry.isdir():
+            return None
+        dest = path(dest)
+        if not dest.exists():
+            dest.makedirs()
+        out = []
+        for thefile in sorted(entry.files()):
+            thefile.copy2(dest / thefile.name)
+            out.append(dest / thefile.name)
+        return out
+
+    def store(self, key, files):
+        """
+        Stores copies of `files` under `key`.  The entry appears whole
+        or not at all.
+        """
+        tmp = path(tempfile.mkdtemp(dir=self.root, prefix='.partial-'))
+        try:
+            for thefile in files:
+                path(thefile).copy2(tmp / path(thefile).name)
+            try:
+                os.rename(tmp, self.root / key)
+            except OSError:
+                # someone else stored the same build first
+                if not (self.root / key).isdir():
+                    raise
+        finally:
+            if tmp.exists():
+                tmp.rmtree()
+        return self.root / key
+
+
 @contextmanager
 def pushd(dir):
     old_dir = os.getcwd()
@@ -1,26 +1,43 @@
-import gevent.monkey
-gevent.monkey.patch_all()
-
+from . import config
+from . import damping
+from . import detect
 from . import haproxy
+from . import metrics
+from . import topology
+from .roles import ChainRoles
+from .roles import Logged
+from .roles import Snapshot
+from .roles import classify
+from .roles import defaults as chain_defaults
+from .roles import for_roles
+from .roles import register_patterns
 from gevent import pool
-from gevent.event import Event
+from gevent.queue import Empty
+from gevent.queue import Queue
+from gevent.lock import Semaphore
 from redis.connection import ConnectionError
 from stuf import frozenstuf
 import gevent
-import inspect as ins
 import logging
 import operator
 import redis
 import itertools
-from cliff.command import Command
+import time
+
+try:
+    from redis.exceptions import TimeoutError
+except ImportError:
+    TimeoutError = ConnectionError
 
+# what an instance that is down or wedged raises
+Unreachable = (ConnectionError, TimeoutError)
 
-class Logged(object):
-    logger = logging.getLogger(__name__)
-    info = logger.info
-    warn = logger.warn
-    error = logger.error
-    debug = logger.debug
+dispatches = metrics.registry.counter('redundis_dispatch_total',
+                                      'Role dispatches by the handler chosen')
+transitions = metrics.registry.counter('redundis_transitions_total',
+                                       'Instances seen going up or down')
+loop_time = metrics.registry.histogram('redundis_loop_seconds',
+                                       'Time to inspect and rechain per loop iteration')
 
 
 class RedisCxn(Logged):
@@ -32,7 +49,11 @@ class RedisCxn(Logged):
     def __init__(self, **cxn_args):
         self.cxn_args = frozenstuf(cxn_args)
         self.cxn = self.connect(self.cxn_args)
+        self._blocking = None
         self.connected = False
+        self.detector = None
+        self.info_section = 'replication'
+        self.snapshot = Snapshot.down
 
     @property
     def host(self):
@@ -42,13 +63,20 @@ class RedisCxn(Logged):
     def port(self):
         return self.cxn_args.port
 
+    @property
+    def spec(self):
+        return '%s:%s' %(self.host, self.port)
+
+    def __repr__(self):
+        return '<RedisCxn %s>' % self.spec
+
     def connect(self, cxn_args):
         cxn = self.redis_class(**cxn_args)
         try:
             cxn.ping()
             self.info("Connected %s:%s", cxn_args.host, cxn_args.port)
             self.connected = True
-        except ConnectionError:
+        except Unreachable:
             self.warn("Not connected %(host)s:%(port)s " %self.cxn_args)
         return cxn
 
@@ -59,10 +87,19 @@ class RedisCxn(Logged):
         return dict(host=host, port=port)
 
     @classmethod
-    def from_spec(cls, spec):
-        return cls(**cls.parse_redis_spec(spec))
+    def from_spec(cls, spec, **cxn_args):
+        return cls(**dict(cls.parse_redis_spec(spec), **cxn_args))
+
+    @property
+    def blocking(self):
+        """
+        A client without a socket timeout for blocking commands
+        """
+        if self._blocking is None:
+            self._blocking = self.redis_class(**dict(self.cxn_args, socket_timeout=None))
+        return self._blocking
 
-    def monitor_down(self, event, interval=2):
+    def monitor_down(self, interval=2):
         """
         poll a redis host until it become available
         """
@@ -71,109 +108,156 @@ class RedisCxn(Logged):
             try:
                 self.cxn.ping()
                 self.info("%s:%s back up", self.host, self.port)
-                self.connected = True
-                event.set()
+                transitions.inc(instance=self.spec, state='up')
                 return True
-            except ConnectionError:
+            except Unreachable:
                 if not next(counter) % 5:
                     self.debug("%s:%s down", self.host, self.port)
                 gevent.sleep(interval)
 
-    def monitor_up(self, event, key='redundis.monitor'):
+    def monitor_up(self, key='redundis.monitor'):
         """
         A monitor
         
         start a hanging connection that will either return or
-        disconnect with an error. 
+        disconnect with an error.  Returns False on a connection
+        failure, True when something is pushed to `key` to ask for a
+        fresh look at the chain.
+        """
+        while True:
+            try:
+                self.blocking.blpop(key)
+                return True
+            except Unreachable:
+                self.warn("%s:%s has had a connection failure", self.host, self.port)
+                transitions.inc(instance=self.spec, state='down')
+                return False
+            except redis.ResponseError, e:
+                # UNBLOCKED when the instance's role changes under us
+                self.debug("%s:%s blpop: %s", self.host, self.port, e)
+
+    def monitor_detect(self, up=True):
+        """
+        Heartbeat the instance through its detector until it is
+        judged to have changed from `up`.
+        """
+        alive = self.detector.wait_for(not up)
+        transitions.inc(instance=self.spec, state=alive and 'up' or 'down')
+        if alive:
+            self.info("%s:%s back up", self.host, self.port)
+        else:
+            self.warn("%s:%s has failed its heartbeat", self.host, self.port)
+        return alive
+
+    def watch(self, publish, interval=2):
+        """
+        Monitors the instance for as long as the greenlet lives,
+        calling `publish((self, up))` on each change of state.
+        `connected` is the state the watch starts out expecting.
+        """
+        while True:
+            if self.detector is not None:
+                up = self.monitor_detect(self.connected)
+            elif self.connected:
+                up = self.monitor_up()
+            else:
+                up = self.monitor_down(interval)
+            self.connected = up
+            publish((self, up))
+
+    @metrics.timed('redundis_probe_seconds', 'INFO replication probe latency')
+    def probe(self):
+        """
+        Takes a `Snapshot` of the instance's replication state with a
+        single `INFO replication` and keeps it as `snapshot`.  An
+        instance that refuses even a bare `INFO` counts as down.
         """
         try:
-            out = self.cxn.blpop(key)
-            event.set()
-            return out
-        except ConnectionError:
-            self.warn("%s:%s has had a connection failure", self.host, self.port)
-            self.connected = False
-            event.set()
-            return self
-        except gevent.GreenletExit:
-            pass
+            info = self.cxn.info(self.info_section)
+        except redis.ResponseError, e:
+            if self.info_section is not None:
+                # redis before 2.6 has no INFO sections
+                self.info_section = None
+                return self.probe()
+            self.warn("%s:%s refused INFO: %s", self.host, self.port, e)
+            self.snapshot = Snapshot.down
+        except Unreachable:
+            self.snapshot = Snapshot.down
+        else:
+            self.snapshot = Snapshot.from_info(info)
+        return self.snapshot
 
     @property
     def role(self):
-        try:
-            return self.cxn.info()['role']
-        except ConnectionError:
-            return None        
+        return self.probe().role
 
     @property
     def ping(self):
         try:
             return self.cxn.ping()
-        except ConnectionError:
+        except Unreachable:
             return False
 
+    @metrics.timed('redundis_slaveof_seconds', 'SLAVEOF latency')
     def slaveof(self, rcxn=None):
         if rcxn is None:
             return self.cxn.slaveof()
         return self.cxn.slaveof(host=rcxn.host, port=rcxn.port)
 
 
-def for_roles(*pattern):
-    """
-    Annotates a function with a pattern
-    """
-    def register(func):
-        rp = getattr(func, '_role_pattern', None)
-        if rp is None:
-            rp = []
-        rp.append(pattern)
-        func._role_pattern = rp
-        return func
-    return register
-
-
-def register_patterns(cls):
-    funcs = (x for x in cls.__dict__.values() \
-             if ins.isroutine(x) and getattr(x, '_role_pattern', False))
-    mapping = cls._role_patterns = {}
-    for func in funcs:
-        for pattern in func._role_pattern:
-            mapping[pattern] = func.__name__
-    return cls
-
-
-@register_patterns
-class Watcher(Logged):
+class Watcher(ChainRoles):
     redis_class = RedisCxn
-    statssocket_class = haproxy.StatsSocket
-    defaults = frozenstuf(redi=['localhost:6379',
-                                'localhost:6380',
-                                'localhost:6381'],
-                          redis_proxy='localhost:6666',
-                          haproxy_sock='/tmp/redundis-haproxy.sock',
-                          ha_backend='redis',
-                          ha_prefix='redis-%s')
-
-    weights = (150, 1, 0)
+    statssocket_class = haproxy.StatsSession
+    defaults = frozenstuf(chain_defaults)
 
     get_role = operator.attrgetter('role')
+    get_probe = operator.methodcaller('probe')
     get_ping = operator.attrgetter('ping')
 
-    state_set = frozenstuf(unitialized=set('master' for x in range(3)),
-                        stable=set(('master', 'slave', 'slave')))
-    
     def __init__(self, redi=None, haproxy_sock=None, redis_proxy=None,
-                 ha_backend=None, ha_prefix=None, down_poll=2):
+                 ha_backend=None, ha_prefix=None, down_poll=2,
+                 detector=None, detector_args=None, promote_wait=0,
+                 topology='chain', weights=None, name='default', pool=None, stats=None,
+                 probe_timeout=None, damping_args=None, publishers=None,
+                 quorum_timeout=10.0, haproxy_poll=1.0, haproxy_timeout=1000,
+                 sync_timeout=5.0):
+        self.name = name
+        self.probe_timeout = probe_timeout
         self.redi = redi and redi or self.defaults.redi
+        assert topology in self.topologies, "Unknown topology %s" % topology
+        self.topology = topology
+        if weights is not None:
+            self.weights = tuple(weights)
         self.down_poll = down_poll
+        self.promote_wait = promote_wait
+        self.sync_timeout = sync_timeout
+        self.syncing = frozenset()
+        self.upstreams = {}
+        self.repointed = set()
+        self.detector_class = detector and detect.detectors[detector] or None
+        self.detector_args = detector_args and detector_args or {}
+        self.damper = damping.Damper(**(damping_args and damping_args or {}))
+        self.quorum_timeout = quorum_timeout
+        self.haproxy_poll = haproxy_poll
+        self.disputes = {}
         self.redis_proxy = redis_proxy and redis_proxy or self.defaults.redis_proxy
-        self.haproxy = self.statssocket_class(haproxy_sock and haproxy_sock or self.defaults.haproxy_sock)
+        self.haproxy = stats is not None and stats or \
+                       self.statssocket_class(haproxy_sock and haproxy_sock or self.defaults.haproxy_sock,
+                                              timeout=haproxy_timeout)
+        self.weights_pending = False
         self.ha_backend = ha_backend and ha_backend or self.defaults.ha_backend
         self.ha_prefix = ha_prefix and ha_prefix or self.defaults.ha_prefix
-        self.pool = pool.Pool(4)
+        self.pool = gevent.pool.Pool(4) if pool is None else pool
+        self.monitors = gevent.pool.Group()
+
+        self.publishers = list(publishers or ())
+        self.epoch = int(time.time())
+        self.version = 0
+        self.published = None
 
         self.instances = None
-        self.watches = []
+        self.watches = {}
+        self.changes = Queue()
         self._cxns = {}
         self.state = {}
 
@@ -181,26 +265,110 @@ class Watcher(Logged):
         self.greenlet = gevent.spawn(self.start)
         return self.greenlet
     
-    def roles(self):
+    def probe(self):
+        """
+        Snapshots every instance once, concurrently
+        """
         if self.instances is None:
             self.load_inst()
-        return self.pool.map(self.get_role, self.instances)
+        return self.pool.map(self.get_probe, self.instances)
+
+    def roles(self):
+        """
+        The role of each instance, or None for those that are down or
+        held back by the damper
+        """
+        snaps = self.probe()
+        self.dispute([inst for inst, snap in zip(self.instances, snaps) if not snap.up])
+        roles = []
+        for inst, snap in zip(self.instances, snaps):
+            if snap.up and not self.damper.admit(inst):
+                self.debug("%s:%s held back (%s)", inst.host, inst.port, snap)
+                roles.append(None)
+                continue
+            roles.append(snap.role)
+        return roles
+
+    def haproxy_verdicts(self, max_age=None):
+        """
+        What HAProxy's health checks last said of each instance, as a
+        dict of instance to `haproxy.check_passed`
+        """
+        try:
+            stats = self.haproxy.show_stat(self.ha_backend, max_age=max_age)
+        except haproxy.StatsError, e:
+            self.warn("Could not read HAProxy checks: %s", e)
+            stats = {}
+        return dict((inst, haproxy.check_passed(stats.get(self.ha_prefix % inst.cxn_args.port))) \
+                    for inst in self.instances or ())
+
+    def dispute(self, down, now=None):
+        """
+        Notes which of the instances the watcher found `down` HAProxy
+        still passes health checks on.  Until both agree or
+        `quorum_timeout` seconds have passed, the chain is held as it
+        is rather than failed over for what may be a blip between the
+        watcher and redis.  Returns the instances in dispute.
+        """
+        now = now is not None and now or time.time()
+        if not down or not self.quorum_timeout:
+            self.disputes = {}
+            return []
+        verdicts = self.haproxy_verdicts()
+        self.disputes = dict((inst, self.disputes.get(inst, now)) \
+                             for inst in down if verdicts[inst])
+        return self.held(now)
+
+    def held(self, now=None):
+        """
+        The instances in dispute for less than `quorum_timeout`
+        """
+        now = now is not None and now or time.time()
+        return [inst for inst, since in self.disputes.items() \
+                if now - since < self.quorum_timeout]
+
+    def watch_haproxy(self, interval):
+        """
+        Polls HAProxy's health checks every `interval` seconds and asks
+        for a dispatch as soon as one fails, so an outage HAProxy sees
+        first is confirmed by a probe without waiting on the monitors
+        """
+        failing = set()
+        while True:
+            gevent.sleep(interval)
+            verdicts = self.haproxy_verdicts(max_age=interval)
+            for inst, passed in verdicts.items():
+                if passed is False and inst not in failing:
+                    self.info("%s:%s failing HAProxy checks", inst.host, inst.port)
+                    self.changes.put((inst, None))
+            failing = set(inst for inst, passed in verdicts.items() if passed is False)
 
     def ping_all_inst(self):
         return self.pool.map(self.get_ping, self.instances)
 
     def load_inst(self):
         self.instances = []
-        self.instances.extend(self.redis_class.from_spec(spec) for spec in self.redi)
+        self.instances.extend(self.redis_class.from_spec(spec, socket_timeout=self.probe_timeout) \
+                              for spec in self.redi)
+        if self.detector_class is not None:
+            for inst in self.instances:
+                inst.detector = self.detector_class(inst.host, inst.port, **self.detector_args)
         return self.instances
 
-    def logging_setup(self, loglevel=logging.INFO):
-        logging.basicConfig(level=loglevel,
-                            format='[%(levelname)s] %(message)s')
-
     def dispatch_for_roles(self, roles):
-        self.debug("dfr: %s", roles)
-        name = self._role_patterns.get(tuple([x for x in roles if x]), 'default_role_handler')
+        self.debug("dfr: %s %s", self.name, roles)
+        self.syncing = frozenset()
+        held = self.held()
+        if held:
+            self.warn("%s: HAProxy still passes %s, holding chain at %s", self.name,
+                      ', '.join('%s:%s' %(inst.host, inst.port) for inst in held), roles)
+            dispatches.inc(handler='disputed')
+            return self.instances
+        name = self.handler_for(roles)
+        if name is None:
+            dispatches.inc(handler='deferred')
+            return self.instances
+        dispatches.inc(handler=name)
         method = getattr(self, name)
         try:
             return method(roles)
@@ -208,117 +376,111 @@ class Watcher(Logged):
             #import pdb, sys;pdb.post_mortem(sys.exc_info()[2])
             self.error("Unexpected exception", exc_info=True)
 
-    def default_role_handler(self, roles):
-        if not any(roles):
-            return self.instances
-        return self.all_up_reversed(roles)
-
-    @for_roles(None, None, None)
-    def all_down(self, roles):
-        """
-        No instances are up. Do nothing.
-        """
-        return self.instances
-
-    # these conditions likely result from intermittent network issues.
-
-    @for_roles('master', 'master', 'slave') 
-    def abberation1(self, roles):
-        self.warn("abberation1 '%s'" %roles)
-        return self.masterup_fix_chain(roles)
-
-    @for_roles('slave', 'slave', 'slave')  
-    def abberation2(self, roles):
-        self.warn("abberation2 '%s'" %roles)
-        return self.all_up_reversed(roles)
-
-
-    @for_roles('master', 'slave', 'slave')   # normal order, but may need rechain
-    @for_roles('master', 'master', 'master') # initial order
-    @for_roles('master', 'slave', 'master')  # a redis returns
-    def masterup_fix_chain(self, roles):
-        """
-        A master is in the master position. Chain redis to each
-        other. If not a condition of initialization, an abberation has
-        occurred
-        """
-        r1, r2, r3 = self.instances
-        r2.slaveof(r1)
-        r3.slaveof(r2)
-        self.assign_weights(r1, r2, r3)
-        return self.instances
-
-    @for_roles('slave', 'master', 'master')
-    @for_roles('slave', 'master', 'slave')
-    @for_roles('slave', 'slave', 'master')
-    def all_up_reversed(self, roles):
-        r1, _, _ = self.instances
-        r1.slaveof(); roles[0] = 'master'
-        return self.masterup_fix_chain(roles)
-        
-    @for_roles('master')
-    def only_master(self, roles):
-        self.instances.insert(0, self.instances.pop(roles.index('master')))
-        self.assign_weights(self.instances[0])
-        return self.instances
-
-    @for_roles('slave')
-    def only_slave(self, roles):
-        """
-        Promote to master, await return of other redi
-        """
-        self.instances.insert(0, self.instances.pop(roles.index('slave')))
-        self.assign_weights(self.instances[0])
-        return self.instances
-
-    def heal_pair(self, roles, r1, r2):
-        """
-        Reorder and remaster instances so r1 -> r2 
-        """
-        offline = self.instances.pop(roles.index(None))
-        r1, r2 = self.instances
-        self.instances.append(offline)
-        self.pool.spawn(r1.slaveof)
-        self.pool.spawn(r2.slaveof, r1)
-        self.pool.join()
-        self.assign_weights(r1, r2)
-        return self.instances
-
-    @for_roles('slave', 'slave')
-    def dead_master(self, roles):
-        return self.heal_pair(roles, 'slave', 'slave')
-
-    @for_roles('master', 'slave')
-    def dead_slave(self, roles):
+    def rechain(self, insts, promote=False):
         """
-        One redis is still down, enforce normal configuration
+        Points every instance after the first of `insts` at its
+        upstream, promoting the first with `promote`, all at once.
+        Gives up waiting after `sync_timeout` seconds; a SLAVEOF still
+        running is left to its socket timeout.  Slaves pointed at a
+        new upstream are noted in `repointed`.
         """
-        return self.heal_pair(roles, 'master', 'slave')
+        pairs = ([(insts[0], None)] if promote else []) + self.replication_pairs(insts)
+        jobs = [(inst, upstream, self.pool.spawn(inst.slaveof, upstream)) \
+                for inst, upstream in pairs]
+        gevent.joinall([job for inst, upstream, job in jobs], timeout=self.sync_timeout or None)
+        self.repointed = set()
+        for inst, upstream, job in jobs:
+            if not job.ready():
+                self.warn("%s:%s SLAVEOF still running after %ss",
+                          inst.host, inst.port, self.sync_timeout)
+            if self.upstreams.get(inst, False) is not upstream:
+                self.repointed.add(inst)
+            if job.successful():
+                self.upstreams[inst] = upstream
+            else:
+                self.upstreams.pop(inst, None)
 
-    @for_roles('slave', 'master')
-    def flipped_master(self, roles):
+    def await_sync(self, insts):
         """
-        hypothetically, two redi have gone down and one has returned
+        Waits up to `sync_timeout` seconds for the slaves of `insts`
+        to report their link to their upstream up.  Those just
+        repointed or not yet replicating are probed straight after
+        SLAVEOF, then at doubling intervals.  If any is still down
+        after the first probe, the head and the slaves already
+        replicating are weighted without waiting.  Slaves still syncing
+        at the deadline are kept in `syncing` and out of the weights
+        until the chain is next reviewed.
         """
-        return self.heal_pair(roles, 'slave', 'master')
-
-    @for_roles('master', 'master')
-    def double_master(self, roles):
+        if not self.sync_timeout or len(insts) < 2:
+            return []
+        deadline = time.time() + self.sync_timeout
+        pause = 0.01
+        synced = self.synced(insts)
+        unsure = [inst for inst in insts[1:] if inst in self.repointed or inst not in synced]
+        if not unsure:
+            return []
+        self.pool.map(self.get_probe, unsure)
+        lagging = [inst for inst in insts if inst not in self.synced(insts)]
+        if lagging:
+            self.assign_weights(*self.synced(insts))
+        while lagging and time.time() < deadline:
+            gevent.sleep(min(pause, max(0, deadline - time.time())))
+            pause = min(pause * 2, 0.2)
+            self.pool.map(self.get_probe, lagging)
+            lagging = [inst for inst in insts if inst not in self.synced(insts)]
+        for inst in lagging:
+            self.warn("%s:%s still syncing (%s), leaving it at weight 0",
+                      inst.host, inst.port, inst.snapshot)
+        self.syncing = frozenset(lagging)
+        return lagging
+
+    def drain_lag(self, master, slaves):
         """
-        2 redi up, one lagging to return.  Hypothetically a full
-        failure of all redi or on initialization
+        Waits up to `promote_wait` seconds for `slaves` to reach the
+        replication offset of the `master` about to be promoted, so
+        they can continue replicating without a full resync.
         """
-        return self.heal_pair(roles, 'master', 'master')
-
+        target = master.snapshot.offset
+        if not self.promote_wait or target is None:
+            return []
+        deadline = time.time() + self.promote_wait
+        lagging = [inst for inst in slaves if (inst.snapshot.offset or 0) < target]
+        while lagging and time.time() < deadline:
+            gevent.sleep(0.05)
+            self.pool.map(self.get_probe, lagging)
+            lagging = [inst for inst in lagging \
+                       if inst.snapshot.up and (inst.snapshot.offset or 0) < target]
+        for inst in lagging:
+            self.warn("%s:%s still behind %s:%s at offset %s < %s", inst.host, inst.port,
+                      master.host, master.port, inst.snapshot.offset, target)
+        return lagging
+
+    @metrics.timed('redundis_weight_apply_seconds', 'Time to plan and apply chain weights')
     def assign_weights(self, *insts):
         """
-        Takes a list of `insts` of a maximimum length 3 that is
-        assumed to be in chain order and applies the appropriate
-        weights in haproxy.
+        Takes a list of `insts` that is assumed to be in chain order
+        and applies the appropriate weights in haproxy. Instances not
+        in the chain are drained to 0.  Only weights that differ from
+        those last seen in haproxy are sent, in a single batch.
         """
-        args = ((self.ha_backend, self.ha_prefix % inst.cxn_args.port, str(lbs)) \
-                for inst, lbs in zip(insts, self.weights))
-        self.pool.map(self.set_weight, args)
+        insts = self.weighted(insts)
+        servers = [self.ha_prefix % inst.cxn_args.port for inst in insts]
+        idle = [self.ha_prefix % inst.cxn_args.port \
+                for inst in self.instances if inst not in insts]
+        weights = [self.weight_for(i) for i in range(len(servers))]
+        plan = haproxy.WeightPlan.from_chain(self.ha_backend, servers, weights, idle,
+                                             self.haproxy.cached_weights(self.ha_backend))
+        try:
+            diff = plan.apply(self.haproxy)
+        except haproxy.StatsError, e:
+            # the chain is already rechained; weights are retried on review
+            self.error("%s: could not apply weights, will retry: %s", self.name, e)
+            self.weights_pending = True
+            return []
+        self.weights_pending = False
+        for server, old, new in diff:
+            self.debug("%s %s => %s", server, old, new)
+        return diff
 
     def set_weight(self, args):
         backend, server, weight = args
@@ -327,108 +489,274 @@ class Watcher(Logged):
         self.debug("%s %s", server, cur)
 
     def check_weights(self, *insts):
-        args = ((self.ha_backend, self.ha_prefix % inst.cxn_args.port) for inst in insts)
-        return self.pool.map(self.haproxy.get_weight_tuple, args)        
+        """
+        The weight HAProxy gives each of `insts`, read with one `show
+        stat` for the whole backend; None for servers it doesn't know
+        """
+        try:
+            stats = self.haproxy.show_stat(self.ha_backend)
+        except haproxy.StatsError, e:
+            self.warn("Could not read HAProxy weights: %s", e)
+            stats = {}
+        return [getattr(stats.get(self.ha_prefix % inst.cxn_args.port), 'weight', None) \
+                for inst in insts]
 
     def do_dispatch(self):
+        """
+        Probes the chain once and dispatches on the roles found.  The
+        same snapshots decide what is up afterwards.
+        """
         insts = self.dispatch_for_roles(self.roles())
-        return zip((bool(x) for x in self.roles()),
+        return zip((inst.snapshot.up for inst in insts),
                    self.check_weights(*insts),
                    insts)
 
-    def check_and_respond(self, event):
+    def check_and_respond(self):
         """
         Triggers the inspection and reaction to the order of role for
-        our chain.
+        our chain, then makes sure each instance has a monitor.
+        Returns the monitors that were (re)started.
         """
-        event.clear()
         try:
             inst_up = self.do_dispatch()
         except ConnectionError:
             gevent.sleep(1)
             inst_up = self.do_dispatch()
+        self.publish(inst_up)
 
+        started = []
         for up, weight, inst in inst_up:
-            if up:
-                self.info("%s:%s UP => %s", inst.host, inst.port, weight)
-                gr = self.pool.spawn(inst.monitor_up, event)
-                gr.link(self.monitor_up_exit)
-                yield gr 
-            else:
-                self.info("%s:%s DOWN => %s", inst.host, inst.port, weight)
-                yield self.pool.spawn(inst.monitor_down, event, interval=self.down_poll)
+            self.info("%s:%s %s (%s) => %s", inst.host, inst.port,
+                      up and "UP" or "DOWN", inst.snapshot, weight)
+            gr = self.supervise(inst, up)
+            if gr is not None:
+                started.append(gr)
+        return started
+
+    def describe(self, inst_up):
+        """
+        The chain as a topology document (see `redundis.topology`)
+        """
+        spec = lambda inst: '%s:%s' %(inst.host, inst.port)
+        master = None
+        # the snapshots predate any promotion; the head of the chain is
+        # the master once dispatched, if it is up
+        if inst_up and inst_up[0][0]:
+            master = spec(inst_up[0][2])
+        return dict(cluster=self.name, epoch=self.epoch, version=self.version,
+                    master=master,
+                    chain=[spec(inst) for up, weight, inst in inst_up],
+                    down=[spec(inst) for up, weight, inst in inst_up if not up],
+                    weights=dict((spec(inst), weight) for up, weight, inst in inst_up),
+                    lag=dict((spec(inst), self.lag_of(inst)) \
+                             for up, weight, inst in inst_up if up))
+
+    @staticmethod
+    def lag_of(inst):
+        """
+        Seconds `inst` is behind its master, or None for a slave whose
+        link is down, however recently it last heard from the master
+        """
+        snap = inst.snapshot
+        if snap.role == 'slave' and snap.link != 'up':
+            return None
+        return snap.lag
+
+    def publish(self, inst_up):
+        """
+        Sends a new topology document to each of `publishers` if
+        anything but lag has changed since the last, or a slave's link
+        has gone down or come back.
+        """
+        doc = self.describe(inst_up)
+        key = [doc[k] for k in ('master', 'chain', 'down', 'weights')]
+        key.append(sorted(name for name, lag in doc['lag'].items() if lag is None))
+        if key == self.published:
+            return None
+        self.published = key
+        self.version += 1
+        doc['version'] = self.version
+        for publisher in self.publishers:
+            try:
+                publisher.publish(doc, self)
+            except Exception:
+                self.error("Publishing topology failed", exc_info=True)
+        return doc
+
+    def supervise(self, inst, up):
+        """
+        Leaves a running monitor alone if it already expects `inst` to
+        be `up`; otherwise starts one that does, replacing any stale
+        monitor.  Returns the new monitor, if any.
+        """
+        gr = self.watches.get(inst)
+        if gr is not None and not gr.dead and inst.connected == up:
+            return None
+        if gr is not None:
+            gr.kill()
+        self.rejoined(inst, up)
+        inst.connected = up
+        gr = self.watches[inst] = self.monitors.spawn(inst.watch, self.changes.put,
+                                                      interval=self.down_poll)
+        return gr
+
+    def review_in(self):
+        """
+        Seconds until the chain must be looked at again without any
+        change: when the damper is due to review a held back instance
+        or deferred failover, to recheck a disputed instance, to retry
+        weights HAProxy did not take or to weight slaves that were still
+        syncing.  None if nothing waits.
+        """
+        waits = [self.damper.next_review()]
+        if self.disputes or self.weights_pending or self.syncing:
+            waits.append(self.haproxy_poll or self.down_poll)
+        waits = [x for x in waits if x is not None]
+        if not waits:
+            return None
+        return min(waits)
+
+    def drain_changes(self):
+        """
+        Waits for a monitor to publish a change, and gathers any that
+        arrive with it.  Returns nothing once it is time to review the
+        chain anyway (see `review_in`).
+        """
+        try:
+            changes = [self.changes.get(timeout=self.review_in())]
+        except Empty:
+            return []
+        gevent.sleep(0)
+        while not self.changes.empty():
+            changes.append(self.changes.get_nowait())
+        return changes
 
     def loop(self):
         """
         The loop follows the series of actions:
 
          1. check current state redi, adjust to form a suitable chain
-            if possible, return a series of greenlets to monitor what
-            is up and down.
+            if possible, and make sure every instance has a long lived
+            monitor watching for its next change of connection status
+            (lose or reestablish connection)
 
-         2. Wait for a monitor event to indicate a change of
-            connection status (lose or reestablish connection)
- 
-         3. Kill all watches and clear event
-
-         4. Rinse and repeat
-        """
-        event = Event()
-        while True:
-            watches = [mon for mon in self.check_and_respond(event)]
-            self.debug("%s", [x.strip() for x in self.check_weights(*self.instances)])
-            event.wait()
-            [w.kill() for w in watches] 
+         2. Wait for monitors to publish changes
 
+         3. Send instances that went down to the end of the chain,
+            and let the damper know of every change.  A failing
+            HAProxy check only prompts the next check.
 
-    def monitor_up_exit(self, gr):
-        inst = gr.value
-        if not inst is None:
-            where = self.instances.index(inst)
+         4. Rinse and repeat, restarting only the monitors whose
+            instance is not in the state they expect
+        """
+        poller = self.haproxy_poll and gevent.spawn(self.watch_haproxy, self.haproxy_poll)
+        try:
+            while True:
+                with loop_time.time(cluster=self.name):
+                    self.check_and_respond()
+                self.debug("%s", self.check_weights(*self.instances))
+                for inst, up in self.drain_changes():
+                    if up is None:
+                        continue
+                    self.damper.record(inst, up)
+                    if not up:
+                        self.caboose(inst)
+        finally:
+            if poller:
+                poller.kill()
+
+    def caboose(self, inst):
+        if inst in self.instances:
+            self.instances.remove(inst)
+            self.instances.append(inst)
             self.debug("%s:%s caboosed", inst.host, inst.port)
-            self.instances.append(self.instances.pop(where))
 
     def start(self):
         self.logging_setup()
         return gevent.spawn(self.loop)
 
 
-
-class Watch(Command):
+class ClusterPool(pool.Group):
     """
-    dundis command for running the watcher
-    """
-    def get_parser(self, name):
-        parser = super(Watch, self).get_parser(name)
-        parser.add_argument('-c', '--config', action='store',
-                            default=None, help='config file')
-
-        parser.add_argument('-r', '--redi', action='store',
-                            default=",".join(Watcher.defaults.redi),
-                            help='Redis instances (comma delimited)')
+    One cluster's share of a greenlet pool bounded across clusters.
 
-        parser.add_argument('-p', '--proxy', action='store',
-                            default=Watcher.defaults.redis_proxy, help='Address of redis via haproxy')
-
-        parser.add_argument('--haproxy_sock', action='store',
-                            default=Watcher.defaults.haproxy_sock, help='HAProxy stats socket')
-        
-        parser.add_argument('--haproxy_backend', action='store',
-                            default=Watcher.defaults.ha_backend, help='HAProxy stats socket')
-        
-        #@@ server prefix
-        return parser
-    
-    def run(self, args):
-        redi = args.redi.split(',')
-        watcher = Watcher(redi, args.haproxy_sock, args.proxy, args.haproxy_backend)
+    No more than `share` of the cluster's greenlets run at once, so a
+    busy cluster cannot starve the others, and each running greenlet
+    holds a slot of the process-wide `shared` semaphore.
+    """
+    def __init__(self, shared, share):
+        pool.Group.__init__(self)
+        self.shared = shared
+        self.local = Semaphore(share)
+
+    def spawn(self, func, *args, **kw):
+        self.local.acquire()
+        self.shared.acquire()
         try:
-            watcher.start().join()
-        except KeyboardInterrupt:
-            return 
+            gr = pool.Group.spawn(self, func, *args, **kw)
+        except:
+            self.release()
+            raise
+        gr.rawlink(self.release)
+        return gr
 
+    def release(self, gr=None):
+        self.shared.release()
+        self.local.release()
 
-        
 
+class Supervisor(Logged):
+    """
+    Watches many named clusters from one process.
+
+    The clusters' watchers share one stats session per HAProxy socket
+    and a greenlet pool of `pool_size`, of which each cluster may use
+    `share` at a time (by default an even split).
+    """
+    watcher_class = Watcher
+
+    def __init__(self, clusters, pool_size=16, share=None, publish_channel=None,
+                 publish_sock=None, publish_key=None, **watcher_args):
+        self.shared = Semaphore(pool_size)
+        publishers = topology.publishers(publish_channel, publish_sock, publish_key)
+        share = share and share or max(1, pool_size // max(1, len(clusters)))
+        self.sessions = {}
+        self.watchers = {}
+        for name, spec in sorted(clusters.items()):
+            args = dict(watcher_args, **spec)
+            if 'backend' in args:
+                args['ha_backend'] = args.pop('backend')
+            sock = args.pop('haproxy_sock', None) or self.watcher_class.defaults.haproxy_sock
+            self.watchers[name] = self.watcher_class(name=name,
+                                                     stats=self.session(sock, args.get('haproxy_timeout')),
+                                                     pool=ClusterPool(self.shared, share),
+                                                     publishers=publishers,
+                                                     **args)
+
+    def session(self, sock, timeout=None):
+        if sock not in self.sessions:
+            self.sessions[sock] = self.watcher_class.statssocket_class(sock, timeout=timeout or 1000)
+        return self.sessions[sock]
 
+    @classmethod
+    def from_config(cls, stream):
+        """
+        Loads settings from a YAML stream.  Clusters are a mapping of
+        name to watcher settings under `clusters`; any other top level
+        key is a default for every cluster.  A config without
+        `clusters` describes a single cluster.
+        """
+        settings, clusters = config.load_clusters(stream)
+        sup_args = dict((key, settings.pop(key)) for key in \
+                        ('pool_size', 'share', 'publish_channel', 'publish_sock', 'publish_key') \
+                        if key in settings)
+        if not clusters:
+            clusters = dict(default=settings)
+            settings = {}
+        return cls(clusters, **dict(sup_args, **settings))
 
+    def start(self):
+        self.logging_setup()
+        loops = [gevent.spawn(watcher.loop) for name, watcher in sorted(self.watchers.items())]
+        self.info("Watching %d clusters", len(loops))
+        return gevent.spawn(gevent.joinall, loops, raise_error=True)
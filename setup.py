@@ -30,6 +30,11 @@ setup(name='Redundis',
       dundis = redundis.cli:main
 
       [redundis.cli]
-      watch = redundis.watcher:Watch
+      watch = redundis.commands:Watch
+      bench = redundis.commands:Bench
+      status = redundis.commands:Status
+      cluster = redundis.commands:Cluster
+      chaos = redundis.commands:Chaos
+      install = redundis.devinst:DevInstall
       """,
       )